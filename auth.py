@@ -1,6 +1,10 @@
+import hashlib
 import json
 import os
-from flask import request, _request_ctx_stack
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import request, g, _request_ctx_stack
 from functools import wraps
 from urllib.request import urlopen
 from jose import jwt
@@ -9,6 +13,17 @@ AUTH0_DOMAIN = os.environ['AUTH_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS source, may also be a local file path or a stub server url
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = float(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+
+# number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 
 # AuthError Exception
 class AuthError(Exception):
@@ -50,13 +65,15 @@ def get_token_auth_header():
 
 
 # Check Permissions
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permission not included in JWT.'
         }, 400)
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = payload['permissions']
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found'
@@ -64,27 +81,131 @@ def check_permissions(permission, payload):
     return True
 
 
+# JWKS key store
+class JWKSCache:
+    '''
+    Process-wide store of the signing keys published by the IdP.
+
+    Keys are served from memory. Once they are older than `ttl` they are
+    refreshed in a background thread while the old keys keep being served.
+    An unknown `kid` triggers one synchronous refetch, at most once every
+    `min_refresh_interval` seconds. A failed refresh keeps the stale keys.
+    '''
+
+    def __init__(self, url, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def fetch(self):
+        if '://' in self.url:
+            with urlopen(self.url, timeout=self.timeout) as jsonurl:
+                jwks = json.loads(jsonurl.read())
+        else:
+            with open(self.url) as jsonfile:
+                jwks = json.load(jsonfile)
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys'] if 'kid' in key
+        }
+
+    def refresh(self):
+        with self._refresh_lock:
+            now = time.monotonic()
+            if (self._last_attempt is not None and
+                    now - self._last_attempt < self.min_refresh_interval):
+                return False
+            self._last_attempt = now
+            try:
+                keys = self.fetch()
+            except Exception:
+                with self._lock:
+                    self.refresh_failures += 1
+                return False
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+                self.refreshes += 1
+            return True
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or (
+                    self._last_attempt is not None and
+                    time.monotonic() - self._last_attempt <
+                    self.min_refresh_interval):
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            self.refresh()
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self.refresh_in_background()
+        key = self._keys.get(kid)
+        with self._lock:
+            if key is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if key is None and self.refresh():
+            key = self._keys.get(kid)
+        return key
+
+    def stats(self):
+        with self._lock:
+            age = None
+            if self._fetched_at is not None:
+                age = time.monotonic() - self._fetched_at
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'keys': len(self._keys),
+                'age': age
+            }
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
 # verify JWT
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -120,15 +241,112 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+# Verified token cache
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'exp'])
+
+
+class TokenCache:
+    '''
+    Bounded LRU of verified token payloads, keyed by a hash of the token.
+
+    Entries expire at the token's `exp` claim and carry the token's
+    permissions as a frozenset so permission checks are a set lookup.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if self.maxsize <= 0:
+            return None
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.exp <= time.time():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, token, payload):
+        entry = VerifiedToken(
+            payload,
+            frozenset(payload.get('permissions', ())),
+            payload.get('exp'))
+        if self.maxsize <= 0 or not isinstance(entry.exp, (int, float)):
+            return entry
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+token_cache = TokenCache()
+
+
+def get_verified_token(token):
+    entry = token_cache.get(token)
+    if entry is None:
+        entry = token_cache.put(token, verify_decode_jwt(token))
+    return entry
+
+
 # require auth
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                verified = get_verified_token(token)
+                # None leaves the permission check to the view
+                if permission is not None:
+                    check_permissions(permission, verified.payload,
+                                      verified.permissions)
+            finally:
+                # the auth phase of the request's Server-Timing
+                timings = g.get('timings')
+                if timings is not None:
+                    timings.add('auth', time.perf_counter() - start)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
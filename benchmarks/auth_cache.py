@@ -0,0 +1,42 @@
+'''
+Per-request auth cost with the verified-token cache on and off.
+
+Signs a token with a throwaway RSA key, serves the key from a local JWKS
+file and times requires_auth around a no-op view.
+
+    python benchmarks/auth_cache.py [iterations]
+'''
+import sys
+import time
+
+from common import SigningKey
+
+
+def main(iterations):
+    key = SigningKey()
+
+    from flask import Flask
+    import auth
+
+    view = auth.requires_auth('get:movies')(lambda payload: None)
+    app = Flask(__name__)
+    headers = key.headers(['get:movies'])
+
+    results = {}
+    for label, size in (('cache off', 0), ('cache on', 1024)):
+        auth.token_cache = auth.TokenCache(size)
+        with app.test_request_context(headers=headers):
+            view()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                view()
+            elapsed = time.perf_counter() - start
+        results[label] = elapsed / iterations
+        print(f'{label:>9}: {results[label] * 1e6:10.1f} us/request'
+              f'  {auth.token_cache.stats()}')
+    print(f'speedup: {results["cache off"] / results["cache on"]:.1f}x')
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,93 @@
+'''
+Shared setup for the benchmark scripts: throwaway signing key served from a
+local JWKS file, token minting and synthetic rows.
+'''
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+
+import rsa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('AUTH_DOMAIN', 'fzauth.auth0.com')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'CastAuthApi')
+
+PERMISSIONS = [
+    'delete:actors', 'delete:movies', 'get:actors', 'get:movies',
+    'modify:actors', 'modify:movies', 'post:actors', 'post:movies'
+]
+
+
+def _b64(number):
+    raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class SigningKey:
+    '''
+    RSA key published through a temporary JWKS file. Sets JWKS_URL, so create
+    it before importing auth or flaskr.
+    '''
+
+    def __init__(self, kid='bench'):
+        self.kid = kid
+        public_key, private_key = rsa.newkeys(2048)
+        self.pem = private_key.save_pkcs1().decode()
+        jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        json.dump({'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'n': _b64(public_key.n),
+            'e': _b64(public_key.e)
+        }]}, jwks_file)
+        jwks_file.close()
+        self.jwks_path = jwks_file.name
+        os.environ['JWKS_URL'] = self.jwks_path
+
+    def token(self, permissions=PERMISSIONS, ttl=3600):
+        from jose import jwt
+        now = int(time.time())
+        return jwt.encode({
+            'iss': 'https://{}/'.format(os.environ['AUTH_DOMAIN']),
+            'aud': os.environ['API_AUDIENCE'],
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': permissions
+        }, self.pem, algorithm='RS256', headers={'kid': self.kid})
+
+    def headers(self, permissions=PERMISSIONS):
+        return {'Authorization': 'Bearer ' + self.token(permissions)}
+
+    def close(self):
+        os.remove(self.jwks_path)
+
+
+def temp_database():
+    '''Fresh SQLite file, also exported as DATABASE_URL.'''
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    return path
+
+
+def seed(engine, rows, batch=10000):
+    '''Insert synthetic movies and actors, ids 1..rows.'''
+    from models import Movies, Actors
+    for start in range(0, rows, batch):
+        stop = min(start + batch, rows)
+        engine.execute(Movies.__table__.insert(), [{
+            'name': 'Movie %d' % i,
+            'rdate': 'March %d, %d' % (i % 28 + 1, 1950 + i % 70)
+        } for i in range(start, stop)])
+        engine.execute(Actors.__table__.insert(), [{
+            'name': 'Actor %d' % i,
+            'age': 18 + i % 60,
+            'gender': ('Female', 'Male')[i % 2]
+        } for i in range(start, stop)])
@@ -0,0 +1,58 @@
+'''
+Bytes on the wire and CPU per request of GET /movies?all=true for every
+body format and Content-Encoding, encoded on each request and served from
+the response cache.
+
+    python benchmarks/compression.py [rows] [requests]
+'''
+import os
+import sys
+import time
+
+from common import SigningKey, temp_database, seed
+
+URL = '/movies?all=true'
+FORMATS = ('application/json', 'application/msgpack')
+ENCODINGS = ('identity', 'gzip', 'br')
+
+
+def main(rows, requests):
+    key = SigningKey()
+    path = temp_database()
+    from flaskr import create_app
+    from models import db
+
+    clients = {}
+    for label, cache in (('encoded', 'none'), ('cached', 'memory')):
+        app = create_app({'RESPONSE_CACHE': cache, 'SUGGEST_INDEX': False,
+                          'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+                          'METRICS': False, 'SERVER_TIMING': False})
+        if not clients:
+            with app.app_context():
+                seed(db.engine, rows)
+        clients[label] = app.test_client()
+
+    print(f'{rows} movies, CPU ms per request')
+    print(f'{"format":>20} {"encoding":>9} {"bytes":>10} {"encoded":>9}'
+          f' {"cached":>9}')
+    for mimetype in FORMATS:
+        for encoding in ENCODINGS:
+            headers = dict(key.headers(), **{
+                'Accept': mimetype, 'Accept-Encoding': encoding})
+            size = len(clients['encoded'].get(URL, headers=headers).data)
+            cpu = []
+            for client in clients.values():
+                client.get(URL, headers=headers).close()
+                start = time.process_time()
+                for _ in range(requests):
+                    client.get(URL, headers=headers).close()
+                cpu.append((time.process_time() - start) / requests * 1000)
+            print(f'{mimetype:>20} {encoding:>9} {size:>10,}' + ''.join(
+                f' {ms:>9.2f}' for ms in cpu))
+    os.remove(path)
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 20)
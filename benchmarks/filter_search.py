@@ -0,0 +1,76 @@
+'''
+Filtered actor search on a large synthetic table: downloading the table
+and filtering client side, server-side filters without indexes, and
+server-side filters with the search indexes.
+
+    python benchmarks/filter_search.py [rows]
+'''
+import os
+import sys
+import time
+
+from common import temp_database, seed
+
+QUERIES = (
+    'name_prefix=Actor 12345',
+    'gender=Female&min_age=30&max_age=31',
+    'min_age=70',
+)
+
+
+def timed(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, len(rows)
+
+
+def main(rows):
+    path = temp_database()
+    from flaskr import create_app
+    from flaskr.filters import requested_filters
+    from models import db, Actors, select_rows, row_dicts
+
+    app = create_app()
+    with app.app_context():
+        seed(db.engine, rows)
+        db.session.execute('ANALYZE')
+    indexes = [index for index in Actors.__table__.indexes]
+    print(f'{rows} actors')
+
+    def client_side(args):
+        actors = row_dicts(Actors.FIELDS, select_rows(Actors).all())
+        return [actor for actor in actors if
+                actor['name'].startswith(args.get('name_prefix', '')) and
+                actor['age'] >= int(args.get('min_age', 0)) and
+                actor['age'] <= int(args.get('max_age', 1000)) and
+                args.get('gender', actor['gender']) == actor['gender']]
+
+    def server_side(where):
+        return select_rows(Actors).filter(*where).all()
+
+    for query in QUERIES:
+        with app.test_request_context('/actors?' + query):
+            from flask import request
+            where = requested_filters(Actors)
+            download = timed(lambda: client_side(request.args), repeat=1)
+            for index in indexes:
+                index.drop(db.engine)
+            unindexed = timed(lambda: server_side(where))
+            for index in indexes:
+                index.create(db.engine)
+            db.session.execute('ANALYZE')
+            indexed = timed(lambda: server_side(where))
+        print(f'{query}')
+        for label, (ms, found) in (('download + filter', download),
+                                   ('filter, no index', unindexed),
+                                   ('filter, indexed', indexed)):
+            print(f'  {label:>18}: {ms:9.2f} ms  {found} rows')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,56 @@
+'''
+Concurrent POST /movies throughput with one commit per insert and with
+group commit, threads posting in one worker against a SQLite file.
+
+    python benchmarks/group_commit.py [inserts] [threads]
+'''
+import os
+import sys
+import threading
+import time
+
+from common import SigningKey, temp_database
+
+
+def run(app, headers, inserts, threads):
+    per_thread = inserts // threads
+
+    def post():
+        client = app.test_client()
+        for index in range(per_thread):
+            client.post('/movies', headers=headers,
+                        json={'name': 'Movie', 'rdate': 'March 1, 1999'})
+    workers = [threading.Thread(target=post) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main(inserts, threads):
+    key = SigningKey()
+    headers = key.headers()
+    from flaskr import create_app
+    print(f'{inserts} inserts from {threads} threads')
+    for label, config in (
+            ('commit per insert', {}),
+            ('group commit, 2 ms', {'GROUP_COMMIT': True}),
+            ('group commit, 10 ms', {'GROUP_COMMIT': True,
+                                     'GROUP_COMMIT_WAIT_MS': 10})):
+        path = temp_database()
+        app = create_app(dict(config, DATABASE_URL=os.environ['DATABASE_URL'],
+                              SUGGEST_INDEX=False, RESPONSE_CACHE='none'))
+        rate = run(app, headers, inserts, threads)
+        group = app.extensions.get('group_commit')
+        per_commit = group.stats()['rows_per_commit'] if group else 1.0
+        print(f'  {label:>20}: {rate:8.0f} inserts/s  '
+              f'{per_commit:5.1f} rows per commit')
+        os.remove(path)
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 16)
@@ -0,0 +1,60 @@
+'''
+Cost of the per-request phase timings: GET /actors with Server-Timing and
+/metrics off and on, best of alternating rounds, and the Server-Timing
+breakdown of a page.
+
+    python benchmarks/instrumentation.py [requests]
+'''
+import os
+import sys
+import tempfile
+import time
+
+from common import SigningKey, temp_database, seed
+
+URL = '/actors?limit=50'
+ROUNDS = 5
+
+
+def main(requests):
+    key = SigningKey()
+    path = temp_database()
+    from flaskr import create_app
+    from models import db
+
+    headers = key.headers()
+    clients = {}
+    for label, on in (('timings off', False), ('timings on', True)):
+        app = create_app({'RESPONSE_CACHE': 'none', 'SUGGEST_INDEX': False,
+                          'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+                          'METRICS': on, 'SERVER_TIMING': on,
+                          'METRICS_DIR': tempfile.mkdtemp()})
+        if not on:
+            with app.app_context():
+                seed(db.engine, 10000)
+        clients[label] = app.test_client()
+    results = dict.fromkeys(clients, float('inf'))
+    for _ in range(ROUNDS):
+        for label, client in clients.items():
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.get(URL, headers=headers).close()
+            results[label] = min(results[label], (
+                time.perf_counter() - start) / requests * 1000)
+    for label, ms in results.items():
+        print(f'{label:>12}: {ms:8.3f} ms/request')
+    print(f'overhead: {results["timings on"] - results["timings off"]:.3f}'
+          f' ms/request')
+    client = clients['timings on']
+    response = client.get(URL, headers=headers)
+    print(f'Server-Timing: {response.headers["Server-Timing"]}')
+    response.close()
+    start = time.perf_counter()
+    client.get('/metrics').close()
+    print(f'GET /metrics: {(time.perf_counter() - start) * 1000:.3f} ms')
+    os.remove(path)
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,135 @@
+'''
+The default sync gunicorn workers against gthread workers and the ASGI
+mode, with the same number of processes and threads, under many concurrent
+connections: GET /movies?limit=50 alone, then mixed with long-polls of
+/changes that hold their request for a few seconds the way a slow query or
+key fetch would.
+
+    python benchmarks/load_test.py [connections] [seconds]
+'''
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import SigningKey, temp_database, seed
+
+HOST = '127.0.0.1'
+PORT = 8931
+WORKERS = 2
+THREADS = 32
+FAST_URL = '/movies?limit=50'
+SLOW_URL = '/changes?since=0&wait=2'
+# one request in this many is slow in the mixed run
+SLOW_EVERY = 20
+# command and environment of each server, see gunicorn.conf.py
+SERVERS = {
+    'sync': (['gunicorn', '-w', str(WORKERS), 'flaskr:create_app()'], {}),
+    'gthread': (['gunicorn', '-w', str(WORKERS), 'flaskr:create_app()'],
+                {'WORKER_THREADS': str(THREADS)}),
+    'asgi': (['gunicorn', '-w', str(WORKERS), '-k',
+              'uvicorn.workers.UvicornWorker',
+              'flaskr.asgi:create_asgi_app()'],
+             {'ASGI_THREADS': str(THREADS)})
+}
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def get(url, headers, timeout=30):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(HOST, PORT), timeout)
+        writer.write((
+            'GET {} HTTP/1.1\r\nHost: {}\r\n{}Connection: close\r\n\r\n'
+            .format(url, HOST, ''.join('{}: {}\r\n'.format(*header)
+                                       for header in headers.items()))
+        ).encode())
+        response = await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+        status = int(response.split(b' ', 2)[1])
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        status = None
+    return status, time.perf_counter() - start
+
+
+async def load(connections, seconds, headers, slow):
+    deadline = time.monotonic() + seconds
+    results = []
+
+    async def client(number):
+        count = number
+        while time.monotonic() < deadline:
+            count += 1
+            url = SLOW_URL if slow and count % SLOW_EVERY == 0 else FAST_URL
+            status, elapsed = await get(url, headers)
+            results.append((url, status, elapsed))
+
+    await asyncio.gather(*(client(number) for number in range(connections)))
+    return results
+
+
+def wait_ready(process):
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError('server exited')
+        status, _ = asyncio.run(get('/stats', {}, timeout=1))
+        if status == 200:
+            return
+        time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def report(label, results, seconds):
+    fast = sorted(elapsed for url, status, elapsed in results
+                  if url == FAST_URL and status == 200)
+    slow = sum(1 for url, status, _ in results
+               if url == SLOW_URL and status == 200)
+    errors = sum(1 for _, status, _ in results if status != 200)
+    if not fast:
+        print(f'{label:>16}: no successful requests, {errors} errors')
+        return
+    print(f'{label:>16}: {len(fast) / seconds:8.1f} req/s'
+          f'  p50 {fast[len(fast) // 2] * 1000:8.1f} ms'
+          f'  p99 {fast[int(len(fast) * 0.99)] * 1000:8.1f} ms'
+          f'  long-polls {slow:5}  errors {errors}')
+
+
+def main(connections, seconds):
+    key = SigningKey()
+    path = temp_database()
+    from flaskr import create_app
+    from models import db
+
+    app = create_app({'SUGGEST_INDEX': False,
+                      'CHANGE_LOG_MAINTENANCE_INTERVAL': 0})
+    with app.app_context():
+        seed(db.engine, 10000)
+    headers = {'Authorization': key.headers()['Authorization']}
+    env = dict(os.environ, METRICS_DIR=tempfile.mkdtemp(),
+               CHANGE_LOG_MAINTENANCE_INTERVAL='0', STATS='on')
+    print(f'{WORKERS} workers, {connections} connections, {seconds}s per run')
+    for name, (command, server_env) in SERVERS.items():
+        process = subprocess.Popen(
+            command + ['-b', f'{HOST}:{PORT}', '--backlog', '4096'],
+            cwd=ROOT, env=dict(env, **server_env), stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(process)
+            for slow in (False, True):
+                results = asyncio.run(
+                    load(connections, seconds, headers, slow))
+                report(f'{name} {"mixed" if slow else "fast"}', results,
+                       seconds)
+        finally:
+            process.terminate()
+            process.wait()
+    os.remove(path)
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10)
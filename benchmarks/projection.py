@@ -0,0 +1,59 @@
+'''
+Rows per second of the ORM format() read path against the column
+projection path, with and without JSON encoding.
+
+    python benchmarks/projection.py [rows]
+'''
+import os
+import sys
+import time
+
+from common import temp_database, seed
+
+
+def rate(label, rows, fn, repeat=3):
+    best = min(timed(fn) for _ in range(repeat))
+    print(f'{label:>34}: {rows / best:12,.0f} rows/s')
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main(rows):
+    path = temp_database()
+    from flask import jsonify
+    from flaskr import create_app
+    from models import db, Movies, select_rows, row_dicts
+
+    app = create_app()
+    with app.test_request_context():
+        seed(db.engine, rows)
+
+        def orm_format():
+            movies = [movie.format() for movie in Movies.query.all()]
+            db.session.remove()
+            return movies
+
+        def projection():
+            return row_dicts(Movies.FIELDS, select_rows(Movies).all())
+
+        def sparse():
+            return row_dicts(('id', 'name'),
+                             select_rows(Movies, ('id', 'name')).all())
+
+        print(f'{rows} movies')
+        rate('ORM + format()', rows, orm_format)
+        rate('column projection', rows, projection)
+        rate('column projection fields=id,name', rows, sparse)
+        rate('ORM + format() + jsonify', rows,
+             lambda: jsonify({'movies': orm_format()}).get_data())
+        rate('column projection + jsonify', rows,
+             lambda: jsonify({'movies': projection()}).get_data())
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
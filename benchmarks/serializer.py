@@ -0,0 +1,72 @@
+'''
+Response encoding time of movie listings of growing size, jsonify against
+json_response with the stdlib and the orjson serializer, checking the
+three produce the same bytes. Accented names go through the escaping
+orjson needs to match ensure_ascii.
+
+    python benchmarks/serializer.py [rows]
+'''
+import os
+import sys
+import time
+
+from common import temp_database, seed
+
+
+def best(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(largest):
+    path = temp_database()
+    from flask import jsonify
+    from flaskr import create_app
+    from flaskr.serializer import json_response, make_serializer
+    from models import db, Movies, select_rows, row_dicts
+
+    app = create_app({'SUGGEST_INDEX': False,
+                      'CHANGE_LOG_MAINTENANCE_INTERVAL': 0})
+    serializers = {name: make_serializer(app, name)
+                   for name in ('stdlib', 'orjson')}
+    with app.test_request_context():
+        seed(db.engine, largest)
+        ascii_rows = row_dicts(Movies.FIELDS, select_rows(Movies).all())
+        # names orjson leaves raw and the serializer escapes afterwards,
+        # in every row it is left to the stdlib
+        some_accented = [dict(row, name='Amélie ' + row['name'])
+                         if row['id'] % 50 == 0 else row
+                         for row in ascii_rows]
+        all_accented = [dict(row, name='Amélie ' + row['name'])
+                        for row in ascii_rows]
+
+        for label, rows in (('ASCII names', ascii_rows),
+                            ('one accented name in 50', some_accented),
+                            ('accented names', all_accented)):
+            print(f'{label}\n{"rows":>8} {"jsonify":>10} {"stdlib":>10}'
+                  f' {"orjson":>10} {"speedup":>8}')
+            size = 10
+            while size <= largest:
+                payload = {'movies': rows[:size], 'next_cursor': None,
+                           'success': True}
+                expected = jsonify(payload).get_data()
+                timings = [best(lambda: jsonify(payload).get_data())]
+                for name in ('stdlib', 'orjson'):
+                    app.extensions['json_serializer'] = serializers[name]
+                    assert json_response(payload).get_data() == expected, \
+                        name
+                    timings.append(
+                        best(lambda: json_response(payload).get_data()))
+                print(f'{size:>8}' + ''.join(
+                    f' {seconds * 1000:>8.3f}ms' for seconds in timings) +
+                    f' {timings[0] / timings[2]:>7.1f}x')
+                size *= 10
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,64 @@
+'''
+Peak worker memory of a full-table GET /movies, buffered vs streamed.
+
+Seeds a SQLite file with synthetic rows, then serves the listing once per
+mode, each in a fresh process, and reports the growth of its peak RSS.
+
+    python benchmarks/streaming_memory.py [rows]
+'''
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from common import SigningKey, temp_database, seed
+
+MODES = {
+    'all=true (buffered)': '/movies?all=true',
+    'stream=json': '/movies?stream=json',
+    'stream=ndjson': '/movies?stream=ndjson',
+}
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def serve(url):
+    key = SigningKey()
+    from flaskr import create_app
+    app = create_app()
+    headers = key.headers()
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    res = app.test_client().get(url, headers=headers, buffered=False)
+    assert res.status_code == 200, res.status_code
+    size = sum(len(chunk) for chunk in res.response)
+    elapsed = time.perf_counter() - start
+    print('%.1f %.2f %d' % (peak_rss_mb() - before, elapsed, size))
+    key.close()
+
+
+def main(rows):
+    path = temp_database()
+    from flaskr import create_app
+    from models import db
+    with create_app().app_context():
+        seed(db.engine, rows)
+    print(f'{rows} movies in {path}')
+    for label, url in MODES.items():
+        out = subprocess.run(
+            [sys.executable, __file__, '--serve', url],
+            check=True, capture_output=True, text=True).stdout.split()
+        growth, elapsed, size = out[-3:]
+        print(f'{label:>20}: peak RSS +{float(growth):8.1f} MB'
+              f'  {float(elapsed):6.2f} s  {int(size) / 2 ** 20:7.1f} MB body')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,64 @@
+'''
+Name autocomplete on a large synthetic table: the list endpoint's
+name_prefix filter against /search/suggest served from the database and
+from the in-memory prefix index, per lookup and as a full request.
+
+    python benchmarks/suggest.py [rows]
+'''
+import os
+import sys
+import time
+
+from common import SigningKey, temp_database, seed
+
+PREFIXES = ('A', 'Actor 1', 'Actor 12345', 'actor 9999')
+
+
+def timed(fn, repeat=200):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(rows):
+    key = SigningKey()
+    path = temp_database()
+    from flaskr import create_app
+    from flaskr.suggest import SuggestIndex, _search_db
+    from models import db, Actors
+
+    app = create_app({'RESPONSE_CACHE': 'none', 'SUGGEST_INDEX': False})
+    with app.app_context():
+        seed(db.engine, rows)
+    index = SuggestIndex(app)
+    start = time.perf_counter()
+    index._reload('actors')
+    print(f'{rows} actors, index built in '
+          f'{(time.perf_counter() - start) * 1000:.0f} ms')
+
+    client = app.test_client()
+    headers = key.headers()
+    for prefix in PREFIXES:
+        with app.app_context():
+            database = timed(lambda: _search_db(Actors, prefix, 10), 20)
+        memory = timed(lambda: index.search('actors', prefix, 10))
+        listing = timed(lambda: client.get(
+            '/actors?limit=10&fields=id,name&name_prefix=' + prefix,
+            headers=headers), 20)
+        app.extensions['suggest_index'] = index
+        endpoint = timed(lambda: client.get(
+            '/search/suggest?type=actors&q=' + prefix, headers=headers))
+        del app.extensions['suggest_index']
+        print(f'{prefix!r}')
+        for label, ms in (('database lookup', database),
+                          ('index lookup', memory),
+                          ('GET /actors?name_prefix', listing),
+                          ('GET /search/suggest', endpoint)):
+            print(f'  {label:>24}: {ms:8.3f} ms')
+    os.remove(path)
+    key.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,65 @@
+'''
+Latency and statement count of single-row PATCH/DELETE writes: the old
+SELECT + mutate + commit path against update_row/delete_row.
+
+    python benchmarks/write_latency.py [operations]
+'''
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+from common import temp_database, seed
+
+
+def main(operations):
+    path = temp_database()
+    from flaskr import create_app
+    from models import db, Movies, update_row, delete_row
+
+    app = create_app()
+    with app.app_context():
+        seed(db.engine, operations * 2)
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(1))
+
+        def old_update(m_id):
+            movie = Movies.query.filter(Movies.id == m_id).one_or_none()
+            movie.rdate = 'May 1, 2020'
+            movie.update()
+
+        def old_delete(m_id):
+            movie = Movies.query.filter(Movies.id == m_id).one_or_none()
+            movie.delete()
+
+        def new_update(m_id):
+            update_row(Movies, m_id, {'rdate': 'May 1, 2020'})
+
+        def new_delete(m_id):
+            delete_row(Movies, m_id)
+
+        cases = (
+            ('PATCH select + commit', old_update, range(1, operations + 1)),
+            ('PATCH update_row', new_update, range(1, operations + 1)),
+            ('DELETE select + delete', old_delete, range(1, operations + 1)),
+            ('DELETE delete_row', new_delete,
+             range(operations + 1, 2 * operations + 1)),
+        )
+        print(f'{operations} operations, '
+              f'{db.engine.dialect.name} RETURNING: '
+              f'{db.engine.dialect.implicit_returning}')
+        for label, fn, ids in cases:
+            del statements[:]
+            start = time.perf_counter()
+            for m_id in ids:
+                fn(m_id)
+            elapsed = time.perf_counter() - start
+            print(f'{label:>24}: {elapsed / operations * 1e6:8.1f} us/op'
+                  f'  {len(statements) / operations:.1f} statements/op')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -1,22 +1,142 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask import json
 from flask_migrate import Migrate
-from models import setup_db, Movies, Actors, db
-from auth import AuthError, requires_auth
+from models import setup_db, database_path, Movies, Actors, db, select_rows, \
+    row_dicts, update_row, delete_row, related_rows, missing_ids, \
+    pool_stats, VersionConflict, table_versions
+from auth import AuthError, requires_auth, check_permissions, jwks_cache, \
+    token_cache
+from .pagination import paginate, page_args, wants_all, sort_arg, order_by
+from .streaming import stream_format, stream_response, iter_rows
+from .fields import requested_fields
+from .filters import requested_filters
+from .bulk import bulk_create, bulk_modify, bulk_remove, bulk_cast, \
+    bulk_uncast
+from .includes import requested_includes, with_includes, \
+    iter_with_includes
+from .conditional import conditional
+from .cache import ResponseCache, cached, make_backend, RESPONSE_CACHE
+from .singleflight import SingleFlight, COALESCE_TIMEOUT
+from .suggest import SuggestIndex, SUGGEST_INDEX, suggest, suggest_args
+from .groupcommit import GroupCommit, GROUP_COMMIT, GROUP_COMMIT_WAIT_MS, \
+    GROUP_COMMIT_MAX_ROWS, insert
+from .concurrency import item_etag, expected_version
+from .metrics import Metrics, TimedJSONEncoder, start_timing, finish_timing, \
+    METRICS, SERVER_TIMING, METRICS_DIR, STATS
+from .changes import ChangeFeed, CHANGE_TABLES, changes_args, read_changes, \
+    wants_event_stream, change_stream, CHANGE_LOG_MAINTENANCE_INTERVAL, \
+    CHANGE_LOG_COMPACT_AFTER, CHANGE_LOG_RETENTION
+from .serializer import make_serializer, json_response, JSON_SERIALIZER, \
+    make_msgpack_serializer, msgpack_response, MsgpackRequest, MSGPACK
+from .compression import Compressor, compress_response, COMPRESSION, \
+    COMPRESSION_MIN_SIZE, GZIP_LEVEL, BROTLI_LEVEL
+from .replicas import ReplicaSet, read_replica, replica_urls, \
+    stick_to_primary, DATABASE_REPLICA_URLS, REPLICA_STICKY_SECONDS
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.config['RESPONSE_CACHE'] = RESPONSE_CACHE
+    app.config['COALESCE_TIMEOUT'] = COALESCE_TIMEOUT
+    app.config['SUGGEST_INDEX'] = SUGGEST_INDEX
+    app.config['DATABASE_URL'] = database_path
+    app.config['GROUP_COMMIT'] = GROUP_COMMIT
+    app.config['GROUP_COMMIT_WAIT_MS'] = GROUP_COMMIT_WAIT_MS
+    app.config['GROUP_COMMIT_MAX_ROWS'] = GROUP_COMMIT_MAX_ROWS
+    app.config['DATABASE_REPLICA_URLS'] = DATABASE_REPLICA_URLS
+    app.config['REPLICA_STICKY_SECONDS'] = REPLICA_STICKY_SECONDS
+    app.config['CHANGE_LOG_MAINTENANCE_INTERVAL'] = \
+        CHANGE_LOG_MAINTENANCE_INTERVAL
+    app.config['CHANGE_LOG_COMPACT_AFTER'] = CHANGE_LOG_COMPACT_AFTER
+    app.config['CHANGE_LOG_RETENTION'] = CHANGE_LOG_RETENTION
+    app.config['METRICS'] = METRICS
+    app.config['SERVER_TIMING'] = SERVER_TIMING
+    app.config['METRICS_DIR'] = METRICS_DIR
+    app.config['STATS'] = STATS
+    app.config['JSON_SERIALIZER'] = JSON_SERIALIZER
+    app.config['MSGPACK'] = MSGPACK
+    app.config['COMPRESSION'] = COMPRESSION
+    app.config['COMPRESSION_MIN_SIZE'] = COMPRESSION_MIN_SIZE
+    app.config['GZIP_LEVEL'] = GZIP_LEVEL
+    app.config['BROTLI_LEVEL'] = BROTLI_LEVEL
+    if test_config is not None:
+        app.config.update(test_config)
 
     # connect to databse and models
-    setup_db(app)
+    setup_db(app, app.config['DATABASE_URL'])
+
+    # read replicas for the read-only endpoints
+    urls = replica_urls(app.config['DATABASE_REPLICA_URLS'])
+    if urls:
+        app.extensions['replicas'] = ReplicaSet(urls)
+        app.after_request(stick_to_primary)
+        profiler = app.extensions.get('sql_profiler')
+        if profiler is not None:
+            for engine in app.extensions['replicas'].engines():
+                profiler.attach(engine)
 
     # enable flask_migrate
     migrate = Migrate(app, db)
 
+    # cache of encoded list responses
+    backend = app.config['RESPONSE_CACHE']
+    if isinstance(backend, str):
+        backend = make_backend(backend)
+    if backend is not None:
+        app.extensions['response_cache'] = ResponseCache(backend)
+
+    # share identical concurrent list reads, a timeout of 0 disables it
+    if app.config['COALESCE_TIMEOUT'] > 0:
+        app.extensions['single_flight'] = SingleFlight(
+            app.config['COALESCE_TIMEOUT'])
+
+    # concurrent single inserts share one commit
+    if app.config['GROUP_COMMIT']:
+        app.extensions['group_commit'] = GroupCommit(
+            app.config['GROUP_COMMIT_WAIT_MS'] / 1000,
+            app.config['GROUP_COMMIT_MAX_ROWS'])
+
+    # name autocomplete index, loaded in the background
+    if app.config['SUGGEST_INDEX']:
+        app.extensions['suggest_index'] = SuggestIndex(app)
+        app.extensions['suggest_index'].start()
+
+    # change feed wakeups, and compaction and retention of the change log
+    feed = app.extensions['change_feed'] = ChangeFeed(app)
+    if app.config['CHANGE_LOG_MAINTENANCE_INTERVAL'] > 0:
+        feed.start_maintenance(app.config['CHANGE_LOG_MAINTENANCE_INTERVAL'],
+                               app.config['CHANGE_LOG_COMPACT_AFTER'],
+                               app.config['CHANGE_LOG_RETENTION'])
+
+    # per phase request timings, as Server-Timing and on /metrics
+    metrics = Metrics(app.config['METRICS_DIR']) \
+        if app.config['METRICS'] else None
+    if metrics is not None or app.config['SERVER_TIMING']:
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(start_timing)
+        app.after_request(lambda response: finish_timing(
+            response, metrics, app.config['SERVER_TIMING']))
+
+    # JSON encoding of the endpoints returning lists of rows
+    app.extensions['json_serializer'] = make_serializer(
+        app, app.config['JSON_SERIALIZER'])
+
+    # MessagePack bodies for the clients that accept it, then compression.
+    # after request hooks run last registered first
+    if app.config['COMPRESSION']:
+        app.extensions['compressor'] = Compressor(
+            app.config['COMPRESSION_MIN_SIZE'], app.config['GZIP_LEVEL'],
+            app.config['BROTLI_LEVEL'])
+        app.after_request(compress_response)
+    if app.config['MSGPACK']:
+        app.extensions['msgpack_serializer'] = make_msgpack_serializer(app)
+    if app.extensions.get('msgpack_serializer') is not None:
+        app.request_class = MsgpackRequest
+        app.after_request(msgpack_response)
+
     # enable cross-origins
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
@@ -39,15 +159,15 @@ def create_app(test_config=None):
         name = body.get('name')
         rdate = body.get('rdate')
         try:
-            movie = Movies(
-                name=name,
-                rdate=rdate
-            )
-            Movies.insert(movie)
+            movie_id = insert(Movies, {
+                'name': name,
+                'rdate': rdate
+            })
         except BaseException:
             abort(404)
         return jsonify({
             'status': 'Successfully added a movie',
+            'id': movie_id,
             'success': True
         }), 201
 
@@ -60,112 +180,329 @@ def create_app(test_config=None):
         age = body.get('age')
         gender = body.get('gender')
         try:
-            actor = Actors(
-                name=name,
-                age=age,
-                gender=gender
-            )
-            Actors.insert(actor)
+            actor_id = insert(Actors, {
+                'name': name,
+                'age': age,
+                'gender': gender
+            })
         except BaseException:
             abort(404)
         return jsonify({
             'status': 'Successfully added a actor',
+            'id': actor_id,
             'success': True
         }), 201
 
+    # Bulk insert Movies
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def post_movies_bulk(payload):
+        return bulk_create(Movies)
+
+    # Bulk insert Actors
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def post_actors_bulk(payload):
+        return bulk_create(Actors)
+
+    # Bulk patch Movies
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('modify:movies')
+    def patch_movies_bulk(payload):
+        return bulk_modify(Movies)
+
+    # Bulk patch Actors
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('modify:actors')
+    def patch_actors_bulk(payload):
+        return bulk_modify(Actors)
+
+    # Bulk delete Movies
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def del_movies_bulk(payload):
+        return bulk_remove(Movies)
+
+    # Bulk delete Actors
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def del_actors_bulk(payload):
+        return bulk_remove(Actors)
+
+    # Bulk cast actors in movies
+    @app.route('/cast/bulk', methods=['POST'])
+    @requires_auth('modify:movies')
+    def post_cast_bulk(payload):
+        return bulk_cast()
+
+    # Bulk remove actors from movies
+    @app.route('/cast/bulk', methods=['DELETE'])
+    @requires_auth('modify:movies')
+    def del_cast_bulk(payload):
+        return bulk_uncast()
+
     # Get Movies Decorator
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @read_replica
+    @conditional('movies', cast=('movie_cast', 'actors'))
+    @cached
     def get_movies(payload):
+        fields = requested_fields(Movies)
+        where = requested_filters(Movies)
+        sort = sort_arg(Movies)
+        includes = requested_includes(Movies)
+        stream = stream_format()
+        if stream:
+            rows = iter_rows(Movies, fields, where, sort)
+            return stream_response(
+                'movies', iter_with_includes(Movies, includes, rows), stream)
+        if wants_all():
+            try:
+                movies = select_rows(Movies, fields).filter(
+                    *where).order_by(*order_by(Movies, sort)).all()
+                formatted_movies = with_includes(
+                    Movies, includes, row_dicts(fields, movies))
+            except BaseException:
+                abort(404)
+            return json_response({
+                'movies': formatted_movies,
+                'success': True
+            }), 200
+        limit, after = page_args()
         try:
-            movies = Movies.query.all()
-            formatted_movies = [movie.format() for movie in movies]
+            formatted_movies, next_cursor = paginate(
+                Movies, fields, limit, after, where, sort)
+            formatted_movies = with_includes(
+                Movies, includes, formatted_movies)
         except BaseException:
             abort(404)
-        return jsonify({
+        return json_response({
             'movies': formatted_movies,
+            'next_cursor': next_cursor,
             'success': True
         }), 200
 
     # Get Actors Decorator
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @read_replica
+    @conditional('actors', movies=('movie_cast', 'movies'))
+    @cached
     def get_actors(payload):  # add payload when ready
+        fields = requested_fields(Actors)
+        where = requested_filters(Actors)
+        sort = sort_arg(Actors)
+        includes = requested_includes(Actors)
+        stream = stream_format()
+        if stream:
+            rows = iter_rows(Actors, fields, where, sort)
+            return stream_response(
+                'Actors', iter_with_includes(Actors, includes, rows), stream)
+        if wants_all():
+            try:
+                actors = select_rows(Actors, fields).filter(
+                    *where).order_by(*order_by(Actors, sort)).all()
+                formatted_actors = with_includes(
+                    Actors, includes, row_dicts(fields, actors))
+            except BaseException:
+                abort(404)
+            return json_response({
+                'Actors': formatted_actors,
+                'success': True
+            }), 200
+        limit, after = page_args()
         try:
-            actors = Actors.query.all()
-            formatted_actors = [actor.format() for actor in actors]
+            formatted_actors, next_cursor = paginate(
+                Actors, fields, limit, after, where, sort)
+            formatted_actors = with_includes(
+                Actors, includes, formatted_actors)
         except BaseException:
             abort(404)
-        return jsonify({
+        return json_response({
             'Actors': formatted_actors,
+            'next_cursor': next_cursor,
+            'success': True
+        }), 200
+
+    # Get the cast of a movie
+    @app.route('/movies/<int:m_id>/cast', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_replica
+    def get_movie_cast(payload, m_id):
+        if missing_ids(Movies, [m_id]):
+            abort(404)
+        return json_response({
+            'cast': related_rows(Movies, [m_id])[m_id],
+            'success': True
+        }), 200
+
+    # Get the movies of an actor
+    @app.route('/actors/<int:a_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_replica
+    def get_actor_movies(payload, a_id):
+        if missing_ids(Actors, [a_id]):
+            abort(404)
+        return json_response({
+            'movies': related_rows(Actors, [a_id])[a_id],
+            'success': True
+        }), 200
+
+    # Name autocomplete
+    @app.route('/search/suggest', methods=['GET'])
+    @requires_auth(None)
+    @read_replica
+    def get_suggestions(payload):
+        prefix, limit, tables = suggest_args()
+        for table in tables:
+            check_permissions('get:' + table, payload)
+        return json_response(dict(suggest(prefix, limit, tables),
+                                  success=True)), 200
+
+    # Changes since a seq, as a page, a long-poll or an event stream
+    @app.route('/changes', methods=['GET'])
+    @requires_auth(None)
+    @read_replica
+    def get_changes(payload):
+        since, tables, limit, wait = changes_args()
+        for table in tables:
+            check_permissions(CHANGE_TABLES[table], payload)
+        pruned, last = table_versions('change_log_pruned', 'change_log')
+        if since is not None and since < pruned:
+            return jsonify({
+                'message': 'changes since {} were pruned, read the tables '
+                           'again and continue from last_seq'.format(since),
+                'last_seq': last,
+                'success': False
+            }), 410
+        if wants_event_stream():
+            return change_stream(last if since is None else since,
+                                 tables, limit)
+        if since is None:
+            changes = []
+        else:
+            changes, last = read_changes(since, tables, limit, wait)
+        return json_response({
+            'changes': changes,
+            'last_seq': last,
+            'more': len(changes) == limit,
             'success': True
         }), 200
 
+    # Request counts and phase latency histograms of every worker
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        if metrics is None:
+            abort(404)
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    # Cache, coalescing, pool and auth statistics
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        if not app.config['STATS']:
+            abort(404)
+        cache = app.extensions.get('response_cache')
+        flight = app.extensions.get('single_flight')
+        index = app.extensions.get('suggest_index')
+        replicas = app.extensions.get('replicas')
+        group = app.extensions.get('group_commit')
+        profiler = app.extensions.get('sql_profiler')
+        return jsonify({
+            'response_cache': cache.stats() if cache else None,
+            'single_flight': flight.stats() if flight else None,
+            'suggest_index': index.stats() if index else None,
+            'db_pool': pool_stats(db.engine),
+            'replicas': replicas.stats() if replicas else None,
+            'group_commit': group.stats() if group else None,
+            'change_feed': feed.stats(),
+            'sql_profiler': profiler.stats() if profiler else None,
+            'jwks': jwks_cache.stats(),
+            'token_cache': token_cache.stats(),
+            'success': True
+        }), 200
+
+    # Get movie, its ETag goes in If-Match of PATCH and DELETE
+    @app.route('/movies/<int:m_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_replica
+    def get_movie(payload, m_id):
+        return get_item(Movies, 'movie', m_id)
+
+    # Get actor
+    @app.route('/actors/<int:a_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_replica
+    def get_actor(payload, a_id):
+        return get_item(Actors, 'actor', a_id)
+
+    def get_item(model, key, row_id):
+        row = select_rows(model).add_columns(model.version).filter(
+            model.id == row_id).first()
+        if row is None:
+            abort(404)
+        response = json_response({
+            key: dict(zip(model.FIELDS, row)),
+            'success': True
+        })
+        response.set_etag(item_etag(row[-1]))
+        return response.make_conditional(request)
+
     # Patch movie
     @app.route('/movies/<int:m_id>', methods=['PATCH'])
     @requires_auth('modify:movies')
-    def patch_movie(m_id, payload):
-        body = request.get_json()
-        try:
-            movie = Movies.query.filter(Movies.id == m_id).one_or_none()
-            if movie is None:
-                abort(404)
-        except BaseException:
-            abort(404)
+    def patch_movie(payload, m_id):
+        body = request.get_json(silent=True) or {}
         rdate = body.get('rdate')
         if rdate is None:
             abort(400)
-        movie.rdate = rdate
-        Movies.update(movie)
-        return jsonify({
-            "status": "Movie updated",
-            "success": True
-        }), 200
+        return patch_item(Movies, m_id, {'rdate': rdate}, 'Movie updated')
 
     # Patch Actor
     @app.route('/actors/<int:a_id>', methods=['PATCH'])
     @requires_auth('modify:actors')
-    def patch_actor(a_id, payload):
-        body = request.get_json()
+    def patch_actor(payload, a_id):
+        body = request.get_json(silent=True) or {}
+        changes = {field: body[field] for field in ('age', 'gender')
+                   if body.get(field) is not None}
+        if not changes:
+            abort(400)
+        return patch_item(Actors, a_id, changes,
+                          'Actor updated successfully')
+
+    def patch_item(model, row_id, changes, status):
         try:
-            actor = Actors.query.filter(Actors.id == a_id).one_or_none()
-            if actor is None:
-                abort(404)
-        except BaseException:
+            version = update_row(model, row_id, changes, expected_version())
+        except VersionConflict:
+            abort(412)
+        if version is None:
             abort(404)
-        age = body.get('age')
-        gender = body.get('gender')
-        if age is None and gender is None:
-            abort(400)
-        actor.age = age
-        actor.gender = gender
-        Actors.update(actor)
-        return jsonify({
-            "status": "Actor updated successfully",
+        response = jsonify({
+            "status": status,
             "success": True
-        }), 200
+        })
+        response.set_etag(item_etag(version))
+        return response, 200
 
     # Delete Movie
     @app.route('/movies/<int:m_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def del_movie(payload, m_id):
-        try:
-            movie = Movies.query.filter(Movies.id == m_id).one_or_none()
-            movie.delete()
-        except BaseException:
-            abort(404)
-        return jsonify({
-            'status': 'Deleted Successful'
-        }), 200
+        return delete_item(Movies, m_id)
 
     # Delete Actor
-    @app.route('/actors/<int:m_id>', methods=['DELETE'])
+    @app.route('/actors/<int:a_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def del_actor(payload, a_id):
+        return delete_item(Actors, a_id)
+
+    def delete_item(model, row_id):
         try:
-            actor = Actors.query.filter(Actors.id == a_id).one_or_none()
-            actor.delete()
-        except BaseException:
+            deleted = delete_row(model, row_id, expected_version())
+        except VersionConflict:
+            abort(412)
+        if not deleted:
             abort(404)
         return jsonify({
             'status': 'Deleted Successful'
@@ -206,6 +543,13 @@ def create_app(test_config=None):
             'success': False
         }), 404
 
+    @app.errorhandler(412)
+    def handle_412(error):
+        return jsonify({
+            'message': 'changed since you read it, fetch it again',
+            'success': False
+        }), 412
+
     @app.errorhandler(405)
     def handle_405(error):
         return jsonify({
@@ -0,0 +1,170 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from auth import jwks_cache
+from . import create_app
+
+# threads running requests per worker. a slow query, key fetch or
+# long-poll holds one of them, not the whole worker
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+
+'''
+wsgi_environ(scope, body)
+    the WSGI environ of an ASGI http scope and its request body
+'''
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = server[0]
+    environ['SERVER_PORT'] = str(server[1] or 80)
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+'''
+AsgiApp(wsgi_app, threads, startup)
+    serves a WSGI app on an ASGI server's event loop. the loop reads
+    requests and writes responses, each request runs start to end in one
+    thread of the pool, streamed bodies are sent as they are produced and
+    stop when the client goes away. startup callables run in the pool
+    before the server accepts requests
+'''
+
+
+class AsgiApp:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, startup=()):
+        self.wsgi_app = wsgi_app
+        self.startup = startup
+        self.executor = ThreadPoolExecutor(
+            threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope: ' + scope['type'])
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+
+        async def watch():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = loop.create_task(watch())
+        try:
+            await loop.run_in_executor(
+                self.executor, self.run, loop,
+                wsgi_environ(scope, b''.join(body)), send, disconnected)
+        finally:
+            watcher.cancel()
+
+    def run(self, loop, environ, send, disconnected):
+        # flask's request context lives in this thread, the response is
+        # iterated here too
+        response = []
+
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and len(response) > 1:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [(int(status.split(' ', 1)[0]), [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers])]
+            return write
+
+        def write(data, more_body=True):
+            if len(response) == 1:
+                status, headers = response[0]
+                call({'type': 'http.response.start', 'status': status,
+                      'headers': headers})
+                response.append(True)
+            call({'type': 'http.response.body', 'body': data,
+                  'more_body': more_body})
+
+        chunks = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in chunks:
+                if disconnected.is_set():
+                    return
+                if chunk:
+                    write(chunk)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        write(b'', more_body=False)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                loop = asyncio.get_running_loop()
+                try:
+                    for task in self.startup:
+                        await loop.run_in_executor(self.executor, task)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+'''
+create_asgi_app(test_config)
+    the app of create_app() as an ASGI app, served with
+    gunicorn -k uvicorn.workers.UvicornWorker "flaskr.asgi:create_asgi_app()"
+    signing keys are fetched at startup, off the event loop. unless
+    DB_POOL_SIZE is set the pool keeps a connection per thread, so the
+    threads do not queue for DB_POOL_TIMEOUT behind a pool of 5
+'''
+
+
+def create_asgi_app(test_config=None):
+    config = dict(test_config or {})
+    threads = config.get('ASGI_THREADS', ASGI_THREADS)
+    if 'DB_POOL_SIZE' not in os.environ:
+        config.setdefault('DB_POOL_SIZE', threads)
+    app = create_app(config)
+    return AsgiApp(app, threads, startup=(jwks_cache.refresh,))
@@ -0,0 +1,225 @@
+import os
+from flask import request, abort, jsonify
+from models import bulk_insert, bulk_update, bulk_delete, Movies, Actors, \
+    missing_ids, add_cast, remove_cast
+
+# largest batch accepted by a single bulk request
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 10000))
+
+
+'''
+bulk_items()
+    JSON array body of a bulk request
+'''
+
+
+def bulk_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items or \
+            len(items) > MAX_BULK_ITEMS:
+        abort(400)
+    return items
+
+
+'''
+validate_item(model, item, partial=False)
+    errors of one record, name is required and every other field is
+    optional but must match its column type. a partial record, as sent
+    to PATCH, only has to be non-empty
+'''
+
+
+def validate_item(model, item, partial=False):
+    if not isinstance(item, dict):
+        return ['record must be an object']
+    errors = ['unknown field: ' + field
+              for field in item if field not in model.FIELDS[1:]]
+    for field in model.FIELDS[1:]:
+        value = item.get(field)
+        expected = model.__table__.c[field].type.python_type
+        if value is None:
+            continue
+        if not isinstance(value, expected) or isinstance(value, bool):
+            errors.append('{} must be {}'.format(field, expected.__name__))
+    if partial:
+        if not item:
+            errors.append('no fields to change')
+        elif 'name' in item and not (
+                isinstance(item['name'], str) and item['name'].strip()):
+            errors.append('name is required')
+    elif not isinstance(item.get('name'), str) or not item['name'].strip():
+        errors.append('name is required')
+    return errors
+
+
+'''
+bulk_create(model)
+    validates the whole batch, then writes it in chunked transactions.
+    reports one result per record in request order
+'''
+
+
+def bulk_create(model):
+    items = bulk_items()
+    errors = [validate_item(model, item) for item in items]
+    if any(errors):
+        return jsonify({
+            'results': [{
+                'index': index,
+                'success': not item_errors,
+                'errors': item_errors
+            } for index, item_errors in enumerate(errors)],
+            'created': 0,
+            'success': False
+        }), 400
+
+    rows = [{field: item.get(field) for field in model.FIELDS[1:]}
+            for item in items]
+    results = []
+    for index, (row_id, error) in enumerate(bulk_insert(model, rows)):
+        result = {'index': index, 'success': error is None, 'id': row_id}
+        if error is not None:
+            result['errors'] = [error]
+        results.append(result)
+    created = sum(result['success'] for result in results)
+    return jsonify({
+        'results': results,
+        'created': created,
+        'success': created == len(results)
+    }), 201 if created == len(results) else 207
+
+
+'''
+bulk_target(model, body)
+    id list or equality filter of a bulk PATCH / DELETE body,
+    exactly one of {"ids": [...]} or {"filter": {field: value}}
+'''
+
+
+def bulk_target(model, body):
+    ids = body.get('ids')
+    where = body.get('filter')
+    if (ids is None) == (where is None):
+        abort(400)
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or \
+                len(ids) > MAX_BULK_ITEMS or not all(
+                    isinstance(i, int) and not isinstance(i, bool)
+                    for i in ids):
+            abort(400)
+        return ids, None
+    if not isinstance(where, dict) or not where or \
+            not all(field in model.FIELDS for field in where):
+        abort(400)
+    for field, value in where.items():
+        # the filter compares by equality, null matches missing values
+        expected = model.__table__.c[field].type.python_type
+        if value is not None and (
+                not isinstance(value, expected) or isinstance(value, bool)):
+            abort(400)
+    return None, where
+
+
+'''
+bulk_modify(model) / bulk_remove(model)
+    PATCH / DELETE every row matching the body's id list or filter with
+    one set-based statement, ids are chunked
+'''
+
+
+def bulk_modify(model):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    ids, where = bulk_target(model, body)
+    changes = body.get('changes')
+    errors = validate_item(model, changes, partial=True)
+    if errors:
+        return jsonify({
+            'errors': errors,
+            'success': False
+        }), 400
+    return jsonify({
+        'updated': bulk_update(model, changes, ids=ids, where=where),
+        'success': True
+    }), 200
+
+
+def bulk_remove(model):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    ids, where = bulk_target(model, body)
+    return jsonify({
+        'deleted': bulk_delete(model, ids=ids, where=where),
+        'success': True
+    }), 200
+
+
+'''
+cast_pairs(check_ids)
+    (movie_id, actor_id) pairs of a bulk cast body, a JSON array of
+    {"movie_id": ..., "actor_id": ...}. with check_ids every id must exist.
+    returns the pairs and a 400 response listing per-record errors, or None
+'''
+
+
+def _is_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def cast_pairs(check_ids):
+    items = bulk_items()
+    errors = []
+    for item in items:
+        if not isinstance(item, dict):
+            errors.append(['record must be an object'])
+            continue
+        errors.append(['{} must be int'.format(field)
+                       for field in ('movie_id', 'actor_id')
+                       if not _is_id(item.get(field))])
+    if not any(errors) and check_ids:
+        movies = missing_ids(Movies, [item['movie_id'] for item in items])
+        actors = missing_ids(Actors, [item['actor_id'] for item in items])
+        for item, item_errors in zip(items, errors):
+            if item['movie_id'] in movies:
+                item_errors.append('unknown movie_id')
+            if item['actor_id'] in actors:
+                item_errors.append('unknown actor_id')
+    if any(errors):
+        return None, (jsonify({
+            'results': [{
+                'index': index,
+                'success': not item_errors,
+                'errors': item_errors
+            } for index, item_errors in enumerate(errors)],
+            'success': False
+        }), 400)
+    return [(item['movie_id'], item['actor_id']) for item in items], None
+
+
+'''
+bulk_cast() / bulk_uncast()
+    add / remove every pair of the body in one transaction, pairs already
+    in that state are skipped. returns the count changed
+'''
+
+
+def bulk_cast():
+    pairs, error = cast_pairs(check_ids=True)
+    if error is not None:
+        return error
+    return jsonify({
+        'assigned': add_cast(pairs),
+        'success': True
+    }), 200
+
+
+def bulk_uncast():
+    pairs, error = cast_pairs(check_ids=False)
+    if error is not None:
+        return error
+    return jsonify({
+        'removed': remove_cast(pairs),
+        'success': True
+    }), 200
@@ -0,0 +1,257 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, make_response
+import models
+
+# memory (per worker), redis (shared by every worker) or none
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+
+'''
+LRUBackend(max_bytes)
+    in-process cache, evicts least recently used entries past max_bytes
+'''
+
+
+class LRUBackend:
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tables = {}
+        self._key_tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tables):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = value
+            self.size += len(value)
+            self._key_tables[key] = tables = tuple(tables)
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                for key in list(self._tables.get(table, ())):
+                    self._discard(key)
+
+    def _discard(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+        # evicted keys leave the table index too, or it grows without bound
+        for table in self._key_tables.pop(key, ()):
+            keys = self._tables[table]
+            keys.discard(key)
+            if not keys:
+                del self._tables[table]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions
+        }
+
+
+'''
+RedisBackend(url, ttl)
+    cache shared by every gunicorn worker. keys carry the table versions,
+    so a write in any worker makes the old entries unreachable, they
+    expire after ttl seconds
+'''
+
+
+class RedisBackend:
+    def __init__(self, url=REDIS_URL, ttl=RESPONSE_CACHE_TTL, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            return self.client.get('response:' + key)
+        except Exception:
+            self.errors += 1
+            return None
+
+    def set(self, key, value, tables):
+        try:
+            self.client.set('response:' + key, value, ex=self.ttl)
+        except Exception:
+            self.errors += 1
+
+    def invalidate(self, tables):
+        pass
+
+    def stats(self):
+        return {'errors': self.errors}
+
+
+'''
+LocalSharedBackend(store)
+    stand-in for RedisBackend in tests, apps built with the same store
+    dict share entries the way workers share a redis server
+'''
+
+
+class LocalSharedBackend(RedisBackend):
+    def __init__(self, store=None, ttl=RESPONSE_CACHE_TTL):
+        super().__init__(ttl=ttl, client=_DictClient(
+            {} if store is None else store))
+
+
+class _DictClient:
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        self.store[key] = value
+
+
+def make_backend(name):
+    if name == 'memory':
+        return LRUBackend()
+    if name == 'redis':
+        return RedisBackend()
+    if name == 'none':
+        return None
+    raise ValueError('unknown RESPONSE_CACHE backend: ' + name)
+
+
+'''
+ResponseCache(backend)
+    pre-encoded list responses keyed by their ETag, which already covers
+    the table versions, page, fields and representation
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        mimetype, body = value.split(b'\n', 1)
+        return mimetype.decode(), body
+
+    def set(self, key, tables, mimetype, body):
+        self.backend.set(key, mimetype.encode() + b'\n' + body, tables)
+        with self._lock:
+            self.stores += 1
+
+    def invalidate(self, tables):
+        self.backend.invalidate(tables)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+        stats.update(self.backend.stats())
+        return stats
+
+
+def _invalidate(tables):
+    cache = current_app.extensions.get('response_cache')
+    if cache is not None:
+        cache.invalidate(tables)
+
+
+models.write_listeners.append(_invalidate)
+
+
+'''
+cached(f)
+    serves a list view from the response cache, goes inside
+    @conditional which sets the key. on a miss, identical concurrent
+    requests in the worker share one execution of the view
+'''
+
+
+def cached(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get('response_cache')
+        flight = current_app.extensions.get('single_flight')
+        key = g.get('list_etag')
+        if key is None or (cache is None and flight is None):
+            return f(*args, **kwargs)
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                return _cached_response(entry)
+
+        def render():
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return None, response
+            entry = (response.mimetype, response.get_data())
+            if cache is not None:
+                cache.set(key, g.list_tables, *entry)
+            return entry, response
+
+        if flight is None:
+            return render()[1]
+        leader_response = []
+
+        def lead():
+            entry, response = render()
+            leader_response.append(response)
+            return entry
+
+        entry = flight.do(key, lead)
+        if leader_response:
+            return leader_response[0]
+        if entry is None:
+            return f(*args, **kwargs)
+        return _cached_response(entry)
+
+    return wrapper
+
+
+def _cached_response(entry):
+    mimetype, body = entry
+    return current_app.response_class(body, mimetype=mimetype)
@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import Response, current_app, request, abort, stream_with_context
+import models
+from models import db, table_versions, changes_since, compact_changes, \
+    prune_changes, assign_seqs
+from .streaming import _encoder
+
+# entries returned when the client sends no limit, and the largest allowed
+CHANGES_LIMIT = int(os.environ.get('CHANGES_LIMIT', 500))
+MAX_CHANGES_LIMIT = int(os.environ.get('MAX_CHANGES_LIMIT', 5000))
+# longest ?wait= a long-poll may ask for, in seconds
+MAX_CHANGES_WAIT = float(os.environ.get('MAX_CHANGES_WAIT', 30))
+# seconds between checks for changes written by other workers
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 0.5))
+# seconds an event stream stays open before the client reconnects, and
+# between keepalive comments
+CHANGES_STREAM_SECONDS = float(os.environ.get('CHANGES_STREAM_SECONDS', 300))
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+# entries older than this many seconds are folded into one per row, and
+# dropped after the retention. 0 turns the background maintenance off
+CHANGE_LOG_COMPACT_AFTER = float(
+    os.environ.get('CHANGE_LOG_COMPACT_AFTER', 3600))
+CHANGE_LOG_RETENTION = float(
+    os.environ.get('CHANGE_LOG_RETENTION', 7 * 24 * 3600))
+CHANGE_LOG_MAINTENANCE_INTERVAL = float(
+    os.environ.get('CHANGE_LOG_MAINTENANCE_INTERVAL', 600))
+
+# permission needed to read the changes of each table
+CHANGE_TABLES = {
+    'movies': 'get:movies',
+    'actors': 'get:actors',
+    'movie_cast': 'get:movies'
+}
+
+
+'''
+ChangeFeed(app, poll_interval)
+    wakes up long-polls and event streams of this worker as soon as it
+    writes, changes of other workers are seen by checking the change_log
+    counter every poll_interval seconds. with a maintenance interval it
+    numbers left over entries, compacts and prunes the log in the
+    background
+'''
+
+
+class ChangeFeed:
+    def __init__(self, app, poll_interval=CHANGES_POLL_INTERVAL):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.waits = 0
+        self.wakeups = 0
+        self.compacted = 0
+        self.pruned = 0
+        self.maintenance_runs = 0
+        self._written = threading.Condition()
+
+    def notify(self):
+        with self._written:
+            self._written.notify_all()
+
+    def wait(self, since, timeout):
+        deadline = time.monotonic() + timeout
+        with self._written:
+            self.waits += 1
+        while True:
+            last, = table_versions('change_log')
+            remaining = deadline - time.monotonic()
+            if last > since or remaining <= 0:
+                return last
+            # no connection is held while waiting
+            db.session.close()
+            with self._written:
+                if self._written.wait(min(self.poll_interval, remaining)):
+                    self.wakeups += 1
+
+    def start_maintenance(self, interval, compact_after, retention):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.maintain(compact_after, retention)
+                except Exception:
+                    self.app.logger.exception('change_log maintenance')
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def maintain(self, compact_after, retention):
+        now = datetime.utcnow()
+        with self.app.app_context():
+            # entries a worker committed but died before numbering
+            assign_seqs()
+            compacted = compact_changes(now - timedelta(seconds=compact_after))
+            pruned = prune_changes(now - timedelta(seconds=retention))
+        with self._written:
+            self.compacted += compacted
+            self.pruned += pruned
+            self.maintenance_runs += 1
+
+    def stats(self):
+        with self._written:
+            return {
+                'waits': self.waits,
+                'wakeups': self.wakeups,
+                'compacted': self.compacted,
+                'pruned': self.pruned,
+                'maintenance_runs': self.maintenance_runs
+            }
+
+
+def _notify(tables):
+    feed = current_app.extensions.get('change_feed')
+    if feed is not None:
+        feed.notify()
+
+
+models.write_listeners.append(_notify)
+
+
+'''
+changes_args()
+    since, tables, limit and wait of a change feed request,
+    ?since=120&tables=movies,actors&limit=500&wait=30. since comes from the
+    Last-Event-ID header when an event stream reconnects, and is None when
+    the client only asks where the log is
+'''
+
+
+def _int_arg(value, minimum):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400)
+    if value < minimum:
+        abort(400)
+    return value
+
+
+def changes_args():
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    if since is not None:
+        since = _int_arg(since, 0)
+    tables = request.args.get('tables')
+    tables = tuple(CHANGE_TABLES) if tables is None else tuple(
+        table.strip() for table in tables.split(','))
+    if not tables or any(table not in CHANGE_TABLES for table in tables):
+        abort(400)
+    limit = min(_int_arg(request.args.get('limit', CHANGES_LIMIT), 1),
+                MAX_CHANGES_LIMIT)
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        abort(400)
+    return since, tables, limit, min(max(wait, 0), MAX_CHANGES_WAIT)
+
+
+'''
+wants_event_stream()
+    ?stream=sse or an Accept of text/event-stream
+'''
+
+
+def wants_event_stream():
+    return request.args.get('stream') == 'sse' or \
+        request.accept_mimetypes.best == 'text/event-stream'
+
+
+'''
+read_changes(since, tables, limit, wait)
+    changes after since and the seq to ask from next time. with nothing to
+    return it waits up to wait seconds for a write
+'''
+
+
+def read_changes(since, tables, limit, wait):
+    changes, last = changes_since(since, tables, limit)
+    feed = current_app.extensions.get('change_feed')
+    deadline = time.monotonic() + wait
+    while not changes and feed is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if feed.wait(last, remaining) > last:
+            changes, last = changes_since(since, tables, limit)
+    if len(changes) == limit:
+        last = changes[-1]['seq']
+    return changes, max(last, since)
+
+
+'''
+change_stream(since, tables, limit)
+    Server-Sent Events, one "change" event per entry with its seq as id so
+    the browser resumes from it. the stream ends after
+    CHANGES_STREAM_SECONDS, the client reconnects with Last-Event-ID
+'''
+
+
+def change_stream(since, tables, limit):
+    encode = _encoder()
+
+    def events():
+        position = since
+        end = time.monotonic() + CHANGES_STREAM_SECONDS
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            changes, last = read_changes(
+                position, tables, limit, min(CHANGES_KEEPALIVE, remaining))
+            if changes:
+                yield b''.join(b'id: %d\nevent: change\ndata: %s\n\n' % (
+                    change['seq'], encode(change)) for change in changes)
+            elif last > position:
+                # writes to other tables, move the resume point past them
+                yield b'id: %d\n\n' % last
+            else:
+                yield b': keepalive\n\n'
+            position = last
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,131 @@
+import gzip
+import os
+import zlib
+from flask import current_app, request, g
+from werkzeug.wsgi import ClosingIterator
+
+# gzip or brotli bodies for clients whose Accept-Encoding allows it, off
+# sends every body as is
+COMPRESSION = os.environ.get('COMPRESSION', 'on') != 'off'
+# bodies smaller than this many bytes are not worth compressing
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# zlib level 1-9 and brotli quality 0-11, higher is smaller and slower
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_LEVEL = int(os.environ.get('BROTLI_LEVEL', 4))
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/json', 'application/x-ndjson', 'application/msgpack',
+    'application/x-msgpack', 'text/plain'
+)
+
+
+'''
+Compressor(min_size, gzip_level, brotli_level)
+    compresses response bodies with the best encoding the client accepts,
+    brotli (needs the brotli package) before gzip. streamed bodies are
+    compressed chunk by chunk and flushed after each one, so rows still
+    reach the client as they are read
+'''
+
+
+class Compressor:
+    def __init__(self, min_size=COMPRESSION_MIN_SIZE, gzip_level=GZIP_LEVEL,
+                 brotli_level=BROTLI_LEVEL):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_level = brotli_level
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        self._brotli = brotli
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def negotiate(self):
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return self._brotli.compress(data, quality=self.brotli_level)
+        return gzip.compress(data, self.gzip_level)
+
+    def compress_chunks(self, chunks, encoding):
+        if encoding == 'br':
+            compressor = self._brotli.Compressor(quality=self.brotli_level)
+
+            def compress(chunk):
+                return compressor.process(chunk) + compressor.flush()
+
+            finish = compressor.finish
+        else:
+            # wbits 31 writes the gzip header and trailer
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+
+            def compress(chunk):
+                return compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+
+            finish = compressor.flush
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield compress(chunk)
+        yield finish()
+
+
+'''
+compress_response(response)
+    after request hook compressing JSON, MessagePack and text bodies.
+    compressed responses get a weak ETag, the bytes differ by encoding
+    but not the data. compressed list bodies are kept in the response
+    cache next to the plain ones, under their ETag and encoding
+'''
+
+
+def compress_response(response):
+    compressor = current_app.extensions['compressor']
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+            response.status_code < 200 or \
+            response.status_code in (204, 304) or \
+            'Content-Encoding' in response.headers or \
+            'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compressor.negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        # closing the response still ends the stream_with_context of the
+        # rows, even when no chunk was read
+        chunks = response.response
+        response.response = ClosingIterator(
+            compressor.compress_chunks(chunks, encoding),
+            getattr(chunks, 'close', None))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < compressor.min_size:
+            return response
+        response.set_data(_cached_compress(
+            compressor, response, data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _cached_compress(compressor, response, data, encoding):
+    cache = current_app.extensions.get('response_cache')
+    etag = g.get('list_etag')
+    if cache is None or etag is None or response.status_code != 200 or \
+            response.get_etag()[0] != etag:
+        return compressor.compress(data, encoding)
+    key = '{}:{}'.format(etag, encoding)
+    entry = cache.get(key)
+    if entry is not None:
+        return entry[1]
+    compressed = compressor.compress(data, encoding)
+    cache.set(key, g.list_tables, response.mimetype, compressed)
+    return compressed
@@ -0,0 +1,26 @@
+from flask import request, abort
+
+
+'''
+item_etag(version) / expected_version()
+    ETag of a single movie or actor, built from its version column, and
+    the version a write's If-Match asks for. None when the client sent no
+    If-Match or *, an ETag this API did not issue fails the precondition.
+    the weak form of the ETag, sent with compressed responses, names the
+    same version
+'''
+
+
+def item_etag(version):
+    return 'v{}'.format(version)
+
+
+def expected_version():
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    etags = list(if_match.as_set(include_weak=True))
+    if len(etags) != 1 or not etags[0].startswith('v') or \
+            not etags[0][1:].isdigit():
+        abort(412)
+    return int(etags[0][1:])
@@ -0,0 +1,54 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response, g
+from models import table_versions
+
+
+'''
+list_etag(*tables)
+    strong ETag of a list response, built from the version counters of
+    the tables it reads and the query string and Accept header that
+    shape it
+'''
+
+
+def list_etag(*tables):
+    versions = table_versions(*tables)
+    variant = hashlib.sha1(repr((
+        sorted(request.args.items(multi=True)),
+        request.headers.get('Accept'))).encode()).hexdigest()[:16]
+    return '{}-{}'.format(
+        '.'.join('{}{}'.format(table, version)
+                 for table, version in zip(tables, versions)), variant)
+
+
+'''
+conditional(*tables, **includes)
+    decorator answering If-None-Match with 304 when none of the tables
+    changed, without reading their rows. tags every response with an ETag.
+    includes name the extra tables read for each ?include= value
+'''
+
+
+def conditional(*tables, **includes):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tables_read = list(tables)
+            for name in request.args.get('include', '').split(','):
+                for table in includes.get(name.strip(), ()):
+                    if table not in tables_read:
+                        tables_read.append(table)
+            etag = list_etag(*tables_read)
+            g.list_etag = etag
+            g.list_tables = tuple(tables_read)
+            # weak comparison, compressed responses carry W/ ETags
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,19 @@
+from flask import request, abort
+
+
+'''
+requested_fields(model)
+    sparse fieldset of ?fields=id,name, every field when absent,
+    id is always included
+'''
+
+
+def requested_fields(model):
+    fields = request.args.get('fields')
+    if fields is None:
+        return model.FIELDS
+    requested = [field.strip() for field in fields.split(',')]
+    if not all(field in model.FIELDS for field in requested):
+        abort(400)
+    return ('id',) + tuple(
+        field for field in dict.fromkeys(requested) if field != 'id')
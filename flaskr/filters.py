@@ -0,0 +1,75 @@
+from datetime import date
+from flask import request, abort
+from models import Movies, Actors, prefix_clause
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def _name_prefix(model):
+    prefix = request.args.get('name_prefix')
+    if prefix is None:
+        return []
+    if not prefix:
+        abort(400)
+    return [prefix_clause(model.name, prefix)]
+
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def movie_filters():
+    where = _name_prefix(Movies)
+    released_from = _date_arg('released_from')
+    released_to = _date_arg('released_to')
+    if released_from is not None:
+        where.append(Movies.release_date >= released_from)
+    if released_to is not None:
+        where.append(Movies.release_date <= released_to)
+    return where
+
+
+def actor_filters():
+    where = _name_prefix(Actors)
+    min_age = _int_arg('min_age')
+    max_age = _int_arg('max_age')
+    gender = request.args.get('gender')
+    if min_age is not None:
+        where.append(Actors.age >= min_age)
+    if max_age is not None:
+        where.append(Actors.age <= max_age)
+    if gender is not None:
+        where.append(Actors.gender == gender)
+    return where
+
+
+FILTERS = {
+    Movies: movie_filters,
+    Actors: actor_filters
+}
+
+
+'''
+requested_filters(model)
+    WHERE clauses of the list filters in the query string
+        movies: name_prefix, released_from, released_to (ISO dates)
+        actors: name_prefix, min_age, max_age, gender
+'''
+
+
+def requested_filters(model):
+    return FILTERS[model]()
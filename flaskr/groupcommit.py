@@ -0,0 +1,106 @@
+import os
+import threading
+from flask import current_app
+from sqlalchemy import inspect
+from models import insert_rows
+from .replicas import remember_write
+
+# opt-in, on queues concurrent single inserts and commits them together
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', 'off') == 'on'
+# milliseconds the first insert of a batch waits for others to join it,
+# and the most rows one commit takes
+GROUP_COMMIT_WAIT_MS = float(os.environ.get('GROUP_COMMIT_WAIT_MS', 2))
+GROUP_COMMIT_MAX_ROWS = int(os.environ.get('GROUP_COMMIT_MAX_ROWS', 100))
+
+
+class _Batch:
+    def __init__(self):
+        self.rows = []
+        self.results = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+'''
+GroupCommit(max_wait, max_rows)
+    concurrent inserts into one table inside a worker join a batch. the
+    first one leads, it waits up to max_wait seconds or until max_rows
+    joined, writes the batch in one transaction and hands every caller its
+    own id or error once the commit landed
+'''
+
+
+class GroupCommit:
+    def __init__(self, max_wait=GROUP_COMMIT_WAIT_MS / 1000,
+                 max_rows=GROUP_COMMIT_MAX_ROWS):
+        self.max_wait = max_wait
+        self.max_rows = max_rows
+        self.batches = 0
+        self.rows = 0
+        self.largest = 0
+        self._open = {}
+        self._lock = threading.Lock()
+
+    def insert(self, model, values):
+        table = model.__tablename__
+        with self._lock:
+            batch = self._open.get(table)
+            leader = batch is None
+            if leader:
+                batch = self._open[table] = _Batch()
+            index = len(batch.rows)
+            batch.rows.append(values)
+            if len(batch.rows) >= self.max_rows:
+                del self._open[table]
+                batch.full.set()
+        if not leader:
+            batch.done.wait()
+            # the leader's commit only marked the leader's request
+            if batch.results[index][0] is not None:
+                remember_write()
+            return batch.results[index]
+        batch.full.wait(self.max_wait)
+        with self._lock:
+            if self._open.get(table) is batch:
+                del self._open[table]
+            self.batches += 1
+            self.rows += len(batch.rows)
+            self.largest = max(self.largest, len(batch.rows))
+        try:
+            batch.results = insert_rows(model, batch.rows)
+        except BaseException as error:
+            batch.results = [(None, str(error))] * len(batch.rows)
+            raise
+        finally:
+            batch.done.set()
+        return batch.results[index]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'rows': self.rows,
+                'largest_batch': self.largest,
+                'rows_per_commit': self.rows / self.batches
+                if self.batches else 0.0
+            }
+
+
+'''
+insert(model, values)
+    inserts one row and returns its id, through the app's GroupCommit
+    when it has one. raises ValueError when the row was not written
+'''
+
+
+def insert(model, values):
+    group = current_app.extensions.get('group_commit')
+    if group is None:
+        row = model(**values)
+        row.insert()
+        # the identity survives the commit, row.id would reload the row
+        return inspect(row).identity[0]
+    row_id, error = group.insert(model, values)
+    if error is not None:
+        raise ValueError(error)
+    return row_id
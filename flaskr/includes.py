@@ -0,0 +1,57 @@
+from flask import request, abort
+from models import related_rows
+from .streaming import STREAM_BATCH_SIZE
+
+
+'''
+requested_includes(model)
+    related lists to embed in each row, ?include=cast on movies and
+    ?include=movies on actors, one of model.INCLUDES
+'''
+
+
+def requested_includes(model):
+    include = request.args.get('include')
+    if include is None:
+        return ()
+    includes = tuple(dict.fromkeys(
+        name.strip() for name in include.split(',')))
+    if not all(name in model.INCLUDES for name in includes):
+        abort(400)
+    return includes
+
+
+'''
+with_includes(model, includes, rows)
+    adds each related list to a page of row dicts, with one batched query
+    per include whatever the page size
+'''
+
+
+def with_includes(model, includes, rows):
+    for include in includes:
+        related = related_rows(model, [row['id'] for row in rows])
+        for row in rows:
+            row[include] = related[row['id']]
+    return rows
+
+
+'''
+iter_with_includes(model, includes, rows)
+    with_includes over a stream of row dicts, one STREAM_BATCH_SIZE batch
+    at a time
+'''
+
+
+def iter_with_includes(model, includes, rows):
+    if not includes:
+        yield from rows
+        return
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield from with_includes(model, includes, batch)
+            batch = []
+    if batch:
+        yield from with_includes(model, includes, batch)
@@ -0,0 +1,385 @@
+import atexit
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from flask import g, request, has_app_context
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# per request phase timings, kept in histograms served on /metrics
+METRICS = os.environ.get('METRICS', 'on') != 'off'
+# Server-Timing header with the phases of each response
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'on') != 'off'
+# where every worker writes its histograms for /metrics to add up, empty
+# reports only the answering worker, and seconds between those writes
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# /stats with the cache, pool, profiler and auth counters, which needs no
+# token, so it is off unless turned on for a trusted network
+STATS = os.environ.get('STATS', 'off') == 'on'
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+# auth is requires_auth, db the SQL statements, serialize JSON encoding and
+# app everything else a request spends in the worker
+PHASES = ('auth', 'db', 'serialize', 'app')
+
+
+'''
+Timings()
+    seconds one request spent per phase, and its SQL statements
+'''
+
+
+class Timings:
+    __slots__ = ('start', 'phases', 'queries')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        total = self.elapsed()
+        phases = dict(self.phases, app=self.app_time(total))
+        parts = []
+        for phase in PHASES:
+            part = '{};dur={:.2f}'.format(phase, phases[phase] * 1000)
+            if phase == 'db':
+                part += ';desc="{} queries"'.format(self.queries)
+            parts.append(part)
+        parts.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(parts)
+
+    def app_time(self, total):
+        return max(total - sum(self.phases[phase] for phase in PHASES
+                               if phase != 'app'), 0.0)
+
+
+def current_timings():
+    return g.get('timings') if has_app_context() else None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context,
+                   executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context,
+                    executemany):
+    timings = current_timings()
+    starts = conn.info.get('query_start')
+    if timings is not None and starts:
+        timings.add('db', time.perf_counter() - starts.pop())
+        timings.queries += 1
+
+
+'''
+TimedJSONEncoder
+    the app's JSON encoder, adds the time spent encoding to the request's
+    serialize phase
+'''
+
+
+class TimedJSONEncoder(JSONEncoder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # looked up once, streaming encodes every row with one encoder
+        self._timings = current_timings()
+
+    def encode(self, o):
+        if self._timings is None:
+            return super().encode(o)
+        start = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            self._timings.add('serialize', time.perf_counter() - start)
+
+
+'''
+Metrics(directory, flush_interval)
+    request counts and phase latency histograms per endpoint. each worker
+    writes its own to a file under directory/<gunicorn master pid>, /metrics
+    adds up the files of every worker of the same master. the master folds
+    the file of a worker that exited into one for all of them, see
+    retire_worker, so the totals never go back. with no directory only
+    this worker is reported
+'''
+
+
+class Metrics:
+    def __init__(self, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._requests = {}
+        self._durations = {}
+        self._queries = {}
+        self._dirty = False
+        self._pid = None
+        self._path = None
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, method, status, timings):
+        total = timings.elapsed()
+        phases = dict(timings.phases, app=timings.app_time(total),
+                      total=total)
+        with self._lock:
+            key = (endpoint, method, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._queries[endpoint] = \
+                self._queries.get(endpoint, 0) + timings.queries
+            for phase, seconds in phases.items():
+                histogram = self._durations.get((endpoint, phase))
+                if histogram is None:
+                    histogram = self._durations[(endpoint, phase)] = \
+                        [0] * (len(BUCKETS) + 1) + [0.0]
+                for index, bound in enumerate(BUCKETS):
+                    if seconds <= bound:
+                        break
+                else:
+                    index = len(BUCKETS)
+                histogram[index] += 1
+                histogram[-1] += seconds
+            self._dirty = True
+        if self.directory and self._pid != os.getpid():
+            self._start_flushing()
+
+    def _start_flushing(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # forked workers start their own file and flush thread
+            self._pid = os.getpid()
+            group = self._group()
+            self._path = os.path.join(group, '{}-{}.json'.format(
+                self._pid, uuid.uuid4().hex[:8]))
+        os.makedirs(group, exist_ok=True)
+        _remove_dead_groups(self.directory, group)
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        threading.Thread(target=run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _group(self):
+        return os.path.join(self.directory, str(os.getppid()))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': [list(key) + [count]
+                             for key, count in self._requests.items()],
+                'durations': [list(key) + [list(histogram)]
+                              for key, histogram in self._durations.items()],
+                'queries': [[endpoint, count]
+                            for endpoint, count in self._queries.items()]
+            }
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self._pid != os.getpid():
+                return
+            self._dirty = False
+        temporary = self._path + '.tmp'
+        try:
+            with open(temporary, 'w') as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file)
+            os.replace(temporary, self._path)
+        except OSError:
+            # the directory went away, keep the counts for the next try
+            with self._lock:
+                self._dirty = True
+
+    def collect(self):
+        snapshots = [self.snapshot()]
+        if self.directory:
+            files = _read_snapshots(
+                glob.glob(os.path.join(self._group(), '*.json')), self._path)
+            # a worker file exited.json already counts, about to be removed
+            absorbed = set().union(*(snapshot.get('absorbed', ())
+                                     for snapshot in files.values()))
+            snapshots += [snapshot for path, snapshot in files.items()
+                          if os.path.basename(path) not in absorbed]
+        return _merge(snapshots)
+
+    def render(self):
+        requests, durations, queries = self.collect()
+        lines = [
+            '# HELP casting_http_requests_total Requests served.',
+            '# TYPE casting_http_requests_total counter'
+        ]
+        for (endpoint, method, status), count in sorted(requests.items()):
+            lines.append('casting_http_requests_total{{{}}} {}'.format(
+                _labels(endpoint=endpoint, method=method, status=status),
+                count))
+        lines += [
+            '# HELP casting_db_queries_total SQL statements run by requests.',
+            '# TYPE casting_db_queries_total counter'
+        ]
+        for endpoint, count in sorted(queries.items()):
+            lines.append('casting_db_queries_total{{{}}} {}'.format(
+                _labels(endpoint=endpoint), count))
+        lines += [
+            '# HELP casting_http_request_duration_seconds Seconds requests '
+            'spent per phase, total is the whole request.',
+            '# TYPE casting_http_request_duration_seconds histogram'
+        ]
+        name = 'casting_http_request_duration_seconds'
+        for (endpoint, phase), histogram in sorted(durations.items()):
+            labels = _labels(endpoint=endpoint, phase=phase)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram[-1]))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _read_snapshots(paths, skip=None):
+    snapshots = {}
+    for path in paths:
+        if path == skip:
+            continue
+        try:
+            with open(path) as snapshot_file:
+                snapshots[path] = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots):
+    requests, durations, queries = {}, {}, {}
+    for snapshot in snapshots:
+        for *key, count in snapshot['requests']:
+            requests[tuple(key)] = requests.get(tuple(key), 0) + count
+        for endpoint, phase, histogram in snapshot['durations']:
+            total = durations.setdefault(
+                (endpoint, phase), [0] * len(histogram))
+            for index, value in enumerate(histogram):
+                total[index] += value
+        for endpoint, count in snapshot['queries']:
+            queries[endpoint] = queries.get(endpoint, 0) + count
+    return requests, durations, queries
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _remove_dead_groups(directory, keep=None):
+    # files left by the workers of a gunicorn master that is gone
+    for group in glob.glob(os.path.join(directory, '*')):
+        name = os.path.basename(group)
+        if group != keep and name.isdigit() and not _alive(int(name)):
+            shutil.rmtree(group, ignore_errors=True)
+
+
+'''
+clear_metrics_dir(directory) / retire_worker(directory, master_pid, worker_pid)
+    gunicorn master hooks, see gunicorn.conf.py. the first removes what
+    masters that are gone left in directory, before any worker starts. the
+    second adds the file of a worker that exited to exited.json of its
+    master and removes it, so there is one file per live worker and the
+    totals keep the requests of the ones that exited
+'''
+
+EXITED_FILE = 'exited.json'
+
+
+def clear_metrics_dir(directory):
+    if directory:
+        _remove_dead_groups(directory)
+
+
+def retire_worker(directory, master_pid, worker_pid):
+    if not directory:
+        return
+    group = os.path.join(directory, str(master_pid))
+    paths = glob.glob(os.path.join(group, '{}-*.json'.format(worker_pid)))
+    if not paths:
+        return
+    exited = os.path.join(group, EXITED_FILE)
+    snapshots = _read_snapshots(paths + [exited])
+    requests, durations, queries = _merge(snapshots.values())
+    temporary = exited + '.tmp'
+    try:
+        with open(temporary, 'w') as snapshot_file:
+            json.dump({
+                'requests': [list(key) + [count]
+                             for key, count in requests.items()],
+                'durations': [list(key) + [histogram]
+                              for key, histogram in durations.items()],
+                'queries': [[endpoint, count]
+                            for endpoint, count in queries.items()],
+                'absorbed': [os.path.basename(path) for path in paths]
+            }, snapshot_file)
+        os.replace(temporary, exited)
+    except OSError:
+        # the worker's file stays and is still counted
+        return
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+'''
+start_timing() / finish_timing(response)
+    before and after request hooks, the second adds the Server-Timing
+    header and records the request once its body was sent, streamed ones
+    included
+'''
+
+
+def start_timing():
+    g.timings = Timings()
+
+
+def finish_timing(response, metrics, server_timing):
+    timings = g.get('timings')
+    if timings is None:
+        return response
+    if server_timing:
+        response.headers['Server-Timing'] = timings.header()
+    if metrics is not None:
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        response.call_on_close(lambda: metrics.observe(
+            endpoint, method, response.status_code, timings))
+    return response
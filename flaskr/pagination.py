@@ -0,0 +1,139 @@
+import base64
+import json
+import os
+from datetime import date
+from flask import request, abort
+from sqlalchemy import and_, or_
+from models import select_rows, row_dicts
+
+# page size used when the client sends no limit, and the server-enforced max
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+
+'''
+encode_cursor(last_id, **sort_values) / decode_cursor(cursor)
+    opaque cursor pointing just past the last row of a page, holds the id
+    and, when sorting by another column, that column's value
+'''
+
+
+def encode_cursor(last_id, **sort_values):
+    raw = json.dumps(dict(sort_values, id=last_id),
+                     separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+        last_id = values['id']
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+    if not isinstance(last_id, int):
+        abort(400)
+    return values
+
+
+'''
+wants_all()
+    explicit opt-in to the unpaginated listing, ?all=true
+'''
+
+
+def wants_all():
+    return request.args.get('all', '').lower() in ('1', 'true', 'yes')
+
+
+'''
+sort_arg(model)
+    column the list is ordered by, ?sort=release_date, one of model.SORTS
+'''
+
+
+def sort_arg(model):
+    sort = request.args.get('sort', 'id')
+    if sort not in model.SORTS:
+        abort(400)
+    return sort
+
+
+'''
+order_by(model, sort)
+    ORDER BY clauses of a sort, ties and rows without a value (last) are
+    ordered by id
+'''
+
+
+def order_by(model, sort):
+    if sort == 'id':
+        return (model.id,)
+    return (getattr(model, sort).nullslast(), model.id)
+
+
+'''
+page_args()
+    limit and after cursor of the requested page
+'''
+
+
+def page_args():
+    limit = request.args.get('limit', PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+
+def _after_clause(model, sort, after):
+    if sort == 'id':
+        return model.id > after['id']
+    if sort not in after:
+        abort(400)
+    column = getattr(model, sort)
+    value = after[sort]
+    if value is None:
+        return and_(column.is_(None), model.id > after['id'])
+    try:
+        value = date.fromisoformat(value)
+    except (TypeError, ValueError):
+        abort(400)
+    return or_(column > value,
+               and_(column == value, model.id > after['id']),
+               column.is_(None))
+
+
+'''
+paginate(model, fields, limit, after, where, sort)
+    keyset page of model rows matching the where clauses, ordered by sort
+    then id, as dicts of fields, and the cursor of the next page. fields
+    must start with id
+'''
+
+
+def paginate(model, fields, limit, after=None, where=(), sort='id'):
+    query = select_rows(model, fields).filter(*where)
+    if sort != 'id':
+        query = query.add_columns(getattr(model, sort))
+    if after is not None:
+        query = query.filter(_after_clause(model, sort, after))
+    rows = query.order_by(*order_by(model, sort)).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if sort == 'id':
+            next_cursor = encode_cursor(last[0])
+        else:
+            value = last[-1]
+            next_cursor = encode_cursor(last[0], **{
+                sort: value.isoformat() if value is not None else None})
+    return row_dicts(fields, rows), next_cursor
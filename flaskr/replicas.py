@@ -0,0 +1,192 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, request, g
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError, OperationalError
+import models
+from models import engine_options, pool_stats
+
+# comma separated replica URLs, empty sends every query to DATABASE_URL
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '')
+# seconds a client reads from the primary after it wrote
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# seconds between health checks of a replica in use, and before one that
+# failed is tried again
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+
+STICKY_COOKIE = 'db_primary_until'
+
+
+class _Replica:
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url, **engine_options(url))
+        self.reads = 0
+        self.failures = 0
+        self.checked = 0.0
+        self.down_until = 0.0
+
+
+'''
+ReplicaSet(urls, check_interval, retry_interval)
+    read replicas used round robin. one in use is checked with SELECT 1
+    every check_interval seconds, one that fails a check or a query is
+    skipped for retry_interval seconds
+'''
+
+
+class ReplicaSet:
+    def __init__(self, urls, check_interval=REPLICA_CHECK_INTERVAL,
+                 retry_interval=REPLICA_RETRY_INTERVAL):
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.primary_reads = 0
+        self._replicas = [_Replica(url) for url in urls]
+        self._next = itertools.cycle(self._replicas)
+        self._lock = threading.Lock()
+        for replica in self._replicas:
+            event.listen(replica.engine, 'handle_error',
+                         self._on_error(replica))
+
+    def _on_error(self, replica):
+        def handle_error(context):
+            if context.is_disconnect or isinstance(
+                    context.sqlalchemy_exception, OperationalError):
+                self.mark_down(replica)
+        return handle_error
+
+    def mark_down(self, replica):
+        now = time.monotonic()
+        with self._lock:
+            if replica.down_until <= now:
+                replica.failures += 1
+            replica.down_until = now + self.retry_interval
+
+    def _healthy(self, replica):
+        now = time.monotonic()
+        with self._lock:
+            if replica.down_until > now:
+                return False
+            if now - replica.checked < self.check_interval:
+                return True
+            replica.checked = now
+        try:
+            with replica.engine.connect() as connection:
+                connection.scalar('SELECT 1')
+        except DBAPIError:
+            self.mark_down(replica)
+            return False
+        return True
+
+    def choose(self):
+        for _ in range(len(self._replicas)):
+            with self._lock:
+                replica = next(self._next)
+            if self._healthy(replica):
+                with self._lock:
+                    replica.reads += 1
+                return replica.engine
+        with self._lock:
+            self.primary_reads += 1
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            replicas = [{
+                'url': repr(make_url(replica.url)),
+                'healthy': replica.down_until <= now,
+                'reads': replica.reads,
+                'failures': replica.failures,
+                'pool': pool_stats(replica.engine)
+            } for replica in self._replicas]
+            return {
+                'replicas': replicas,
+                'primary_reads': self.primary_reads
+            }
+
+    def engines(self):
+        return [replica.engine for replica in self._replicas]
+
+    def dispose(self):
+        for replica in self._replicas:
+            replica.engine.dispose()
+
+
+'''
+replica_urls(urls)
+    list of replica URLs from a comma separated string or a list
+'''
+
+
+def replica_urls(urls):
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return [url.strip() for url in urls if url.strip()]
+
+
+'''
+read_replica(f)
+    decorator for read-only views, their queries go to a healthy replica
+    unless the client wrote less than REPLICA_STICKY_SECONDS ago. the
+    primary answers when no replica is healthy
+'''
+
+
+def read_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is not None and not _sticky():
+            g.db_read_bind = replicas.choose()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def _sticky():
+    try:
+        until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+'''
+remember_write()
+    marks the request as one that wrote, so stick_to_primary pins the
+    client's next reads to the primary. a write committed for the request
+    by another thread, such as a group commit leader, calls it as well
+'''
+
+
+def remember_write():
+    if current_app.extensions.get('replicas') is not None:
+        g.db_wrote = True
+
+
+def _remember_write(tables):
+    remember_write()
+
+
+models.write_listeners.append(_remember_write)
+
+
+'''
+stick_to_primary(response)
+    after a write, tells the client to read from the primary for the next
+    sticky seconds
+'''
+
+
+def stick_to_primary(response):
+    if g.get('db_wrote'):
+        seconds = current_app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, str(time.time() + seconds),
+                            max_age=max(int(seconds), 1), httponly=True)
+    return response
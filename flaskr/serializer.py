@@ -0,0 +1,254 @@
+import codecs
+import os
+import time
+from json.encoder import encode_basestring_ascii
+from flask import Request, current_app, request, json
+from .metrics import current_timings
+
+# orjson (needs the orjson package, stdlib without it) or stdlib
+JSON_SERIALIZER = os.environ.get('JSON_SERIALIZER', 'orjson')
+# MessagePack bodies for clients that send or accept them, needs the msgpack
+# package, off or without it every body is JSON
+MSGPACK = os.environ.get('MSGPACK', 'on') != 'off'
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def _escape(error):
+    # every run of non-ASCII characters the way ensure_ascii writes it
+    run = error.object[error.start:error.end]
+    return encode_basestring_ascii(run)[1:-1], error.end
+
+
+codecs.register_error('json_ascii', _escape)
+
+
+'''
+StdlibSerializer(app)
+    jsonify's encoding as bytes: the app's JSON encoder, sort_keys and
+    ensure_ascii from its config. encoder() is the compact encoding built
+    once for every row of a stream, dumps() indents like jsonify when the
+    app pretty prints
+'''
+
+
+class StdlibSerializer:
+    name = 'stdlib'
+
+    def __init__(self, app):
+        self.app = app
+
+    def encoder(self):
+        encode = self.app.json_encoder(
+            sort_keys=self.app.config['JSON_SORT_KEYS'],
+            ensure_ascii=self.app.config['JSON_AS_ASCII'],
+            separators=(',', ':')).encode
+        return lambda obj: encode(obj).encode()
+
+    def dumps(self, obj):
+        if self.app.config['JSONIFY_PRETTYPRINT_REGULAR'] or self.app.debug:
+            return json.dumps(obj, app=self.app, indent=2,
+                              separators=(', ', ': ')).encode()
+        return self.encoder()(obj)
+
+
+'''
+OrjsonSerializer(app)
+    the same bytes as StdlibSerializer, several times faster on large
+    lists. non-ASCII output is escaped the way ensure_ascii does, dates go
+    through the app's encoder. anything orjson refuses (integers over 64
+    bits, non-string keys) falls back to the stdlib, so do pretty printing
+    and text mostly made of non-ASCII characters. floats in exponent
+    notation and NaN print differently, so it is meant for payloads of
+    column values, not /stats
+'''
+
+
+class OrjsonSerializer(StdlibSerializer):
+    name = 'orjson'
+
+    def __init__(self, app):
+        super().__init__(app)
+        import orjson
+        self._orjson = orjson
+
+    def encoder(self):
+        orjson = self._orjson
+        fallback = super().encoder()
+        default = self.app.json_encoder().default
+        option = orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        ascii_only = self.app.config['JSON_AS_ASCII']
+        timings = current_timings()
+
+        def encode(obj):
+            start = time.perf_counter()
+            try:
+                data = orjson.dumps(obj, default=default, option=option)
+            except orjson.JSONEncodeError:
+                data = None
+            else:
+                if ascii_only:
+                    data = _ascii(data)
+            finally:
+                if timings is not None:
+                    timings.add('serialize', time.perf_counter() - start)
+            # the stdlib encoder times itself
+            return fallback(obj) if data is None else data
+
+        return encode
+
+
+def _ascii(data):
+    if not data.isascii():
+        text = data.decode()
+        # escaping characters by the run costs more than the stdlib once
+        # more than one in 64 takes several bytes
+        if len(data) - len(text) > len(text) >> 6:
+            return None
+        data = text.encode('ascii', 'json_ascii')
+    # DEL is ASCII but ensure_ascii escapes it, only strings can hold it
+    if b'\x7f' in data:
+        data = data.replace(b'\x7f', b'\\u007f')
+    return data
+
+
+'''
+make_serializer(app, name)
+    the serializer named by JSON_SERIALIZER, the stdlib one when orjson is
+    not installed
+'''
+
+
+def make_serializer(app, name=JSON_SERIALIZER):
+    if name == 'orjson':
+        try:
+            return OrjsonSerializer(app)
+        except ImportError:
+            app.logger.warning('orjson is not installed, using stdlib json')
+            return StdlibSerializer(app)
+    if name == 'stdlib':
+        return StdlibSerializer(app)
+    raise ValueError('unknown JSON_SERIALIZER: ' + name)
+
+
+'''
+MsgpackSerializer(app)
+    MessagePack of the same values, dates written as the app's JSON
+    encoder writes them
+'''
+
+
+class MsgpackSerializer:
+    name = 'msgpack'
+
+    def __init__(self, app):
+        self.app = app
+        import msgpack
+        self._msgpack = msgpack
+
+    def encoder(self):
+        packb = self._msgpack.packb
+        default = self.app.json_encoder().default
+        timings = current_timings()
+
+        def encode(obj):
+            start = time.perf_counter()
+            try:
+                return packb(obj, default=default)
+            finally:
+                if timings is not None:
+                    timings.add('serialize', time.perf_counter() - start)
+
+        return encode
+
+    def dumps(self, obj):
+        return self.encoder()(obj)
+
+    def loads(self, data):
+        return self._msgpack.unpackb(data)
+
+
+def make_msgpack_serializer(app):
+    try:
+        return MsgpackSerializer(app)
+    except ImportError:
+        app.logger.warning('msgpack is not installed, serving JSON only')
+        return None
+
+
+'''
+msgpack_mimetype()
+    the MessagePack type the client's Accept prefers over JSON, None when
+    it gets JSON
+'''
+
+
+def msgpack_mimetype():
+    if current_app.extensions.get('msgpack_serializer') is None:
+        return None
+    best = request.accept_mimetypes.best_match(
+        ('application/json',) + MSGPACK_MIMETYPES)
+    return best if best in MSGPACK_MIMETYPES else None
+
+
+'''
+MsgpackRequest
+    request class whose get_json() also reads MessagePack bodies, sent
+    with a Content-Type of application/msgpack
+'''
+
+
+class MsgpackRequest(Request):
+    def get_json(self, force=False, silent=False, cache=True):
+        serializer = current_app.extensions.get('msgpack_serializer')
+        if serializer is None or self.mimetype not in MSGPACK_MIMETYPES:
+            return super().get_json(force, silent, cache)
+        try:
+            return serializer.loads(self.get_data(cache=cache))
+        except ValueError as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+
+
+'''
+json_response(data)
+    jsonify(data) through the app's serializer, or MessagePack when the
+    client asks for it, for the endpoints that return lists of rows
+'''
+
+
+def json_response(data):
+    app = current_app._get_current_object()
+    mimetype = msgpack_mimetype()
+    if mimetype is not None:
+        body = app.extensions['msgpack_serializer'].dumps(data)
+    else:
+        mimetype = app.config['JSONIFY_MIMETYPE']
+        body = app.extensions['json_serializer'].dumps(data) + b'\n'
+    return app.response_class(body, mimetype=mimetype)
+
+
+'''
+msgpack_response(response)
+    after request hook turning the JSON body of any other endpoint into
+    MessagePack for the clients that prefer it. streams stay JSON
+'''
+
+
+def msgpack_response(response):
+    if response.is_streamed or response.mimetype not in \
+            ('application/json',) + MSGPACK_MIMETYPES:
+        return response
+    response.vary.add('Accept')
+    mimetype = msgpack_mimetype()
+    if mimetype is None or response.mimetype != 'application/json' or \
+            response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    serializer = current_app.extensions['msgpack_serializer']
+    response.set_data(serializer.dumps(json.loads(response.get_data())))
+    response.mimetype = mimetype
+    return response
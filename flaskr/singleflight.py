@@ -0,0 +1,68 @@
+import os
+import threading
+
+# seconds a request waits for an identical in-flight read before running
+# its own
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 5))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+'''
+SingleFlight(timeout)
+    concurrent calls of do() with the same key inside one worker share a
+    single execution of fn, callers that give up after timeout seconds or
+    whose leader failed run fn themselves
+'''
+
+
+class SingleFlight:
+    def __init__(self, timeout=COALESCE_TIMEOUT):
+        self.timeout = timeout
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            return fn()
+        if call.failed:
+            return fn()
+        with self._lock:
+            self.coalesced += 1
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._calls)
+            }
@@ -0,0 +1,90 @@
+import os
+from flask import Response, request, stream_with_context, abort, current_app
+from models import select_rows
+from .pagination import order_by
+
+# rows fetched from the server-side cursor per round trip
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+
+STREAM_FORMATS = ('ndjson', 'json')
+
+
+'''
+stream_format()
+    requested streaming mode, ?stream=ndjson or ?stream=json, or None
+'''
+
+
+def stream_format():
+    stream = request.args.get('stream')
+    if stream is None:
+        if request.accept_mimetypes.best == 'application/x-ndjson':
+            return 'ndjson'
+        return None
+    if stream not in STREAM_FORMATS:
+        abort(400)
+    return stream
+
+
+def _encoder():
+    # built once per response, flask.json.dumps re-reads app config per call
+    return current_app.extensions['json_serializer'].encoder()
+
+
+'''
+iter_rows(model, fields, where, sort)
+    every row of a table matching the where clauses as a dict of fields,
+    read through a server-side cursor in batches so only one batch is held
+    in memory at a time
+'''
+
+
+def iter_rows(model, fields, where=(), sort='id'):
+    query = select_rows(model, fields).filter(*where).order_by(
+        *order_by(model, sort)).execution_options(
+        stream_results=True).yield_per(STREAM_BATCH_SIZE)
+    for row in query:
+        yield dict(zip(fields, row))
+
+
+def _batched(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= STREAM_BATCH_SIZE:
+            yield b''.join(batch)
+            batch = []
+    if batch:
+        yield b''.join(batch)
+
+
+def _ndjson(rows, encode):
+    for row in rows:
+        yield encode(row) + b'\n'
+
+
+def _json_array(key, rows, encode):
+    yield b'{"%s":[' % key.encode()
+    separator = b''
+    for row in rows:
+        yield separator + encode(row)
+        separator = b','
+    yield b'],"success":true}\n'
+
+
+'''
+stream_response(key, rows, stream)
+    chunked response writing rows as they are read, either one JSON document
+    per line or the regular {key: [...], "success": true} document
+'''
+
+
+def stream_response(key, rows, stream):
+    encode = _encoder()
+    if stream == 'ndjson':
+        body = _batched(_ndjson(rows, encode))
+        mimetype = 'application/x-ndjson'
+    else:
+        body = _batched(_json_array(key, rows, encode))
+        mimetype = 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype)
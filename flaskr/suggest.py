@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from flask import current_app, request, abort
+from sqlalchemy import func
+import models
+from models import db, Movies, Actors, table_versions
+
+# in-memory name index, off serves every lookup from the database
+SUGGEST_INDEX = os.environ.get('SUGGEST_INDEX', 'on') != 'off'
+# matches returned when the client sends no limit, and the largest allowed
+SUGGEST_LIMIT = int(os.environ.get('SUGGEST_LIMIT', 10))
+MAX_SUGGEST_LIMIT = int(os.environ.get('MAX_SUGGEST_LIMIT', 50))
+# seconds between checks for writes made by other workers
+SUGGEST_REFRESH_INTERVAL = float(
+    os.environ.get('SUGGEST_REFRESH_INTERVAL', 5))
+
+SUGGEST_MODELS = {'movies': Movies, 'actors': Actors}
+
+
+'''
+PrefixIndex()
+    names of one table as a sorted array of (lowercased name, id), prefix
+    lookups are a binary search followed by a scan of the matches
+'''
+
+
+class PrefixIndex:
+    def __init__(self, rows=()):
+        self._names = dict(rows)
+        self._keys = sorted(
+            (name.lower(), row_id) for row_id, name in self._names.items()
+            if name is not None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def put(self, row_id, name):
+        self.remove(row_id)
+        if name is not None:
+            self._names[row_id] = name
+            insort(self._keys, (name.lower(), row_id))
+
+    def remove(self, row_id):
+        name = self._names.pop(row_id, None)
+        if name is not None:
+            index = bisect_left(self._keys, (name.lower(), row_id))
+            del self._keys[index]
+
+    def search(self, prefix, limit):
+        prefix = prefix.lower()
+        matches = []
+        for index in range(bisect_left(self._keys, (prefix,)),
+                           len(self._keys)):
+            key, row_id = self._keys[index]
+            if not key.startswith(prefix) or len(matches) == limit:
+                break
+            matches.append({'id': row_id, 'name': self._names[row_id]})
+        return matches
+
+
+'''
+SuggestIndex(app, refresh_interval)
+    a PrefixIndex per table, loaded in the background at startup and kept
+    current by the rows this worker writes. writes from other workers show
+    up as table versions the index has not applied, which trigger a reload
+    at most every refresh_interval seconds. rows this worker writes during
+    a load are kept and replayed onto the new index before it replaces the
+    old one, so a load always finishes. while a table is not loaded
+    lookups go to the database
+'''
+
+
+class SuggestIndex:
+    def __init__(self, app, refresh_interval=SUGGEST_REFRESH_INTERVAL):
+        self.app = app
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.fallbacks = 0
+        self.reloads = 0
+        self._indexes = {}
+        self._versions = {}
+        self._loading = set()
+        self._pending = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for table in SUGGEST_MODELS:
+            self.reload_in_background(table)
+
+    def reload_in_background(self, table):
+        with self._lock:
+            if table in self._loading:
+                return
+            self._loading.add(table)
+        threading.Thread(target=self._reload, args=(table,),
+                         daemon=True).start()
+
+    def _reload(self, table):
+        model = SUGGEST_MODELS[table]
+        try:
+            with self._lock:
+                self._pending[table] = []
+            with self.app.app_context():
+                version, = table_versions(table)
+                index = PrefixIndex(db.session.query(model.id, model.name))
+            with self._lock:
+                # writes of this worker that landed during the load may be
+                # in neither the old nor the new index
+                for rows in self._pending.pop(table):
+                    if rows is None:
+                        self._checked = 0.0
+                    else:
+                        _apply(index, rows)
+                self._indexes[table] = index
+                self._versions[table] = version
+                self.reloads += 1
+        finally:
+            with self._lock:
+                self._pending.pop(table, None)
+                self._loading.discard(table)
+
+    def apply(self, table, rows):
+        with self._lock:
+            if table in self._pending:
+                self._pending[table].append(rows)
+            index = self._indexes.get(table)
+            if index is None:
+                return
+            if rows is None:
+                # unknown rows, leave the version behind so it reloads
+                self._checked = 0.0
+                return
+            _apply(index, rows)
+            self._versions[table] += 1
+
+    def _check_versions(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked < self.refresh_interval:
+                return
+            self._checked = now
+            tables = tuple(self._versions)
+            applied = tuple(self._versions[table] for table in tables)
+        if not tables:
+            return
+        for table, version, current in zip(
+                tables, applied, table_versions(*tables)):
+            if current != version:
+                self.reload_in_background(table)
+
+    def search(self, table, prefix, limit):
+        self._check_versions()
+        with self._lock:
+            index = self._indexes.get(table)
+            if index is not None:
+                self.hits += 1
+                return index.search(prefix, limit)
+            self.fallbacks += 1
+        return _search_db(SUGGEST_MODELS[table], prefix, limit)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'fallbacks': self.fallbacks,
+                'reloads': self.reloads,
+                'loading': sorted(self._loading),
+                'sizes': {table: len(index)
+                          for table, index in self._indexes.items()}
+            }
+
+
+def _apply(index, rows):
+    for row_id, values in rows.items():
+        if values is None:
+            index.remove(row_id)
+        elif 'name' in values:
+            index.put(row_id, values['name'])
+
+
+def _search_db(model, prefix, limit):
+    rows = db.session.query(model.id, model.name).filter(
+        func.lower(model.name).startswith(prefix.lower(), autoescape=True)
+    ).order_by(func.lower(model.name), model.id).limit(limit)
+    return [{'id': row_id, 'name': name} for row_id, name in rows]
+
+
+def _apply_rows(table, rows):
+    index = current_app.extensions.get('suggest_index')
+    if index is not None and table in SUGGEST_MODELS:
+        index.apply(table, rows)
+
+
+models.row_listeners.append(_apply_rows)
+
+
+'''
+suggest_args()
+    prefix, limit and tables of a suggest request,
+    ?q=kea&limit=10&type=actors, type defaults to both tables
+'''
+
+
+def suggest_args():
+    prefix = request.args.get('q', '')
+    if not prefix.strip():
+        abort(400)
+    limit = request.args.get('limit', SUGGEST_LIMIT)
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    kind = request.args.get('type')
+    if kind is None:
+        tables = tuple(SUGGEST_MODELS)
+    elif kind in SUGGEST_MODELS:
+        tables = (kind,)
+    else:
+        abort(400)
+    return prefix, min(limit, MAX_SUGGEST_LIMIT), tables
+
+
+'''
+suggest(prefix, limit, tables)
+    up to limit names of each table starting with prefix, ignoring case,
+    in name order
+'''
+
+
+def suggest(prefix, limit, tables):
+    index = current_app.extensions.get('suggest_index')
+    return {table: index.search(table, prefix, limit) if index is not None
+            else _search_db(SUGGEST_MODELS[table], prefix, limit)
+            for table in tables}
@@ -0,0 +1,43 @@
+import os
+
+# gunicorn reads this file from the working directory. workers stay sync
+# unless WORKER_THREADS is above 1, then each is a gthread worker running
+# that many requests at once, so a slow query, key fetch or long-poll
+# holds one thread instead of the whole worker
+threads = int(os.environ.get('WORKER_THREADS', 1))
+if threads > 1:
+    worker_class = 'gthread'
+    # unless set, a connection per thread, or the threads queue for the
+    # pool up to DB_POOL_TIMEOUT
+    os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+
+'''
+post_worker_init(worker)
+    fetches the signing keys before the worker takes requests, so the
+    first authenticated request does not wait for them
+'''
+
+
+def post_worker_init(worker):
+    from auth import jwks_cache
+    jwks_cache.refresh()
+
+
+'''
+on_starting(server) / child_exit(server, worker)
+    with METRICS_DIR set, clears what earlier masters left there before
+    the workers start, and folds the metrics file of a worker that exited
+    into the one of the workers gone, so the directory does not grow with
+    every worker restart
+'''
+
+
+def on_starting(server):
+    from flaskr.metrics import METRICS_DIR, clear_metrics_dir
+    clear_metrics_dir(METRICS_DIR)
+
+
+def child_exit(server, worker):
+    from flaskr.metrics import METRICS_DIR, retire_worker
+    retire_worker(METRICS_DIR, server.pid, worker.pid)
@@ -0,0 +1,42 @@
+"""add table_versions
+
+Revision ID: 3f1c2a7d9b40
+Revises: eb71712fe7c9
+Create Date: 2026-10-18 13:05:41.218307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b40'
+down_revision = 'eb71712fe7c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if 'table_versions' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'table_versions',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('name')
+        )
+    table_versions = sa.table(
+        'table_versions',
+        sa.column('name', sa.String),
+        sa.column('version', sa.Integer)
+    )
+    seeded = {name for name, in bind.execute(
+        sa.select([table_versions.c.name]).where(
+            table_versions.c.name.in_(('movies', 'actors'))))}
+    op.bulk_insert(table_versions, [{'name': name, 'version': 0}
+                                    for name in ('movies', 'actors')
+                                    if name not in seeded])
+
+
+def downgrade():
+    op.drop_table('table_versions')
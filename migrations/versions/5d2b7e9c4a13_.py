@@ -0,0 +1,98 @@
+"""add typed movies.release_date and backfill it from rdate
+
+Revision ID: 5d2b7e9c4a13
+Revises: 8c4e1f0a2b6d
+Create Date: 2026-10-18 15:02:37.118204
+
+The backfill commits every BACKFILL_BATCH rows, so it holds no long lock on
+movies and an interrupted run picks up where it stopped when re-run. The
+index is built after it, concurrently on PostgreSQL, instead of being
+updated row by row during the backfill.
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b7e9c4a13'
+down_revision = '8c4e1f0a2b6d'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH = 1000
+
+# copy of models.RELEASE_DATE_FORMATS at the time of this revision
+FORMATS = (
+    '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y',
+    '%d %B %Y', '%d %b %Y', '%Y-%m-%d', '%m/%d/%Y'
+)
+
+movies = sa.table(
+    'movies',
+    sa.column('id', sa.Integer),
+    sa.column('rdate', sa.String),
+    sa.column('release_date', sa.Date)
+)
+
+
+def parse(rdate):
+    rdate = ' '.join(rdate.split())
+    for date_format in FORMATS:
+        try:
+            return datetime.strptime(rdate, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+
+def backfill(bind):
+    update = movies.update().where(
+        movies.c.id == sa.bindparam('b_id')).values(
+        release_date=sa.bindparam('b_date'))
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select([movies.c.id, movies.c.rdate]).where(sa.and_(
+                movies.c.id > last_id,
+                movies.c.release_date.is_(None),
+                movies.c.rdate.isnot(None)
+            )).order_by(movies.c.id).limit(BACKFILL_BATCH)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        values = [{'b_id': row_id, 'b_date': parse(rdate)}
+                  for row_id, rdate in rows]
+        values = [value for value in values if value['b_date'] is not None]
+        if values:
+            bind.execute(update, values)
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'release_date' not in [column['name'] for column in
+                              inspector.get_columns('movies')]:
+        op.add_column('movies', sa.Column('release_date', sa.Date()))
+    indexed = 'ix_movies_release_date' in [index['name'] for index in
+                                           inspector.get_indexes('movies')]
+    if bind.dialect.name == 'sqlite':
+        # no AUTOCOMMIT isolation level, backfill in the migration transaction
+        backfill(bind)
+        if not indexed:
+            op.create_index('ix_movies_release_date', 'movies',
+                            ['release_date', 'id'])
+        return
+    with op.get_context().autocommit_block():
+        backfill(op.get_bind())
+        # built once the rows are filled in, without blocking writes
+        if not indexed:
+            op.create_index('ix_movies_release_date', 'movies',
+                            ['release_date', 'id'],
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_column('movies', 'release_date')
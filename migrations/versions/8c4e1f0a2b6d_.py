@@ -0,0 +1,40 @@
+"""add search indexes on movies and actors
+
+Revision ID: 8c4e1f0a2b6d
+Revises: 3f1c2a7d9b40
+Create Date: 2026-10-18 13:41:09.552871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e1f0a2b6d'
+down_revision = '3f1c2a7d9b40'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = (
+    ('ix_movies_name', 'movies', ['name']),
+    ('ix_actors_name', 'actors', ['name']),
+    ('ix_actors_age', 'actors', ['age']),
+    ('ix_actors_gender_age', 'actors', ['gender', 'age'])
+)
+
+
+def upgrade():
+    # setup_db() may have created them already, on app start
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        if name not in [index['name'] for index in
+                        inspector.get_indexes(table)]:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
+    op.drop_index('ix_actors_name', table_name='actors')
+    op.drop_index('ix_movies_name', table_name='movies')
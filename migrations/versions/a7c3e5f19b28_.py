@@ -0,0 +1,52 @@
+"""add movie_cast association between movies and actors
+
+Revision ID: a7c3e5f19b28
+Revises: 5d2b7e9c4a13
+Create Date: 2026-10-18 16:20:44.730518
+
+setup_db() runs create_all() and seeds table_versions on app start, so the
+table and its version row may already be there.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e5f19b28'
+down_revision = '5d2b7e9c4a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if 'movie_cast' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'movie_cast',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                    ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+        op.create_index('ix_movie_cast_actor_id', 'movie_cast',
+                        ['actor_id', 'movie_id'])
+    table_versions = sa.table(
+        'table_versions',
+        sa.column('name', sa.String),
+        sa.column('version', sa.Integer)
+    )
+    seeded = bind.execute(sa.select([table_versions.c.name]).where(
+        table_versions.c.name == 'movie_cast')).first()
+    if seeded is None:
+        op.bulk_insert(table_versions,
+                       [{'name': 'movie_cast', 'version': 0}])
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions WHERE name = 'movie_cast'")
+    op.drop_index('ix_movie_cast_actor_id', table_name='movie_cast')
+    op.drop_table('movie_cast')
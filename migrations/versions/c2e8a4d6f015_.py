@@ -0,0 +1,39 @@
+"""add version column to movies and actors for optimistic concurrency
+
+Revision ID: c2e8a4d6f015
+Revises: a7c3e5f19b28
+Create Date: 2026-10-18 18:02:13.418207
+
+existing rows start at version 1, the server default. setup_db() runs
+create_all() on app start, which does not add columns to existing tables,
+but a fresh database already has them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2e8a4d6f015'
+down_revision = 'a7c3e5f19b28'
+branch_labels = None
+depends_on = None
+
+TABLES = ('movies', 'actors')
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in TABLES:
+        columns = [column['name'] for column in inspector.get_columns(table)]
+        if 'version' not in columns:
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.add_column(sa.Column(
+                    'version', sa.Integer(), nullable=False,
+                    server_default='1'))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
@@ -0,0 +1,61 @@
+"""add change_log for the incremental change feed
+
+Revision ID: e41b9d7c2a58
+Revises: c2e8a4d6f015
+Create Date: 2026-10-18 19:11:52.604331
+
+setup_db() runs create_all() and seeds table_versions on app start, so the
+table and its counter rows may already be there. the log starts empty,
+clients read the tables once and follow the feed from there. entries are
+written without a seq and numbered after their transaction commits.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b9d7c2a58'
+down_revision = 'c2e8a4d6f015'
+branch_labels = None
+depends_on = None
+
+COUNTERS = ('change_log', 'change_log_compacted', 'change_log_pruned')
+
+
+def upgrade():
+    bind = op.get_bind()
+    if 'change_log' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'change_log',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('seq', sa.Integer(), nullable=True),
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('row_id', sa.Integer(), nullable=True),
+            sa.Column('op', sa.String(), nullable=False),
+            sa.Column('data', sa.Text(), nullable=True),
+            sa.Column('created', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_change_log_seq', 'change_log', ['seq'],
+                        unique=True)
+        op.create_index('ix_change_log_created', 'change_log', ['created'])
+    table_versions = sa.table(
+        'table_versions',
+        sa.column('name', sa.String),
+        sa.column('version', sa.Integer)
+    )
+    seeded = {name for name, in bind.execute(
+        sa.select([table_versions.c.name]).where(
+            table_versions.c.name.in_(COUNTERS)))}
+    op.bulk_insert(table_versions, [{'name': name, 'version': 0}
+                                    for name in COUNTERS
+                                    if name not in seeded])
+
+
+def downgrade():
+    op.execute("DELETE FROM table_versions WHERE name IN "
+               "('change_log', 'change_log_compacted', 'change_log_pruned')")
+    op.drop_index('ix_change_log_created', table_name='change_log')
+    op.drop_index('ix_change_log_seq', table_name='change_log')
+    op.drop_table('change_log')
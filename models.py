@@ -1,11 +1,333 @@
+import io
+import json
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, Date, DateTime, Text, \
+    Index, ForeignKey, create_engine, func, select, and_, bindparam, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError, DisconnectionError, \
+    TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import validates, sessionmaker
+from flask import g, request, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
 # Get DB PATH from ENV
 database_path = os.environ['DATABASE_URL']
 
-db = SQLAlchemy()
+# ids per IN list when loading the other side of movie_cast
+RELATED_BATCH_SIZE = int(os.environ.get('RELATED_BATCH_SIZE', 500))
+
+# rows written per transaction by the bulk write paths
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+# connection pool, also settable per app through app.config
+POOL_SETTINGS = {
+    # connections kept open, and extra ones opened under load
+    'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    # seconds a request waits for a free connection
+    'DB_POOL_TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    # seconds before a connection is replaced, below server/proxy timeouts
+    'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    # test connections on checkout, so a dropped one is replaced
+    'DB_POOL_PRE_PING': os.environ.get('DB_POOL_PRE_PING', 'on') != 'off',
+    # milliseconds before PostgreSQL cancels a statement, 0 is no limit
+    'DB_STATEMENT_TIMEOUT': int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+}
+
+# SQL profiler, also settable per app through app.config
+PROFILER_SETTINGS = {
+    # on records the statements of every request, see QueryProfiler
+    'SQL_PROFILER': os.environ.get('SQL_PROFILER', 'off') == 'on',
+    # statements slower than this many milliseconds are logged
+    'SLOW_QUERY_MS': float(os.environ.get('SLOW_QUERY_MS', 100)),
+    # a request running one SELECT this many times is a likely N+1
+    'N_PLUS_ONE_THRESHOLD': int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+}
+
+
+'''
+RoutingSession
+    session that sends reads to g.db_read_bind when the request set one,
+    see flaskr.replicas. flushes always go to the primary
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context():
+            bind = g.get('db_read_bind')
+            if bind is not None:
+                return bind
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+'''
+TimedQueuePool
+    QueuePool that counts how long checkouts wait and how often they time
+    out. connections are tagged with the pid that opened them and are
+    never handed to another process, so forked workers (gunicorn
+    --preload) open their own instead of sharing the parent's sockets
+'''
+
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'checked_in': self.checkedin(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_ms_total': self.wait_time * 1000,
+                'wait_ms_max': self.max_wait * 1000
+            }
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid') != os.getpid():
+        # opened before a fork, drop it without closing the shared socket
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError(
+            'connection opened in pid {}, now in pid {}'.format(
+                connection_record.info.get('pid'), os.getpid()))
+
+
+'''
+engine_options(database_path, settings)
+    create_engine() arguments for the POOL_SETTINGS, overridden by
+    settings. SQLite keeps its default pool, its connections are not
+    shared between threads
+'''
+
+
+def engine_options(database_path, settings=None):
+    settings = dict(POOL_SETTINGS, **(settings or {}))
+    options = {
+        'pool_pre_ping': settings['DB_POOL_PRE_PING'],
+        'pool_recycle': settings['DB_POOL_RECYCLE']
+    }
+    backend = make_url(database_path).get_backend_name()
+    if backend != 'sqlite':
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': settings['DB_POOL_SIZE'],
+            'max_overflow': settings['DB_MAX_OVERFLOW'],
+            'pool_timeout': settings['DB_POOL_TIMEOUT']
+        })
+    if backend == 'postgresql' and settings['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(
+            settings['DB_STATEMENT_TIMEOUT'])}
+    return options
+
+
+'''
+pool_stats(engine)
+    usage of the engine's connection pool
+'''
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, TimedQueuePool):
+        stats.update(pool.stats())
+    return stats
+
+
+'''
+statement_shape(statement) / repeated_selects(statements, threshold)
+    a statement with whitespace, numbers and IN lists of any length
+    collapsed, so the same query for other ids looks the same. the
+    SELECT shapes run threshold times or more, with their counts
+'''
+
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_IN_LIST = re.compile(
+    r'\(\s*' + _PLACEHOLDER + r'(?:\s*,\s*' + _PLACEHOLDER + r')*\s*\)')
+_NUMBER = re.compile(r'\b\d+\b')
+
+
+def statement_shape(statement):
+    return _IN_LIST.sub('(?)', _NUMBER.sub('?', ' '.join(statement.split())))
+
+
+def repeated_selects(statements, threshold):
+    counts = {}
+    for statement in statements:
+        shape = statement_shape(statement)
+        if shape.upper().startswith('SELECT'):
+            counts[shape] = counts.get(shape, 0) + 1
+    return sorted(((shape, count) for shape, count in counts.items()
+                   if count >= threshold), key=lambda item: -item[1])
+
+
+'''
+QueryProfiler(app, slow_query_ms, n_plus_one_threshold)
+    engine listeners counting the statements of each request and their
+    time, per endpoint. a statement slower than slow_query_ms is logged
+    with its parameters and endpoint, a request repeating one SELECT
+    n_plus_one_threshold times or more is logged as a likely N+1. the
+    latest of both are kept for /stats, which takes no token, so without
+    the parameters
+'''
+
+
+class QueryProfiler:
+    def __init__(self, app, slow_query_ms, n_plus_one_threshold, keep=50):
+        self.logger = app.logger
+        self.slow_query_ms = slow_query_ms
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.slow_queries = deque(maxlen=keep)
+        self.n_plus_one = deque(maxlen=keep)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        app.teardown_request(self.finish)
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._started)
+        event.listen(engine, 'after_cursor_execute', self._finished)
+
+    def _started(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+    def _finished(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        elapsed = time.perf_counter() - conn.info['profiler_start'].pop()
+        endpoint = None
+        if has_request_context():
+            endpoint = request.endpoint or 'unmatched'
+            g.setdefault('sql_profile', []).append((statement, elapsed))
+        if elapsed * 1000 < self.slow_query_ms:
+            return
+        parameters = repr(parameters)
+        if len(parameters) > 500:
+            parameters = parameters[:500] + '...'
+        statement = ' '.join(statement.split())
+        self.logger.warning('slow query, %.1f ms in %s: %s %s',
+                            elapsed * 1000, endpoint, statement, parameters)
+        with self._lock:
+            self.slow_queries.append({
+                'ms': round(elapsed * 1000, 3),
+                'endpoint': endpoint,
+                'statement': statement
+            })
+
+    def finish(self, error=None):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return
+        endpoint = request.endpoint or 'unmatched'
+        repeated = repeated_selects(
+            [statement for statement, elapsed in profile],
+            self.n_plus_one_threshold)
+        for shape, count in repeated:
+            self.logger.warning('likely N+1 in %s, %d times: %s',
+                                endpoint, count, shape)
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0, 'statements': 0, 'ms': 0.0,
+                'max_statements': 0})
+            stats['requests'] += 1
+            stats['statements'] += len(profile)
+            stats['ms'] += sum(elapsed for statement, elapsed in profile) \
+                * 1000
+            stats['max_statements'] = max(stats['max_statements'],
+                                          len(profile))
+            self.n_plus_one.extend({
+                'endpoint': endpoint,
+                'count': count,
+                'statement': shape
+            } for shape, count in repeated)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'endpoints': {endpoint: dict(
+                    stats, statements_per_request=stats['statements'] /
+                    stats['requests'], ms=round(stats['ms'], 3))
+                    for endpoint, stats in self._endpoints.items()},
+                'slow_queries': list(self.slow_queries),
+                'n_plus_one': list(self.n_plus_one)
+            }
+
+
+'''
+query_budget(budget, engine, tables)
+    for tests, fails with AssertionError when the statements run inside
+    the block exceed budget, listing them and the SELECTs repeated. with
+    tables only the statements reading or writing one of them count.
+    yields the list of statements counted
+'''
+
+_TABLE_NAME = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)', re.I)
+
+
+@contextmanager
+def query_budget(budget, engine=None, tables=None):
+    engine = engine or db.engine
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        if tables is None or \
+                set(_TABLE_NAME.findall(statement)).intersection(tables):
+            statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    if len(statements) > budget:
+        repeated = ''.join('\n  repeated {} times: {}'.format(count, shape)
+                           for shape, count in repeated_selects(statements, 2))
+        raise AssertionError('{} statements, budget {}:\n  {}{}'.format(
+            len(statements), budget, '\n  '.join(statements), repeated))
 
 
 '''
@@ -17,9 +339,645 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, {name: app.config[name] for name in POOL_SETTINGS
+                        if name in app.config})
     db.app = app
     db.init_app(app)
+    profiler = dict(PROFILER_SETTINGS, **{
+        name: app.config[name] for name in PROFILER_SETTINGS
+        if name in app.config})
+    if profiler['SQL_PROFILER']:
+        app.extensions['sql_profiler'] = QueryProfiler(
+            app, profiler['SLOW_QUERY_MS'], profiler['N_PLUS_ONE_THRESHOLD'])
+        app.extensions['sql_profiler'].attach(db.get_engine(app))
     db.create_all()
+    seed_versions()
+    # outside a request the session outlives the app, do not leave one
+    # bound to this app's engine for the next app created in this thread
+    db.session.remove()
+
+
+'''
+TableVersions
+    one counter per table, bumped in the same transaction as every write
+    to that table. lets readers tell whether a table changed without
+    reading its rows
+'''
+
+
+class TableVersions(db.Model):
+    __tablename__ = 'table_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+VERSIONED_TABLES = ('movies', 'actors', 'movie_cast')
+# last seq written to change_log, and the last one compacted and pruned
+CHANGE_COUNTERS = ('change_log', 'change_log_compacted', 'change_log_pruned')
+
+
+def seed_versions():
+    existing = {name for name, in db.session.query(TableVersions.name)}
+    for name in VERSIONED_TABLES + CHANGE_COUNTERS:
+        if name not in existing:
+            db.session.add(TableVersions(name=name, version=0))
+    db.session.commit()
+
+
+'''
+bump_versions(*tables)
+    bumps the version of each table in a transaction of its own, run after
+    the write committed. the counter rows are locked for this one UPDATE,
+    not for the whole write, so a slow write to a table does not hold up
+    every other writer of it. until the bump lands a reader may see the
+    new rows under the old version, a later poll gets the new one
+'''
+
+
+def bump_versions(*tables):
+    table = TableVersions.__table__
+    try:
+        db.session.execute(
+            table.update().where(table.c.name.in_(tables))
+            .values(version=table.c.version + 1))
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+
+
+def table_versions(*tables):
+    versions = dict(db.session.query(
+        TableVersions.name, TableVersions.version)
+        .filter(TableVersions.name.in_(tables)))
+    return tuple(versions.get(name, 0) for name in tables)
+
+
+'''
+ChangeLog
+    append-only log of the writes to movies, actors and movie_cast, written
+    in the same transaction as the write but without a seq, see
+    assign_seqs. readers only see entries that have one.
+    op is upsert with the written fields, delete, or reset when the write
+    did not know its rows and the table has to be read again
+'''
+
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    id = Column(Integer, primary_key=True)
+    seq = Column(Integer, index=True, unique=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer)
+    op = Column(String, nullable=False)
+    data = Column(Text)
+    created = Column(DateTime, nullable=False, index=True)
+
+    def format(self):
+        change = {'seq': self.seq, 'table': self.table_name, 'op': self.op}
+        if self.row_id is not None:
+            change['id'] = self.row_id
+        if self.data is not None:
+            change['data'] = json.loads(self.data)
+        return change
+
+
+def _change_entries(table, rows):
+    if rows is None:
+        return [(None, 'reset', None)]
+    if table == movie_cast.name:
+        return [(None, 'delete' if values is None else 'upsert',
+                 {'movie_id': movie_id, 'actor_id': actor_id})
+                for (movie_id, actor_id), values in rows.items()]
+    fields = {'movies': Movies, 'actors': Actors}[table].FIELDS
+    return [(row_id, 'delete', None) if values is None else
+            (row_id, 'upsert', {field: values[field] for field in fields
+                                if field != 'id' and field in values})
+            for row_id, values in rows.items()]
+
+
+def log_changes(written):
+    entries = [(table,) + entry for table, rows in written.items()
+               for entry in _change_entries(table, rows)]
+    if not entries:
+        return
+    created = datetime.utcnow()
+    db.session.execute(ChangeLog.__table__.insert(), [{
+        'table_name': table, 'row_id': row_id, 'op': op,
+        'data': None if data is None else json.dumps(data),
+        'created': created
+    } for table, row_id, op, data in entries])
+
+
+'''
+assign_seqs()
+    numbers the committed change_log entries that have no seq yet, after
+    the last seq handed out, in a short transaction of its own. the
+    change_log counter row is only locked for that transaction, never for
+    a write, and a seq only becomes visible with the counter that covers
+    it, so a reader never skips an entry still in flight. any worker picks
+    up the entries of one that died before numbering its own
+'''
+
+
+def assign_seqs():
+    table = TableVersions.__table__
+    log = ChangeLog.__table__
+    counter = table.c.name == 'change_log'
+    unnumbered = db.session.query(log.c.id).filter(
+        log.c.seq.is_(None)).order_by(log.c.id)
+    try:
+        # another worker numbered them already, no need to wait for the lock
+        if unnumbered.first() is None:
+            db.session.rollback()
+            return 0
+        # takes the counter row lock, so one worker numbers at a time
+        db.session.execute(table.update().where(counter).values(
+            version=table.c.version))
+        last, = table_versions('change_log')
+        ids = [row_id for row_id, in unnumbered]
+        if ids:
+            db.session.execute(
+                log.update().where(log.c.id == bindparam('b_id')).values(
+                    seq=bindparam('b_seq')),
+                [{'b_id': row_id, 'b_seq': seq} for seq, row_id in
+                 enumerate(ids, last + 1)])
+            db.session.execute(table.update().where(counter).values(
+                version=last + len(ids)))
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return len(ids)
+
+
+'''
+changes_since(since, tables, limit)
+    up to limit change_log entries of tables after seq since, in seq order,
+    and the last seq written when they were read
+'''
+
+
+def changes_since(since, tables, limit):
+    last, = table_versions('change_log')
+    entries = ChangeLog.query.filter(
+        ChangeLog.seq > since, ChangeLog.seq <= last,
+        ChangeLog.table_name.in_(tables)).order_by(ChangeLog.seq).limit(limit)
+    return [entry.format() for entry in entries], last
+
+
+'''
+compact_changes(before, batch_size) / prune_changes(before)
+    compact_changes folds the entries written before `before` that it did
+    not fold yet into one per row: upserts merge into the latest one, a
+    delete wins over earlier upserts, and a table's entries before its
+    latest reset go away. changes only ever move to a later seq, so a
+    client reading from any seq still ends up with the same rows.
+    prune_changes deletes the entries written before `before`, a client
+    asking for changes since an older seq has to read the tables again.
+    both return how many entries they removed
+'''
+
+
+def _claim_counter(name, old, new):
+    table = TableVersions.__table__
+    # another worker that got there first leaves nothing to update
+    return db.session.execute(table.update().where(and_(
+        table.c.name == name, table.c.version == old)).values(
+        version=new)).rowcount == 1
+
+
+def _change_key(entry):
+    if entry.op == 'reset':
+        return entry.table_name, 'reset'
+    if entry.row_id is None:
+        data = json.loads(entry.data)
+        return entry.table_name, data['movie_id'], data['actor_id']
+    return entry.table_name, entry.row_id
+
+
+def _compact_batch(entries):
+    resets = {}
+    for entry in entries:
+        if entry.op == 'reset':
+            resets[entry.table_name] = entry.seq
+    merged = {}
+    removed = []
+    for entry in entries:
+        if entry.seq < resets.get(entry.table_name, 0):
+            removed.append(entry.seq)
+            continue
+        key = _change_key(entry)
+        previous = merged.get(key)
+        if previous is not None:
+            removed.append(previous.seq)
+            if previous.op == 'upsert' and entry.op == 'upsert' and \
+                    entry.row_id is not None:
+                data = dict(json.loads(previous.data), **json.loads(
+                    entry.data))
+                entry.data = json.dumps(data)
+        merged[key] = entry
+    return removed
+
+
+def compact_changes(before, batch_size=10000):
+    compacted, last = table_versions('change_log_compacted', 'change_log')
+    upto = db.session.query(func.max(ChangeLog.seq)).filter(
+        ChangeLog.seq > compacted, ChangeLog.seq <= last,
+        ChangeLog.created < before).scalar()
+    if upto is None:
+        return 0
+    removed = 0
+    try:
+        while compacted < upto:
+            end = min(compacted + batch_size, upto)
+            if not _claim_counter('change_log_compacted', compacted, end):
+                db.session.rollback()
+                return removed
+            seqs = _compact_batch(ChangeLog.query.filter(
+                ChangeLog.seq > compacted, ChangeLog.seq <= end).order_by(
+                ChangeLog.seq).all())
+            for start in range(0, len(seqs), RELATED_BATCH_SIZE):
+                ChangeLog.query.filter(ChangeLog.seq.in_(
+                    seqs[start:start + RELATED_BATCH_SIZE])).delete(
+                    synchronize_session=False)
+            db.session.commit()
+            removed += len(seqs)
+            compacted = end
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return removed
+
+
+def prune_changes(before):
+    pruned, = table_versions('change_log_pruned')
+    upto = db.session.query(func.max(ChangeLog.seq)).filter(
+        ChangeLog.created < before).scalar()
+    if upto is None or upto <= pruned:
+        return 0
+    try:
+        if not _claim_counter('change_log_pruned', pruned, upto):
+            db.session.rollback()
+            return 0
+        removed = ChangeLog.query.filter(ChangeLog.seq <= upto).delete(
+            synchronize_session=False)
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return removed
+
+
+'''
+commit_changes(*tables, rows=None, related=None)
+    logs the rows to change_log, commits, bumps the version of the written
+    tables, numbers the logged entries and then calls every function in
+    write_listeners with the tables, and every function in row_listeners
+    with each table and the written rows. rows maps ids, (movie_id,
+    actor_id) pairs for movie_cast, to the written values, or to None for
+    deleted rows. it is None when the write does not know which rows it
+    touched. related maps other tables written in the same transaction to
+    their own rows, such as the movie_cast rows deleted along with a movie
+'''
+
+write_listeners = []
+row_listeners = []
+
+
+def commit_changes(*tables, rows=None, related=None):
+    written = dict.fromkeys(tables, rows)
+    written.update(related or {})
+    tables = tuple(written)
+    log_changes(written)
+    db.session.commit()
+    bump_versions(*tables)
+    try:
+        assign_seqs()
+    except SQLAlchemyError:
+        # the write is committed, the next assign_seqs() numbers its entries
+        pass
+    for listener in write_listeners:
+        listener(tables)
+    for listener in row_listeners:
+        for table, table_rows in written.items():
+            listener(table, table_rows)
+
+
+'''
+select_rows(model, fields=None)
+    query returning plain column tuples instead of ORM instances,
+    fields defaults to every field of model.format()
+'''
+
+
+def select_rows(model, fields=None):
+    return db.session.query(
+        *[getattr(model, field) for field in fields or model.FIELDS])
+
+
+'''
+row_dicts(fields, rows)
+    column tuples as the dicts model.format() would return
+'''
+
+
+def row_dicts(fields, rows):
+    return [dict(zip(fields, row)) for row in rows]
+
+
+'''
+insert_rows(model, rows)
+    inserts rows one statement each but in a single transaction, so many
+    writers share one commit. returns an (id, error) pair per row, after a
+    failure every row is retried under its own savepoint so the others
+    still commit
+'''
+
+
+def insert_rows(model, rows):
+    table = model.__table__
+    rows = [model.prepare_values(row) for row in rows]
+    try:
+        ids = [db.session.execute(table.insert().values(**row))
+               .inserted_primary_key[0] for row in rows]
+        commit_changes(table.name, rows=dict(zip(ids, rows)))
+        return [(row_id, None) for row_id in ids]
+    except SQLAlchemyError:
+        db.session.rollback()
+    results = []
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                row_id = db.session.execute(
+                    table.insert().values(**row)).inserted_primary_key[0]
+            results.append((row_id, None))
+        except SQLAlchemyError as error:
+            results.append((None, str(getattr(error, 'orig', None) or error)))
+    written = {row_id: row for (row_id, error), row in zip(results, rows)
+               if error is None}
+    try:
+        if written:
+            commit_changes(table.name, rows=written)
+        else:
+            db.session.rollback()
+    except SQLAlchemyError as error:
+        db.session.rollback()
+        message = str(getattr(error, 'orig', None) or error)
+        return [(None, message) for row in rows]
+    return results
+
+
+'''
+bulk_insert(model, rows, chunk_size)
+    inserts rows, dicts holding every field but id, one transaction per
+    chunk, COPY on PostgreSQL and executemany elsewhere.
+    returns an (id, error) pair per row, id is None when the database
+    cannot report it
+'''
+
+
+def bulk_insert(model, rows, chunk_size=BULK_CHUNK_SIZE):
+    rows = [model.prepare_values(row) for row in rows]
+    results = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            ids = _insert_chunk(model, chunk)
+            commit_changes(model.__tablename__, rows=None if None in ids
+                           else dict(zip(ids, chunk)))
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            message = str(getattr(error, 'orig', None) or error)
+            results.extend((None, message) for row in chunk)
+        else:
+            results.extend((row_id, None) for row_id in ids)
+    return results
+
+
+def _insert_chunk(model, chunk):
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return _copy_chunk(model, chunk)
+    db.session.execute(table.insert(), chunk)
+    if dialect == 'sqlite':
+        # writers are serialised, so the chunk holds the highest rowids
+        last_id = db.session.execute(select([func.max(table.c.id)])).scalar()
+        return list(range(last_id - len(chunk) + 1, last_id + 1))
+    return [None] * len(chunk)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_chunk(model, chunk):
+    table = model.__table__
+    connection = db.session.connection()
+    # ids are taken from the serial sequence up front so they can be
+    # reported per row, COPY itself returns nothing
+    ids = [row[0] for row in connection.execute(
+        select([func.nextval(func.pg_get_serial_sequence(table.name, 'id'))])
+        .select_from(func.generate_series(1, len(chunk))))]
+    columns = list(chunk[0])
+    buffer = io.StringIO()
+    for row_id, row in zip(ids, chunk):
+        values = [row_id] + [row[column] for column in columns]
+        buffer.write('\t'.join(_copy_value(value) for value in values))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(
+        table.name, ', '.join(['id'] + columns)), buffer)
+    return ids
+
+
+'''
+bulk_update(model, values, ids=None, where=None, chunk_size)
+bulk_delete(model, ids=None, where=None, chunk_size)
+    set-based UPDATE / DELETE of the rows matching an id list, sent in
+    chunks of chunk_size ids, or an equality filter {field: value}. an id
+    listed twice is written once. runs in one transaction and returns the
+    number of affected rows
+'''
+
+
+def _where_clauses(model, ids, where, chunk_size):
+    table = model.__table__
+    if ids is not None:
+        for start in range(0, len(ids), chunk_size):
+            yield table.c.id.in_(ids[start:start + chunk_size])
+    else:
+        yield and_(*[table.c[field] == value
+                     for field, value in where.items()])
+
+
+def _unique(ids):
+    # a repeat in another chunk would be counted twice
+    return None if ids is None else list(dict.fromkeys(ids))
+
+
+def bulk_update(model, values, ids=None, where=None,
+                chunk_size=BULK_CHUNK_SIZE):
+    table = model.__table__
+    values = model.prepare_values(values)
+    ids = _unique(ids)
+    affected = 0
+    try:
+        for clause in _where_clauses(model, ids, where, chunk_size):
+            affected += db.session.execute(
+                table.update().where(clause).values(
+                    version=table.c.version + 1, **values)).rowcount
+        if affected:
+            # ids that matched no row must not be reported as written
+            known = ids is not None and affected == len(ids)
+            commit_changes(table.name, rows={
+                row_id: values for row_id in ids} if known else None)
+        else:
+            db.session.rollback()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return affected
+
+
+def bulk_delete(model, ids=None, where=None, chunk_size=BULK_CHUNK_SIZE):
+    table = model.__table__
+    ids = _unique(ids)
+    affected = 0
+    cast = {}
+    try:
+        for clause in _where_clauses(model, ids, where, chunk_size):
+            cast.update(delete_cast_of(model, clause))
+            affected += db.session.execute(
+                table.delete().where(clause)).rowcount
+        if affected:
+            commit_changes(table.name, rows=None if ids is None else {
+                row_id: None for row_id in ids}, related=_cast_rows(cast))
+        else:
+            db.session.rollback()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return affected
+
+
+'''
+update_row(model, row_id, values, version) / delete_row(model, row_id, version)
+    single-row UPDATE / DELETE in one round trip, no SELECT first. with a
+    version the row is only written if it still has it. uses RETURNING
+    where the dialect supports it and the rowcount otherwise. without
+    RETURNING and without a version update_row reads the new version back
+    with a SELECT after the UPDATE, a second statement.
+    update_row returns the row's new version, delete_row True. both
+    return None when no row has that id and raise VersionConflict when
+    the row has another version
+'''
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def _write_row(stmt, table):
+    if db.session.get_bind().dialect.implicit_returning:
+        row = db.session.execute(stmt.returning(table.c.version)).first()
+        return None if row is None else row[0]
+    return True if db.session.execute(stmt).rowcount > 0 else None
+
+
+def _row_clause(table, row_id, version):
+    if version is None:
+        return table.c.id == row_id
+    return and_(table.c.id == row_id, table.c.version == version)
+
+
+def _not_written(model, row_id, version):
+    db.session.rollback()
+    # only a failed conditional write pays for telling the two apart
+    if version is not None and not missing_ids(model, [row_id]):
+        raise VersionConflict(row_id)
+    return None
+
+
+def update_row(model, row_id, values, version=None):
+    table = model.__table__
+    values = model.prepare_values(values)
+    try:
+        written = _write_row(table.update().where(
+            _row_clause(table, row_id, version)).values(
+            version=table.c.version + 1, **values), table)
+        if written is None:
+            return _not_written(model, row_id, version)
+        if written is True:
+            # no RETURNING, known from the expected version or read back
+            written = version + 1 if version is not None else \
+                db.session.query(table.c.version).filter(
+                    table.c.id == row_id).scalar()
+        commit_changes(table.name, rows={row_id: values})
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return written
+
+
+def delete_row(model, row_id, version=None):
+    table = model.__table__
+    try:
+        cast = delete_cast_of(model, row_id=row_id)
+        written = _write_row(table.delete().where(
+            _row_clause(table, row_id, version)), table)
+        if written is None:
+            return _not_written(model, row_id, version)
+        commit_changes(table.name, rows={row_id: None},
+                       related=_cast_rows(cast))
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return True
+
+
+'''
+prefix_clause(column, prefix)
+    case-sensitive prefix match written as a range, so a plain btree index
+    on the column serves it. the LIKE only rechecks the rows in the range
+'''
+
+
+def prefix_clause(column, prefix):
+    clauses = [column >= prefix, column.startswith(prefix, autoescape=True)]
+    if ord(prefix[-1]) < 0x10FFFF:
+        clauses.append(column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return and_(*clauses)
+
+
+'''
+parse_release_date(rdate)
+    date of a free-form release date such as "March 30, 1999",
+    None when it is not in a known format
+'''
+
+RELEASE_DATE_FORMATS = (
+    '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y',
+    '%d %B %Y', '%d %b %Y', '%Y-%m-%d', '%m/%d/%Y'
+)
+
+
+def parse_release_date(rdate):
+    if not isinstance(rdate, str):
+        return None
+    rdate = ' '.join(rdate.split())
+    for date_format in RELEASE_DATE_FORMATS:
+        try:
+            return datetime.strptime(rdate, date_format).date()
+        except ValueError:
+            pass
+    return None
 
 
 '''
@@ -29,24 +987,52 @@ Movies
 
 class Movies(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        Index('ix_movies_release_date', 'release_date', 'id'),
+    )
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     rdate = Column(String)
+    # parsed from rdate on every write, used for range filters and sorting
+    release_date = Column(Date)
+    # bumped by every update, an UPDATE naming an old version matches
+    # nothing, so concurrent edits cannot overwrite each other
+    version = Column(Integer, nullable=False, server_default='1')
+
+    FIELDS = ('id', 'name', 'rdate')
+    SORTS = ('id', 'release_date')
+    INCLUDES = ('cast',)
 
     def __init__(self, name, rdate):
         self.name = name
         self.rdate = rdate
 
+    @validates('rdate')
+    def validate_rdate(self, key, rdate):
+        self.release_date = parse_release_date(rdate)
+        return rdate
+
+    @classmethod
+    def prepare_values(cls, values):
+        if 'rdate' in values:
+            values = dict(values,
+                          release_date=parse_release_date(values['rdate']))
+        return values
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_changes(self.__tablename__, rows={self.id: self.format()})
 
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        commit_changes(self.__tablename__, rows={self.id: self.format()})
 
     def delete(self):
+        cast = delete_cast_of(type(self), row_id=self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit_changes(self.__tablename__, rows={self.id: None},
+                       related=_cast_rows(cast))
 
     def format(self):
         return {
@@ -63,26 +1049,42 @@ Actors
 
 class Actors(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        Index('ix_actors_gender_age', 'gender', 'age'),
+    )
     id = Column(Integer, primary_key=True)
-    name = Column(String)
-    age = Column(Integer)
+    name = Column(String, index=True)
+    age = Column(Integer, index=True)
     gender = Column(String)
+    version = Column(Integer, nullable=False, server_default='1')
+
+    FIELDS = ('id', 'name', 'age', 'gender')
+    SORTS = ('id',)
+    INCLUDES = ('movies',)
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @classmethod
+    def prepare_values(cls, values):
+        return values
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_changes(self.__tablename__, rows={self.id: self.format()})
 
     def update(self):
-        db.session.commit()
+        self.version = type(self).version + 1
+        commit_changes(self.__tablename__, rows={self.id: self.format()})
 
     def delete(self):
+        cast = delete_cast_of(type(self), row_id=self.id)
         db.session.delete(self)
-        db.session.commit()
+        commit_changes(self.__tablename__, rows={self.id: None},
+                       related=_cast_rows(cast))
 
     def format(self):
         return {
@@ -91,3 +1093,149 @@ class Actors(db.Model):
             'age': self.age,
             'gender': self.gender
         }
+
+
+'''
+movie_cast
+    which actors play in which movie, one row per pair. rows go away with
+    either side
+'''
+
+movie_cast = db.Table(
+    'movie_cast',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_movie_cast_actor_id', 'actor_id', 'movie_id')
+)
+
+# own key, other key and model on the other side, per side of movie_cast
+CAST_SIDES = {
+    Movies: (movie_cast.c.movie_id, movie_cast.c.actor_id, Actors),
+    Actors: (movie_cast.c.actor_id, movie_cast.c.movie_id, Movies)
+}
+
+
+'''
+related_rows(model, ids, fields)
+    rows on the other side of movie_cast for each id, as {id: [dict, ...]}.
+    loaded like selectinload, one query per RELATED_BATCH_SIZE ids however
+    many rows or relations there are
+'''
+
+
+def related_rows(model, ids, fields=None, batch_size=RELATED_BATCH_SIZE):
+    own, other, related = CAST_SIDES[model]
+    fields = fields or related.FIELDS
+    ids = list(dict.fromkeys(ids))
+    result = {row_id: [] for row_id in ids}
+    for start in range(0, len(ids), batch_size):
+        rows = db.session.query(
+            own, *[getattr(related, field) for field in fields]) \
+            .select_from(movie_cast).join(related, related.id == other) \
+            .filter(own.in_(ids[start:start + batch_size])) \
+            .order_by(own, related.id)
+        for row in rows:
+            result[row[0]].append(dict(zip(fields, row[1:])))
+    return result
+
+
+'''
+missing_ids(model, ids)
+    the ids that have no row in model's table
+'''
+
+
+def missing_ids(model, ids, batch_size=RELATED_BATCH_SIZE):
+    ids = list(set(ids))
+    found = set()
+    for start in range(0, len(ids), batch_size):
+        found.update(row_id for row_id, in db.session.query(model.id)
+                     .filter(model.id.in_(ids[start:start + batch_size])))
+    return set(ids) - found
+
+
+'''
+add_cast(pairs) / remove_cast(pairs)
+    casts / uncasts (movie_id, actor_id) pairs in one transaction, pairs
+    already in the wanted state are skipped. returns how many changed
+'''
+
+
+def _cast_pairs(pairs, batch_size=RELATED_BATCH_SIZE):
+    movie_ids = list({movie_id for movie_id, actor_id in pairs})
+    existing = set()
+    for start in range(0, len(movie_ids), batch_size):
+        existing.update(db.session.query(
+            movie_cast.c.movie_id, movie_cast.c.actor_id).filter(
+            movie_cast.c.movie_id.in_(
+                movie_ids[start:start + batch_size])))
+    return existing & set(pairs)
+
+
+def _write_cast(stmt, pairs, added):
+    try:
+        if pairs:
+            pairs = sorted(pairs)
+            db.session.execute(stmt, [
+                {'b_movie_id': movie_id, 'b_actor_id': actor_id}
+                for movie_id, actor_id in pairs])
+            commit_changes(movie_cast.name, rows={
+                pair: dict(zip(('movie_id', 'actor_id'), pair)) if added
+                else None for pair in pairs})
+        else:
+            db.session.rollback()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return len(pairs)
+
+
+'''
+delete_cast_of(model, clause, row_id)
+    deletes the movie_cast rows of the model rows matching clause, or of
+    the one row with row_id, before those rows are deleted in the same
+    transaction. by id the statement does not read the model's table, a
+    version check is left to the row's own DELETE. returns the deleted
+    pairs mapped to None, for commit_changes. the foreign keys cascade
+    too, but those deletes are neither logged nor versioned, and SQLite
+    does not enforce them
+'''
+
+
+def delete_cast_of(model, clause=None, row_id=None):
+    own = CAST_SIDES[model][0]
+    if clause is None:
+        match = own == row_id
+    else:
+        match = own.in_(select([model.__table__.c.id]).where(clause))
+    stmt = movie_cast.delete().where(match)
+    if db.session.get_bind().dialect.implicit_returning:
+        pairs = db.session.execute(stmt.returning(
+            movie_cast.c.movie_id, movie_cast.c.actor_id)).fetchall()
+    else:
+        pairs = db.session.query(
+            movie_cast.c.movie_id, movie_cast.c.actor_id).filter(
+            match).all()
+        if pairs:
+            db.session.execute(stmt)
+    return {tuple(pair): None for pair in pairs}
+
+
+def _cast_rows(cast):
+    return {movie_cast.name: cast} if cast else None
+
+
+def add_cast(pairs):
+    pairs = set(pairs) - _cast_pairs(pairs)
+    return _write_cast(movie_cast.insert().values(
+        movie_id=bindparam('b_movie_id'),
+        actor_id=bindparam('b_actor_id')), pairs, True)
+
+
+def remove_cast(pairs):
+    return _write_cast(movie_cast.delete().where(and_(
+        movie_cast.c.movie_id == bindparam('b_movie_id'),
+        movie_cast.c.actor_id == bindparam('b_actor_id'))),
+        _cast_pairs(pairs), False)
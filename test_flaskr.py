@@ -1,10 +1,45 @@
 import unittest
+import asyncio
+import gzip
 import json
 import os
+import runpy
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, datetime
 
+import brotli
+import msgpack
+from flask import g, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, create_engine, inspect
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from werkzeug.exceptions import PreconditionFailed
 from flaskr import create_app
-from models import setup_db, Movies, Actors
+from models import setup_db, Movies, Actors, db, select_rows, \
+    parse_release_date, engine_options, TimedQueuePool, insert_rows, \
+    update_row, delete_row, bulk_update, bulk_delete, VersionConflict, \
+    add_cast, changes_since, compact_changes, prune_changes, table_versions, \
+    query_budget, statement_shape, repeated_selects, missing_ids, movie_cast, \
+    ChangeLog, assign_seqs
+from flaskr.pagination import encode_cursor, decode_cursor
+from flaskr.cache import LRUBackend, LocalSharedBackend, ResponseCache
+from flaskr.singleflight import SingleFlight
+from flaskr.suggest import PrefixIndex, SuggestIndex
+from flaskr.groupcommit import GroupCommit
+from flaskr.concurrency import expected_version
+from flaskr.changes import read_changes
+from flaskr.metrics import Metrics, Timings, retire_worker, \
+    clear_metrics_dir, EXITED_FILE
+from flaskr import metrics as metrics_module
+from flaskr.serializer import make_serializer
+from flaskr.compression import Compressor
+from flaskr.asgi import AsgiApp, create_asgi_app, ASGI_THREADS
+from flaskr.replicas import ReplicaSet, read_replica, stick_to_primary
+from auth import JWKSCache, TokenCache, AuthError, check_permissions, \
+    jwks_cache
 
 
 # Create Test Case
@@ -87,6 +122,77 @@ class CastingAppTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 404)
             self.assertEqual(data['success'], False)
 
+    # Executive Producer POST /movies/bulk inserts every record
+    def test_insert_movies_bulk(self):
+        movies = [self.new_movie, {'name': 'The Matrix Reloaded'}]
+        res = self.client().post('/movies/bulk',
+                                 headers=self.ep_header, json=movies)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([r['index'] for r in data['results']], [0, 1])
+
+    # Invalid record rejects the whole batch with 400
+    def test_insert_actors_bulk_invalid(self):
+        actors = [self.new_actor, {'name': 'Carrie-Anne Moss', 'age': 'old'}]
+        res = self.client().post('/actors/bulk',
+                                 headers=self.cd_header, json=actors)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['created'], 0)
+        self.assertEqual(data['results'][0]['success'], True)
+        self.assertEqual(data['results'][1]['success'], False)
+
+    # Creative Assistant POST /actors/bulk should fail with 403
+    def test_insert_actors_bulk_ca(self):
+        res = self.client().post('/actors/bulk',
+                                 headers=self.ca_header, json=[self.new_actor])
+        self.assertEqual(res.status_code, 403)
+
+    # Executive Producer PATCH /movies/bulk updates every listed movie
+    def test_patching_movies_bulk(self):
+        res = self.client().post('/movies/bulk', headers=self.ep_header,
+                                 json=[self.new_movie, self.new_movie])
+        ids = [r['id'] for r in json.loads(res.data)['results']]
+        res = self.client().patch('/movies/bulk', headers=self.ep_header,
+                                  json={'ids': ids,
+                                        'changes': {'rdate': 'May 1, 2020'}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+
+    # Executive Producer DELETE /movies/bulk deletes every listed movie
+    def test_delete_movies_bulk(self):
+        res = self.client().post('/movies/bulk', headers=self.ep_header,
+                                 json=[self.new_movie, self.new_movie])
+        ids = [r['id'] for r in json.loads(res.data)['results']]
+        res = self.client().delete('/movies/bulk', headers=self.ep_header,
+                                   json={'ids': ids})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+
+    # Bulk PATCH needs either ids or a filter, not both
+    def test_patching_actors_bulk_bad_target(self):
+        res = self.client().patch('/actors/bulk', headers=self.cd_header,
+                                  json={'ids': [1], 'filter': {'age': 54},
+                                        'changes': {'age': 55}})
+        self.assertEqual(res.status_code, 400)
+
+    # Bulk filter values must have their column's type
+    def test_patching_actors_bulk_bad_filter_value(self):
+        for value in ([1, 2], {'gt': 1}):
+            res = self.client().patch('/actors/bulk', headers=self.cd_header,
+                                      json={'filter': {'age': value},
+                                            'changes': {'age': 5}})
+            self.assertEqual(res.status_code, 400)
+
+    # Bulk DELETE with a list as a filter value should fail with 400
+    def test_delete_actors_bulk_bad_filter_value(self):
+        res = self.client().delete('/actors/bulk', headers=self.ep_header,
+                                   json={'filter': {'gender': ['F']}})
+        self.assertEqual(res.status_code, 400)
+
     # Createive Assistant GET /movies should succeed
     def test_movies(self):
         res = self.client().get('/movies', headers=self.ca_header)
@@ -109,6 +215,425 @@ class CastingAppTestCase(unittest.TestCase):
             self.assertEqual(res.status_code, 404)
             self.assertEqual(data['success'], False)
 
+    # GET /movies returns a page and a cursor to the next one
+    def test_movies_paginated(self):
+        res = self.client().get('/movies?limit=1', headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['movies']), 1)
+        self.assertIn('next_cursor', data)
+        if data['next_cursor']:
+            res = self.client().get(
+                '/movies?limit=1&after=' + data['next_cursor'],
+                headers=self.ca_header)
+            next_page = json.loads(res.data)
+            self.assertGreater(next_page['movies'][0]['id'],
+                               data['movies'][0]['id'])
+
+    # GET /actors?all=true keeps the unpaginated shape
+    def test_actors_all(self):
+        res = self.client().get('/actors?all=true', headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('next_cursor', data)
+        self.assertEqual(data['success'], True)
+
+    # GET /movies?stream=ndjson streams one movie per line
+    def test_movies_ndjson(self):
+        res = self.client().get('/movies?stream=ndjson',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        for line in res.data.decode().splitlines():
+            self.assertIn('id', json.loads(line))
+
+    # GET /actors?stream=json matches the unpaginated document
+    def test_actors_stream_json(self):
+        streamed = self.client().get('/actors?stream=json',
+                                     headers=self.ca_header)
+        buffered = self.client().get('/actors?all=true',
+                                     headers=self.ca_header)
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(json.loads(streamed.data), json.loads(buffered.data))
+
+    # GET /movies with the current ETag returns 304
+    def test_movies_not_modified(self):
+        res = self.client().get('/movies', headers=self.ca_header)
+        etag = res.headers['ETag']
+        headers = dict(self.ca_header, **{'If-None-Match': etag})
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    # Writing to actors changes the ETag of GET /actors
+    def test_actors_etag_changes_on_write(self):
+        res = self.client().get('/actors', headers=self.cd_header)
+        etag = res.headers['ETag']
+        self.client().post('/actors', headers=self.cd_header,
+                           json=self.new_actor)
+        headers = dict(self.cd_header, **{'If-None-Match': etag})
+        res = self.client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # GET /movies?all=true is gzipped for clients accepting it, and its
+    # weak ETag still gets a 304
+    def test_movies_gzip(self):
+        client = create_app({'COMPRESSION_MIN_SIZE': 0}).test_client()
+        plain = client.get('/movies?all=true', headers=self.ca_header)
+        res = client.get('/movies?all=true', headers=dict(
+            self.ca_header, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(res.headers['ETag'], 'W/' + plain.headers['ETag'])
+        res = client.get('/movies?all=true', headers=dict(
+            self.ca_header, **{'Accept-Encoding': 'gzip',
+                               'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    # Streams are compressed too, with the same rows once decompressed
+    def test_movies_ndjson_brotli(self):
+        plain = self.client().get('/movies?stream=ndjson',
+                                  headers=self.ca_header)
+        res = self.client().get('/movies?stream=ndjson', headers=dict(
+            self.ca_header, **{'Accept-Encoding': 'br'}))
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(brotli.decompress(res.data), plain.data)
+
+    # Actors posted and listed as MessagePack match the JSON ones
+    def test_actors_msgpack(self):
+        res = self.client().post('/actors', data=msgpack.packb(
+            self.new_actor), headers=dict(
+            self.cd_header, **{'Content-Type': 'application/msgpack'}))
+        self.assertEqual(res.status_code, 201)
+        actor_id = json.loads(res.data)['id']
+        headers = dict(self.ca_header, Accept='application/msgpack')
+        res = self.client().get('/actors?all=true', headers=headers)
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(res.data), json.loads(
+            self.client().get('/actors?all=true',
+                              headers=self.ca_header).data))
+        res = self.client().get('/actors/%d' % actor_id, headers=headers)
+        self.assertEqual(msgpack.unpackb(res.data)['actor']['name'],
+                         'Keanu Reeves')
+
+    # Workers sharing a cache never serve a list another worker changed
+    def test_shared_cache_invalidated_across_workers(self):
+        store = {}
+        worker_a = create_app({'RESPONSE_CACHE': LocalSharedBackend(store)})
+        worker_b = create_app({'RESPONSE_CACHE': LocalSharedBackend(store)})
+        before = json.loads(worker_a.test_client().get(
+            '/movies?all=true', headers=self.ep_header).data)
+        worker_b.test_client().post('/movies', headers=self.ep_header,
+                                    json=self.new_movie)
+        after = json.loads(worker_a.test_client().get(
+            '/movies?all=true', headers=self.ep_header).data)
+        self.assertEqual(len(after['movies']), len(before['movies']) + 1)
+
+    # GET /actors?fields=name returns only id and name
+    def test_actors_sparse_fields(self):
+        res = self.client().get('/actors?fields=name',
+                                headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for actor in data['Actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    # Unknown field should fail with 400
+    def test_movies_unknown_field(self):
+        res = self.client().get('/movies?fields=budget',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    # Malformed cursor should fail with 400
+    def test_movies_bad_cursor(self):
+        res = self.client().get('/movies?after=nope', headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    # GET /actors filters by name prefix, age range and gender
+    def test_actors_filtered(self):
+        self.client().post('/actors', headers=self.cd_header,
+                           json=self.new_actor)
+        res = self.client().get(
+            '/actors?all=true&name_prefix=Keanu&min_age=50&max_age=60'
+            '&gender=Female', headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(len(data['Actors']), 0)
+        for actor in data['Actors']:
+            self.assertTrue(actor['name'].startswith('Keanu'))
+            self.assertTrue(50 <= actor['age'] <= 60)
+            self.assertEqual(actor['gender'], 'Female')
+
+    # Non numeric age should fail with 400
+    def test_actors_bad_age_filter(self):
+        res = self.client().get('/actors?min_age=old',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    def indexes(self, table):
+        return {index['name']: index['column_names']
+                for index in inspect(db.engine).get_indexes(table)}
+
+    # GET /movies?released_from&released_to filters on the parsed date
+    def test_movies_released_between(self):
+        self.client().post('/movies', headers=self.ep_header,
+                           json=self.new_movie)
+        res = self.client().get(
+            '/movies?all=true&released_from=1999-01-01'
+            '&released_to=1999-12-31', headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('March 30, 1999',
+                      [movie['rdate'] for movie in data['movies']])
+
+    # Malformed release date should fail with 400
+    def test_movies_bad_release_date_filter(self):
+        res = self.client().get('/movies?released_from=30/03/1999',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    # GET /movies?sort=release_date pages through every movie once
+    def test_movies_sorted_by_release_date(self):
+        self.client().post('/movies', headers=self.ep_header,
+                           json=self.new_movie)
+        res = self.client().get('/movies?all=true', headers=self.ca_header)
+        expected = sorted(movie['id'] for movie in
+                          json.loads(res.data)['movies'])
+        seen = []
+        url = '/movies?sort=release_date&limit=2'
+        while url:
+            data = json.loads(self.client().get(
+                url, headers=self.ca_header).data)
+            seen.extend(movie['id'] for movie in data['movies'])
+            url = data['next_cursor'] and (
+                '/movies?sort=release_date&limit=2&after=' +
+                data['next_cursor'])
+        self.assertEqual(sorted(seen), expected)
+
+    # Sorting actors by release date should fail with 400
+    def test_actors_bad_sort(self):
+        res = self.client().get('/actors?sort=release_date',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    def cast_pair(self):
+        res = self.client().post('/movies/bulk', headers=self.ep_header,
+                                 json=[self.new_movie])
+        movie_id = json.loads(res.data)['results'][0]['id']
+        res = self.client().post('/actors/bulk', headers=self.ep_header,
+                                 json=[self.new_actor])
+        actor_id = json.loads(res.data)['results'][0]['id']
+        res = self.client().post('/cast/bulk', headers=self.cd_header, json=[
+            {'movie_id': movie_id, 'actor_id': actor_id}])
+        self.assertEqual(json.loads(res.data)['assigned'], 1)
+        return movie_id, actor_id
+
+    def count_queries(self, url):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get(url, headers=self.ca_header)
+            res.get_data()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(res.status_code, 200)
+        return len(statements)
+
+    # GET /movies/<id>/cast and /actors/<id>/movies list both sides
+    def test_cast_both_sides(self):
+        movie_id, actor_id = self.cast_pair()
+        res = self.client().get('/movies/{}/cast'.format(movie_id),
+                                headers=self.ca_header)
+        self.assertIn(actor_id, [actor['id'] for actor in
+                                 json.loads(res.data)['cast']])
+        res = self.client().get('/actors/{}/movies'.format(actor_id),
+                                headers=self.ca_header)
+        self.assertIn(movie_id, [movie['id'] for movie in
+                                 json.loads(res.data)['movies']])
+
+    # Unknown movie cast should fail with 404
+    def test_cast_unknown_movie(self):
+        res = self.client().get('/movies/0/cast', headers=self.ca_header)
+        self.assertEqual(res.status_code, 404)
+
+    # Casting unknown ids should fail with 400 and cast nobody
+    def test_cast_bulk_unknown_ids(self):
+        res = self.client().post('/cast/bulk', headers=self.cd_header,
+                                 json=[{'movie_id': 0, 'actor_id': 0}])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['results'][0]['errors'],
+                         ['unknown movie_id', 'unknown actor_id'])
+
+    # DELETE /cast/bulk uncasts the pair
+    def test_uncast_bulk(self):
+        movie_id, actor_id = self.cast_pair()
+        res = self.client().delete('/cast/bulk', headers=self.cd_header,
+                                   json=[{'movie_id': movie_id,
+                                          'actor_id': actor_id}])
+        self.assertEqual(json.loads(res.data)['removed'], 1)
+
+    # GET /movies?include=cast runs as many queries for 1 movie as for 20
+    def test_include_cast_query_count(self):
+        movie_id, actor_id = self.cast_pair()
+        self.cast_pair()
+        res = self.client().get('/movies?all=true&include=cast',
+                                headers=self.ca_header)
+        movie = [movie for movie in json.loads(res.data)['movies']
+                 if movie['id'] == movie_id][0]
+        self.assertIn(actor_id, [actor['id'] for actor in movie['cast']])
+        self.assertEqual(
+            self.count_queries('/movies?include=cast&limit=1'),
+            self.count_queries('/movies?include=cast&limit=20'))
+        self.assertEqual(
+            self.count_queries('/actors?include=movies&limit=1'),
+            self.count_queries('/actors?include=movies&limit=20'))
+
+    # List endpoints stay within their query budgets, however many rows
+    def test_query_budgets(self):
+        self.cast_pair()
+        budgets = {
+            '/movies?limit=20': 2,
+            '/movies?include=cast&limit=20': 3,
+            '/actors?include=movies&limit=20': 3,
+            '/movies/1/cast': 2,
+            '/search/suggest?q=a': 2
+        }
+        for url, budget in budgets.items():
+            with query_budget(budget):
+                self.client().get(url, headers=self.ca_header).get_data()
+
+    # GET /search/suggest finds a new actor by a prefix in any case
+    def test_suggest_actor(self):
+        self.client().post('/actors', headers=self.cd_header,
+                           json=self.new_actor)
+        res = self.client().get('/search/suggest?q=keanu r&type=actors',
+                                headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('movies', data)
+        self.assertIn('Keanu Reeves',
+                      [actor['name'] for actor in data['actors']])
+
+    # Suggestions without a prefix should fail with 400
+    def test_suggest_no_prefix(self):
+        res = self.client().get('/search/suggest?q=',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    # GET /movies/<int:m_id> returns the movie with its version as ETag
+    def test_get_movie_etag(self):
+        res = self.client().post('/movies', headers=self.ep_header,
+                                 json=self.new_movie)
+        movie_id = json.loads(res.data)['id']
+        res = self.client().get('/movies/%d' % movie_id,
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie']['id'], movie_id)
+        self.assertEqual(res.headers['ETag'], '"v1"')
+        res = self.client().get('/movies/%d' % movie_id, headers=dict(
+            self.ca_header, **{'If-None-Match': '"v1"'}))
+        self.assertEqual(res.status_code, 304)
+
+    # PATCH with a stale If-Match should fail with 412
+    def test_patching_actor_stale_version(self):
+        res = self.client().post('/actors', headers=self.cd_header,
+                                 json=self.new_actor)
+        actor_id = json.loads(res.data)['id']
+        header = dict(self.cd_header, **{'If-Match': '"v1"'})
+        res = self.client().patch('/actors/%d' % actor_id, headers=header,
+                                  json={'age': 40})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"v2"')
+        res = self.client().patch('/actors/%d' % actor_id, headers=header,
+                                  json={'age': 41})
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(json.loads(res.data)['success'], False)
+        res = self.client().delete('/actors/%d' % actor_id, headers=dict(
+            self.ep_header, **{'If-Match': '"v2"'}))
+        self.assertEqual(res.status_code, 200)
+
+    # PATCH and DELETE of one row take one statement on its table, no
+    # SELECT first. without RETURNING a PATCH with no If-Match reads the
+    # new version back
+    def test_single_row_statements(self):
+        returning = db.engine.dialect.implicit_returning
+        movie_id, actor_id = self.cast_pair()
+        for table, row_id, changes in (
+                ('movies', movie_id, {'rdate': 'March 31, 1999'}),
+                ('actors', actor_id, {'age': 40})):
+            url = '/%s/%d' % (table, row_id)
+            with query_budget(1 if returning else 2,
+                              tables=(table,)) as statements:
+                res = self.client().patch(url, headers=self.ep_header,
+                                          json=changes)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(statements[0].startswith('UPDATE'))
+            header = dict(self.ep_header, **{'If-Match': res.headers['ETag']})
+            with query_budget(1, tables=(table,)):
+                res = self.client().patch(url, headers=header, json=changes)
+            self.assertEqual(res.status_code, 200)
+            with query_budget(1, tables=(table,)) as statements:
+                res = self.client().delete(url, headers=self.ep_header)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(statements[0].startswith('DELETE'))
+
+    # PATCH and DELETE of a missing id fail with 404 after one statement
+    def test_single_row_missing(self):
+        for table, changes in (('movies', {'rdate': 'March 31, 1999'}),
+                               ('actors', {'age': 40})):
+            url = '/%s/%d' % (table, 2 ** 31 - 1)
+            with query_budget(1):
+                res = self.client().patch(url, headers=self.ep_header,
+                                          json=changes)
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(json.loads(res.data)['success'], False)
+            with query_budget(1, tables=(table,)) as statements:
+                res = self.client().delete(url, headers=self.ep_header)
+            self.assertEqual(res.status_code, 404)
+            self.assertTrue(statements[0].startswith('DELETE'))
+
+    # GET /changes returns the writes made after since
+    def test_changes(self):
+        res = self.client().get('/changes', headers=self.ca_header)
+        since = json.loads(res.data)['last_seq']
+        res = self.client().post('/movies', headers=self.ep_header,
+                                 json=self.new_movie)
+        movie_id = json.loads(res.data)['id']
+        res = self.client().get('/changes?tables=movies&since=%d' % since,
+                                headers=self.ca_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(change['op'], change['id'])
+                          for change in data['changes']],
+                         [('upsert', movie_id)])
+        self.assertEqual(data['last_seq'], data['changes'][-1]['seq'])
+
+    # GET /changes of an unknown table should fail with 400
+    def test_changes_unknown_table(self):
+        res = self.client().get('/changes?tables=bogus',
+                                headers=self.ca_header)
+        self.assertEqual(res.status_code, 400)
+
+    # The filtered columns have their indexes, whether the planner uses
+    # them depends on the size of the tables
+    def test_filter_indexes(self):
+        actors = self.indexes('actors')
+        self.assertEqual(actors['ix_actors_name'], ['name'])
+        self.assertEqual(actors['ix_actors_gender_age'], ['gender', 'age'])
+        self.assertEqual(actors['ix_actors_age'], ['age'])
+        movies = self.indexes('movies')
+        self.assertEqual(movies['ix_movies_name'], ['name'])
+        self.assertEqual(movies['ix_movies_release_date'],
+                         ['release_date', 'id'])
+
     # Creative Assistant /movies should fail with 403
     def test_insert_movie_ca(self):
         res = self.client().post('/movies',
@@ -219,5 +744,1241 @@ class CastingAppTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
 
+# Pagination cursors
+class CursorTestCase(unittest.TestCase):
+
+    # Cursor round trips the last id
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42))['id'], 42)
+
+    # Cursor of a release date page keeps the date
+    def test_cursor_sort_value(self):
+        cursor = decode_cursor(encode_cursor(7, release_date='1999-03-30'))
+        self.assertEqual(cursor, {'id': 7, 'release_date': '1999-03-30'})
+
+
+# Release dates parsed from the free text rdate
+class ReleaseDateTestCase(unittest.TestCase):
+
+    # Common spellings parse to the same date
+    def test_release_date_formats(self):
+        for rdate in ('March 30, 1999', 'Mar 30 1999', '30 March 1999',
+                      '1999-03-30', '03/30/1999', ' March  30,  1999 '):
+            self.assertEqual(parse_release_date(rdate), date(1999, 3, 30))
+
+    # Unparseable rdate leaves the release date empty
+    def test_release_date_unparseable(self):
+        self.assertIsNone(parse_release_date('sometime in the 90s'))
+        self.assertIsNone(parse_release_date(None))
+
+    # Writes keep release_date in step with rdate
+    def test_release_date_prepared(self):
+        self.assertEqual(Movies.prepare_values({'rdate': '1999-03-30'}),
+                         {'rdate': '1999-03-30',
+                          'release_date': date(1999, 3, 30)})
+        self.assertEqual(Movies('Heat', '1999-03-30').release_date,
+                         date(1999, 3, 30))
+
+
+# Name autocomplete index
+class PrefixIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex([(1, 'Keanu Reeves'), (2, 'kevin Bacon'),
+                                  (3, 'Keira Knightley'), (4, None)])
+
+    # Matches ignore case and come in name order
+    def test_prefix_search(self):
+        self.assertEqual([match['id'] for match in
+                          self.index.search('KE', 10)], [1, 3, 2])
+        self.assertEqual(self.index.search('kea', 10),
+                         [{'id': 1, 'name': 'Keanu Reeves'}])
+        self.assertEqual(self.index.search('x', 10), [])
+
+    # At most limit matches
+    def test_prefix_search_limit(self):
+        self.assertEqual(len(self.index.search('ke', 2)), 2)
+
+    # Renamed and removed rows leave the old name behind
+    def test_prefix_put_remove(self):
+        self.index.put(1, 'Carrie-Anne Moss')
+        self.index.remove(3)
+        self.index.put(5, 'Kevin Costner')
+        self.assertEqual([match['id'] for match in
+                          self.index.search('ke', 10)], [2, 5])
+        self.assertEqual(len(self.index), 3)
+
+
+# Background loads of the autocomplete index, on a SQLite file
+class SuggestIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False
+        })
+        with self.app.app_context():
+            insert_rows(Movies, [{'name': 'Heat', 'rdate': None},
+                                 {'name': 'Ronin', 'rdate': None}])
+        self.index = SuggestIndex(self.app)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    # Writes made while a load reads the table end up in the new index
+    def test_writes_during_load_replayed(self):
+        def write(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().startswith('SELECT movies.id'):
+                self.index.apply('movies', {1: {'name': 'Heist'}, 2: None,
+                                            3: {'name': 'Hero'}})
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', write)
+        try:
+            self.index._reload('movies')
+        finally:
+            event.remove(engine, 'before_cursor_execute', write)
+        with self.app.app_context():
+            self.assertEqual(self.index.search('movies', 'he', 10),
+                             [{'id': 1, 'name': 'Heist'},
+                              {'id': 3, 'name': 'Hero'}])
+            self.assertEqual(self.index.search('movies', 'ron', 10), [])
+        self.assertEqual(self.index.reloads, 1)
+        self.assertEqual(self.index._pending, {})
+
+
+# Connection pool settings and stats
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = TimedQueuePool(
+            lambda: sqlite3.connect(':memory:', check_same_thread=False),
+            pool_size=1, max_overflow=0, timeout=0.05)
+
+    # PostgreSQL gets the queue pool and the statement timeout
+    def test_engine_options_postgres(self):
+        options = engine_options('postgresql://u:p@localhost/capdb', {
+            'DB_POOL_SIZE': 20, 'DB_STATEMENT_TIMEOUT': 5000})
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    # SQLite keeps its own pool
+    def test_engine_options_sqlite(self):
+        options = engine_options('sqlite:///cast.db')
+        self.assertNotIn('poolclass', options)
+        self.assertNotIn('connect_args', options)
+
+    # Checkouts past the pool are counted as timeouts
+    def test_pool_timeout_counted(self):
+        connection = self.pool.connect()
+        with self.assertRaises(PoolTimeoutError):
+            self.pool.connect()
+        stats = self.pool.stats()
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['wait_ms_max'], 50)
+        connection.close()
+
+    # A connection opened by another process is replaced on checkout
+    def test_pool_connection_not_shared_across_fork(self):
+        connection = self.pool.connect()
+        opened = connection.connection
+        connection._connection_record.info['pid'] = os.getpid() + 1
+        connection.close()
+        connection = self.pool.connect()
+        self.assertIsNot(connection.connection, opened)
+        connection.close()
+
+
+# Read replica routing, with two SQLite files
+class ReplicaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        primary = 'sqlite:///' + os.path.join(self.dir.name, 'primary.db')
+        replica = 'sqlite:///' + os.path.join(self.dir.name, 'replica.db')
+        missing = 'sqlite:///' + os.path.join(self.dir.name, 'no', 'r.db')
+        self.app = create_app({
+            'DATABASE_URL': primary,
+            'DATABASE_REPLICA_URLS': [missing, replica],
+            'SUGGEST_INDEX': False
+        })
+        # stands in for replication, the row only exists on the replica
+        engine = create_engine(replica)
+        db.metadata.create_all(engine)
+        engine.execute(Movies.__table__.insert(),
+                       {'name': 'On the replica', 'rdate': None})
+        engine.dispose()
+
+    def tearDown(self):
+        self.app.extensions['replicas'].dispose()
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    def movie_names(self, headers=None):
+        with self.app.test_request_context('/', headers=headers):
+            return read_replica(lambda: [
+                movie.name for movie in Movies.query.all()])()
+
+    # Reads go to a healthy replica, the missing one is skipped
+    def test_reads_from_replica(self):
+        self.assertEqual(self.movie_names(), ['On the replica'])
+        stats = self.app.extensions['replicas'].stats()
+        self.assertEqual([replica['healthy'] for replica in
+                          stats['replicas']], [False, True])
+
+    # A client that just wrote reads from the primary
+    def test_read_your_writes(self):
+        with self.app.test_request_context('/'):
+            Movies(name='On the primary', rdate=None).insert()
+            response = stick_to_primary(self.app.response_class())
+            cookie = response.headers['Set-Cookie'].split(';')[0]
+        self.assertEqual(self.movie_names({'Cookie': cookie}),
+                         ['On the primary'])
+
+    # Every insert of a group commit batch sticks its client to the primary,
+    # not only the one that committed it
+    def test_group_commit_sticks(self):
+        group = GroupCommit(max_wait=1, max_rows=4)
+        cookies = []
+
+        def insert(index):
+            with self.app.test_request_context('/'):
+                group.insert(Movies, {'name': 'Movie %d' % index,
+                                      'rdate': None})
+                response = stick_to_primary(self.app.response_class())
+                cookies.append('Set-Cookie' in response.headers)
+        threads = [threading.Thread(target=insert, args=(index,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(group.stats()['batches'], 1)
+        self.assertEqual(cookies, [True] * 4)
+
+    # With no healthy replica the primary answers
+    def test_fallback_to_primary(self):
+        replicas = ReplicaSet(['sqlite:////nonexistent/replica.db'])
+        self.assertIsNone(replicas.choose())
+        self.assertEqual(replicas.stats()['primary_reads'], 1)
+
+
+# Group commit of concurrent inserts, on a SQLite file
+class GroupCommitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False
+        })
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    def insert_concurrently(self, group, count):
+        results = {}
+
+        def insert(index):
+            with self.app.app_context():
+                results[index] = group.insert(
+                    Movies, {'name': 'Movie %d' % index, 'rdate': None})
+        threads = [threading.Thread(target=insert, args=(index,))
+                   for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    # Concurrent inserts share one commit, each gets its own id
+    def test_inserts_share_commit(self):
+        group = GroupCommit(max_wait=1, max_rows=8)
+        results = self.insert_concurrently(group, 8)
+        self.assertEqual(group.stats()['batches'], 1)
+        with self.app.app_context():
+            names = dict(select_rows(Movies, ('id', 'name')))
+        for index, (row_id, error) in results.items():
+            self.assertIsNone(error)
+            self.assertEqual(names[row_id], 'Movie %d' % index)
+
+    # A batch never takes more than max_rows
+    def test_batch_bounded(self):
+        group = GroupCommit(max_wait=0.05, max_rows=3)
+        self.insert_concurrently(group, 9)
+        self.assertLessEqual(group.stats()['largest_batch'], 3)
+        self.assertGreaterEqual(group.stats()['batches'], 3)
+
+    # A failing row is reported alone, the rest of the batch commits
+    def test_failed_row_isolated(self):
+        with self.app.app_context():
+            results = insert_rows(Movies, [
+                {'name': 'First', 'rdate': None},
+                {'id': 1, 'name': 'Same id', 'rdate': None},
+                {'name': 'Third', 'rdate': None}])
+            self.assertEqual([row_id for row_id, error in results],
+                             [1, None, 2])
+            self.assertIsNotNone(results[1][1])
+            self.assertEqual(select_rows(Movies, ('name',)).count(), 2)
+
+
+# Optimistic concurrency on row versions, on a SQLite file
+class VersionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False
+        })
+        self.context = self.app.app_context()
+        self.context.push()
+        self.actor_id = insert_rows(Actors, [
+            {'name': 'Keanu Reeves', 'age': 50, 'gender': 'Male'}])[0][0]
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.context.pop()
+        self.dir.cleanup()
+
+    def version(self):
+        return select_rows(Actors, ('version',)).filter(
+            Actors.id == self.actor_id).scalar()
+
+    # Every update bumps the version, with or without an expected one
+    def test_update_bumps_version(self):
+        self.assertEqual(self.version(), 1)
+        self.assertEqual(update_row(Actors, self.actor_id, {'age': 51}), 2)
+        self.assertEqual(update_row(Actors, self.actor_id, {'age': 52}, 2), 3)
+        bulk_update(Actors, {'age': 53}, ids=[self.actor_id])
+        self.assertEqual(self.version(), 4)
+        actor = Actors.query.get(self.actor_id)
+        actor.age = 54
+        actor.update()
+        self.assertEqual(self.version(), 5)
+
+    # A write naming an old version is refused and changes nothing
+    def test_stale_version_conflicts(self):
+        update_row(Actors, self.actor_id, {'age': 51})
+        with self.assertRaises(VersionConflict):
+            update_row(Actors, self.actor_id, {'age': 60}, 1)
+        with self.assertRaises(VersionConflict):
+            delete_row(Actors, self.actor_id, 1)
+        self.assertEqual(select_rows(Actors, ('age',)).filter(
+            Actors.id == self.actor_id).scalar(), 51)
+
+    # A missing row is not a conflict
+    def test_missing_row(self):
+        self.assertIsNone(update_row(Actors, 999, {'age': 51}, 1))
+        self.assertIsNone(delete_row(Actors, 999, 1))
+        self.assertTrue(delete_row(Actors, self.actor_id, 1))
+
+    # If-Match parsing, * and no header expect no version
+    def test_expected_version(self):
+        for header, version in ((None, None), ('*', None), ('"v7"', 7)):
+            headers = {'If-Match': header} if header else {}
+            with self.app.test_request_context(headers=headers):
+                self.assertEqual(expected_version(), version)
+        with self.app.test_request_context(headers={'If-Match': '"abc"'}):
+            with self.assertRaises(PreconditionFailed):
+                expected_version()
+
+
+# Change log and feed, on a SQLite file
+class ChangeLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0
+        })
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.context.pop()
+        self.dir.cleanup()
+
+    def changes(self, since=0, tables=('movies', 'actors', 'movie_cast')):
+        return changes_since(since, tables, 100)[0]
+
+    # Every write is logged in order with the fields it wrote
+    def test_writes_logged(self):
+        (movie_id, error), = insert_rows(
+            Movies, [{'name': 'Matrix', 'rdate': '1999-03-31'}])
+        (actor_id, error), = insert_rows(
+            Actors, [{'name': 'Keanu Reeves', 'age': 50, 'gender': 'Male'}])
+        update_row(Actors, actor_id, {'age': 51})
+        add_cast([(movie_id, actor_id)])
+        delete_row(Movies, movie_id)
+        bulk_update(Actors, {'gender': 'M'}, where={'gender': 'Male'})
+        self.assertEqual([(change['seq'], change['op'], change.get('id'),
+                           change.get('data')) for change in self.changes()], [
+            (1, 'upsert', movie_id, {'name': 'Matrix', 'rdate': '1999-03-31'}),
+            (2, 'upsert', actor_id,
+             {'name': 'Keanu Reeves', 'age': 50, 'gender': 'Male'}),
+            (3, 'upsert', actor_id, {'age': 51}),
+            (4, 'upsert', None, {'movie_id': movie_id, 'actor_id': actor_id}),
+            (5, 'delete', movie_id, None),
+            (6, 'delete', None, {'movie_id': movie_id, 'actor_id': actor_id}),
+            (7, 'reset', None, None)])
+        self.assertEqual([change['seq'] for change in self.changes(
+            since=2, tables=('actors',))], [3, 7])
+
+    # An id repeated in another chunk is written, counted and logged once
+    def test_bulk_repeated_ids(self):
+        insert_rows(Actors, [{'name': 'Keanu Reeves', 'age': 50},
+                             {'name': 'Sandra Bullock', 'age': 40}])
+        self.assertEqual(bulk_update(Actors, {'age': 60}, ids=[1, 2, 1],
+                                     chunk_size=2), 2)
+        self.assertEqual(bulk_delete(Actors, ids=[2, 1, 2], chunk_size=1),
+                         2)
+        self.assertEqual([(change['op'], change['id'])
+                          for change in self.changes(2)],
+                         [('upsert', 1), ('upsert', 2),
+                          ('delete', 2), ('delete', 1)])
+
+    # Cast rows go away with their movie or actor, logged and versioned
+    def test_cast_deleted_with_row(self):
+        insert_rows(Movies, [{'name': 'Matrix'}, {'name': 'Speed'}])
+        insert_rows(Actors, [{'name': 'Keanu Reeves', 'age': 50,
+                              'gender': 'Male'},
+                             {'name': 'Sandra Bullock', 'age': 40,
+                              'gender': 'Female'}])
+        add_cast([(1, 1), (2, 1), (2, 2)])
+        version, since = table_versions('movie_cast', 'change_log')
+        delete_row(Movies, 1)
+        bulk_delete(Actors, where={'gender': 'Female'})
+        Actors.query.get(1).delete()
+        self.assertEqual(table_versions('movie_cast'), (version + 3,))
+        self.assertEqual([(change['op'], change['data']) for change in
+                          self.changes(since, ('movie_cast',))], [
+            ('delete', {'movie_id': 1, 'actor_id': 1}),
+            ('delete', {'movie_id': 2, 'actor_id': 2}),
+            ('delete', {'movie_id': 2, 'actor_id': 1})])
+        self.assertEqual(db.session.query(movie_cast).count(), 0)
+
+    # Entries committed without a seq stay hidden until they are numbered,
+    # after every seq handed out before
+    def test_unnumbered_entries(self):
+        insert_rows(Movies, [{'name': 'Matrix', 'rdate': None}])
+        db.session.execute(ChangeLog.__table__.insert(), {
+            'table_name': 'movies', 'row_id': 1, 'op': 'delete',
+            'created': datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual([change['seq'] for change in self.changes()], [1])
+        self.assertEqual(assign_seqs(), 1)
+        self.assertEqual(assign_seqs(), 0)
+        self.assertEqual([(change['seq'], change['op'])
+                          for change in self.changes()],
+                         [(1, 'upsert'), (2, 'delete')])
+        self.assertEqual(table_versions('change_log'), (2,))
+
+    # The write's own transaction never touches the counter rows, they are
+    # updated in short transactions after it commits
+    def test_counters_outside_write(self):
+        statements = []
+
+        def executed(conn, cursor, statement, *args):
+            statements.append(statement.split()[0] + (
+                ' table_versions' if 'table_versions' in statement else ''))
+
+        def committed(session):
+            statements.append('COMMIT')
+
+        (movie_id, error), = insert_rows(
+            Movies, [{'name': 'Matrix', 'rdate': None}])
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'after_cursor_execute', executed)
+        event.listen(db.session, 'after_commit', committed)
+        try:
+            update_row(Movies, movie_id, {'name': 'The Matrix'})
+        finally:
+            event.remove(engine, 'after_cursor_execute', executed)
+            event.remove(db.session, 'after_commit', committed)
+        write = statements.index('COMMIT')
+        self.assertNotIn('UPDATE table_versions', statements[:write])
+        self.assertIn('UPDATE table_versions', statements[write:])
+        self.assertEqual(table_versions('movies'), (2,))
+
+    # A rolled back write leaves no entry
+    def test_failed_write_not_logged(self):
+        insert_rows(Movies, [{'name': 'Matrix', 'rdate': None}])
+        with self.assertRaises(VersionConflict):
+            update_row(Movies, 1, {'rdate': '1999'}, 5)
+        self.assertEqual(len(self.changes()), 1)
+
+    # Compaction folds a row's entries into its latest seq
+    def test_compaction(self):
+        insert_rows(Actors, [{'name': 'Keanu Reeves', 'age': 50,
+                              'gender': 'Male'},
+                             {'name': 'Carrie-Anne Moss', 'age': 40,
+                              'gender': 'Female'}])
+        update_row(Actors, 1, {'age': 51})
+        delete_row(Actors, 2)
+        self.assertEqual(compact_changes(datetime.utcnow()), 2)
+        self.assertEqual([(change['seq'], change['op'], change.get('data'))
+                          for change in self.changes()], [
+            (3, 'upsert', {'name': 'Keanu Reeves', 'age': 51,
+                           'gender': 'Male'}),
+            (4, 'delete', None)])
+        bulk_delete(Actors, where={'gender': 'Male'})
+        insert_rows(Actors, [{'name': 'Laurence Fishburne', 'age': 60,
+                              'gender': 'Male'}])
+        compact_changes(datetime.utcnow())
+        self.assertEqual([(change['seq'], change['op'])
+                          for change in self.changes()],
+                         [(3, 'upsert'), (4, 'delete'), (5, 'reset'),
+                          (6, 'upsert')])
+
+    # Pruning drops old entries and moves the horizon past them
+    def test_prune(self):
+        insert_rows(Movies, [{'name': 'Matrix', 'rdate': None}])
+        self.assertEqual(prune_changes(datetime.utcnow()), 1)
+        insert_rows(Movies, [{'name': 'Speed', 'rdate': None}])
+        self.assertEqual(
+            table_versions('change_log_pruned', 'change_log'), (1, 2))
+        self.assertEqual([change['seq'] for change in self.changes()], [2])
+
+    # A long-poll returns as soon as another thread writes
+    def test_long_poll_wakes_up(self):
+        def write():
+            time.sleep(0.2)
+            with self.app.app_context():
+                insert_rows(Movies, [{'name': 'Matrix', 'rdate': None}])
+        threading.Thread(target=write).start()
+        with self.app.test_request_context():
+            start = time.monotonic()
+            changes, last = read_changes(0, ('movies',), 10, 5)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual((len(changes), last), (1, 1))
+
+
+# Server-Timing and Prometheus metrics
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+            'METRICS_DIR': os.path.join(self.dir.name, 'metrics'),
+            'STATS': True
+        })
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    def get(self, url):
+        res = self.client.get(url)
+        res.close()
+        return res
+
+    # Responses carry their phases and query count as Server-Timing
+    def test_server_timing(self):
+        res = self.get('/metrics')
+        phases = [part.split(';')[0]
+                  for part in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['auth', 'db', 'serialize', 'app', 'total'])
+        self.assertIn('desc="0 queries"', res.headers['Server-Timing'])
+
+    # Requests show up on /metrics as counters and histograms
+    def test_metrics_endpoint(self):
+        self.get('/stats')
+        self.get('/movies')
+        body = self.get('/metrics').get_data(as_text=True)
+        self.assertIn('casting_http_requests_total{endpoint="get_stats",'
+                      'method="GET",status="200"} 1', body)
+        self.assertIn('casting_http_requests_total{endpoint="get_movies",'
+                      'method="GET",status="401"} 1', body)
+        self.assertIn('casting_http_request_duration_seconds_bucket{'
+                      'endpoint="get_stats",phase="total",le="+Inf"} 1', body)
+
+    # /stats takes no token, so it is only served when turned on
+    def test_stats_off_by_default(self):
+        self.assertFalse(create_app({
+            'DATABASE_URL': 'sqlite://', 'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0, 'METRICS_DIR': ''
+        }).config['STATS'])
+        self.app.config['STATS'] = False
+        self.assertEqual(self.get('/stats').status_code, 404)
+
+    # /metrics adds up the files written by the other workers
+    def test_workers_aggregated(self):
+        directory = os.path.join(self.dir.name, 'workers')
+        workers = [Metrics(directory), Metrics(directory)]
+        for worker in workers:
+            timings = Timings()
+            timings.add('db', 0.003)
+            timings.queries = 2
+            worker.observe('get_actors', 'GET', 200, timings)
+            worker.flush()
+        reader = Metrics(directory)
+        body = reader.render()
+        self.assertIn('casting_http_requests_total{endpoint="get_actors",'
+                      'method="GET",status="200"} 2', body)
+        self.assertIn('casting_db_queries_total{endpoint="get_actors"} 4',
+                      body)
+        self.assertIn('casting_http_request_duration_seconds_bucket{'
+                      'endpoint="get_actors",phase="db",le="0.0025"} 0', body)
+        self.assertIn('casting_http_request_duration_seconds_bucket{'
+                      'endpoint="get_actors",phase="db",le="0.005"} 2', body)
+
+    # Files of exited workers are folded into one, the totals stay
+    def test_retire_worker(self):
+        directory = os.path.join(self.dir.name, 'workers')
+        group = os.path.join(directory, str(os.getppid()))
+        for _ in range(3):
+            worker = Metrics(directory)
+            worker.observe('get_actors', 'GET', 200, Timings())
+            worker.flush()
+            retire_worker(directory, os.getppid(), os.getpid())
+        self.assertEqual(os.listdir(group), [EXITED_FILE])
+        self.assertIn('casting_http_requests_total{endpoint="get_actors",'
+                      'method="GET",status="200"} 3',
+                      Metrics(directory).render())
+        stale = os.path.join(directory, '999999999')
+        os.makedirs(stale)
+        clear_metrics_dir(directory)
+        self.assertEqual(os.listdir(directory), [str(os.getppid())])
+
+
+# Statement counts, slow queries and query budgets
+class QueryProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+            'METRICS': False,
+            'SQL_PROFILER': True,
+            'SLOW_QUERY_MS': 1000,
+            'N_PLUS_ONE_THRESHOLD': 3
+        })
+        self.profiler = self.app.extensions['sql_profiler']
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    # Statements for other ids and IN list lengths have the same shape
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape('SELECT id FROM movies\n WHERE id IN (?, ?, ?)'),
+            statement_shape('SELECT id FROM movies WHERE id IN (%(id_1)s)'))
+        self.assertEqual(repeated_selects(
+            ['SELECT a FROM t WHERE id = 1', 'SELECT a FROM t WHERE id = 2',
+             'UPDATE t SET a = 1', 'UPDATE t SET a = 2'], 2),
+            [('SELECT a FROM t WHERE id = ?', 2)])
+
+    # Statements are counted per endpoint, a repeated SELECT is an N+1
+    def test_request_profile(self):
+        with self.app.test_request_context('/movies'):
+            for movie_id in range(4):
+                missing_ids(Movies, [movie_id])
+        stats = self.profiler.stats()
+        self.assertEqual(stats['endpoints']['get_movies']['statements'], 4)
+        self.assertEqual(stats['n_plus_one'][0]['count'], 4)
+        self.assertEqual(stats['slow_queries'], [])
+
+    # Statements over the threshold are logged with their parameters, /stats
+    # keeps the statement and endpoint only
+    def test_slow_query(self):
+        self.profiler.slow_query_ms = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logged:
+            with self.app.test_request_context('/actors'):
+                missing_ids(Actors, [98765])
+        self.assertIn('98765', logged.output[0])
+        slow, = self.profiler.stats()['slow_queries']
+        self.assertEqual(slow['endpoint'], 'get_actors')
+        self.assertIn('actors', slow['statement'])
+        self.assertNotIn('98765', json.dumps(slow))
+
+    # query_budget fails listing the statements over the budget
+    def test_query_budget(self):
+        with self.app.app_context():
+            with query_budget(2):
+                missing_ids(Movies, [1])
+            with self.assertRaises(AssertionError) as raised:
+                with query_budget(2):
+                    for movie_id in range(3):
+                        missing_ids(Movies, [movie_id])
+        self.assertIn('3 statements, budget 2', str(raised.exception))
+        self.assertIn('repeated 3 times', str(raised.exception))
+
+    # With tables only the statements on those tables count
+    def test_query_budget_tables(self):
+        with self.app.app_context():
+            with query_budget(1, tables=('actors',)) as statements:
+                missing_ids(Movies, [1])
+                missing_ids(Actors, [1])
+        self.assertEqual(len(statements), 1)
+        self.assertIn('actors', statements[0])
+
+
+# JSON serializers
+class SerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite://',
+            'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0
+        })
+        self.stdlib = make_serializer(self.app, 'stdlib')
+        self.orjson = make_serializer(self.app, 'orjson')
+
+    def assertSameBytes(self, data):
+        with self.app.test_request_context():
+            self.assertEqual(self.orjson.dumps(data),
+                             self.stdlib.dumps(data))
+            self.assertEqual(self.stdlib.dumps(data) + b'\n',
+                             jsonify(data).get_data())
+            self.assertEqual(self.orjson.encoder()(data),
+                             self.stdlib.encoder()(data))
+
+    # orjson writes what jsonify writes, escapes and key order included
+    def test_same_bytes(self):
+        self.assertSameBytes({
+            'movies': [
+                {'id': 1, 'name': 'Amélie', 'rdate': None},
+                {'id': 2, 'name': '千と千尋の神隠し 🐉', 'rdate': 'July 20'},
+                {'id': 3, 'name': 'tab\tquote"slash\\del\x7fnul\x00',
+                 'rdate': '\u2028\ud7ff\ue000\uffff'}
+            ],
+            'next_cursor': 'eyJpZCI6IDN9',
+            'success': True,
+            'b': [1.5, -0, 0.1, True, False, 2 ** 63 - 1, -2 ** 63]
+        })
+        # mostly non-ASCII text is encoded by the stdlib
+        self.assertSameBytes({'name': 'Ωμέγα' * 100})
+
+    # Dates go through the app's encoder, and so does everything orjson
+    # refuses
+    def test_fallbacks(self):
+        self.assertSameBytes({'released': date(1999, 3, 31),
+                              'updated': datetime(2020, 1, 2, 3, 4, 5)})
+        self.assertSameBytes({'id': 2 ** 64})
+        self.assertSameBytes({'counts': {1: 'one'}})
+
+    # The app's JSON settings apply to both serializers
+    def test_config(self):
+        self.app.config['JSON_AS_ASCII'] = False
+        self.app.config['JSON_SORT_KEYS'] = False
+        self.assertSameBytes({'z': 'Amélie', 'a': 1})
+        self.app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+        with self.app.test_request_context():
+            self.assertEqual(self.orjson.dumps({'z': 1, 'a': [2]}),
+                             b'{\n  "z": 1, \n  "a": [\n    2\n  ]\n}')
+
+    # Serializing counts toward the serialize phase of Server-Timing
+    def test_serialize_timing(self):
+        with self.app.test_request_context():
+            g.timings = Timings()
+            self.orjson.dumps({'movies': [{'id': 1}] * 1000})
+            self.assertGreater(g.timings.phases['serialize'], 0)
+
+    # Unknown serializer names are refused
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            make_serializer(self.app, 'ujson')
+
+
+# Response compression and MessagePack
+class EncodingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app({
+            'DATABASE_URL': 'sqlite:///' + os.path.join(
+                self.dir.name, 'cast.db'),
+            'SUGGEST_INDEX': False,
+            'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+            'METRICS_DIR': '',
+            'COMPRESSION_MIN_SIZE': 200,
+            'STATS': True
+        })
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        self.dir.cleanup()
+
+    # Bodies are compressed with the best encoding the client accepts
+    def test_negotiated_encoding(self):
+        self.client.get('/stats')
+        plain = self.client.get('/metrics').data
+        for accept, encoding, decompress in (
+                ('gzip, deflate, br', 'br', brotli.decompress),
+                ('gzip, br;q=0.5', 'gzip', gzip.decompress),
+                ('deflate', None, None)):
+            res = self.client.get('/metrics',
+                                  headers={'Accept-Encoding': accept})
+            self.assertEqual(res.headers.get('Content-Encoding'), encoding)
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+            if decompress is not None:
+                self.assertLess(len(res.data), len(plain))
+                # the request counter went up since the plain read
+                self.assertEqual(decompress(res.data)[:100], plain[:100])
+
+    # Bodies under the minimum size are sent as they are
+    def test_small_body_not_compressed(self):
+        res = self.client.get('/movies', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 401)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    # Streamed bodies are compressed chunk by chunk
+    def test_compress_chunks(self):
+        compressor = Compressor()
+        chunks = [b'{"id":%d}\n' % i * 100 for i in range(10)]
+        self.assertEqual(gzip.decompress(b''.join(
+            compressor.compress_chunks(iter(chunks), 'gzip'))),
+            b''.join(chunks))
+        self.assertEqual(brotli.decompress(b''.join(
+            compressor.compress_chunks(iter(chunks), 'br'))),
+            b''.join(chunks))
+
+    # JSON responses and errors come as MessagePack when preferred
+    def test_msgpack_response(self):
+        stats = json.loads(self.client.get('/stats').data)
+        res = self.client.get('/stats', headers={
+            'Accept': 'application/msgpack, application/json;q=0.5'})
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(res.data).keys(), stats.keys())
+        self.assertIn('Accept', res.headers['Vary'])
+        res = self.client.get('/movies', headers={
+            'Accept': 'application/x-msgpack'})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.mimetype, 'application/x-msgpack')
+        self.assertEqual(msgpack.unpackb(res.data)['success'], False)
+        res = self.client.get('/stats', headers={'Accept': '*/*'})
+        self.assertEqual(res.mimetype, 'application/json')
+
+    # MessagePack request bodies read like JSON ones
+    def test_msgpack_request(self):
+        with self.app.test_request_context(
+                '/actors', method='POST', content_type='application/msgpack',
+                data=msgpack.packb({'name': 'Amélie', 'age': 30})):
+            self.assertEqual(request.get_json(), {'name': 'Amélie',
+                                                  'age': 30})
+        with self.app.test_request_context(
+                '/actors', method='POST', content_type='application/msgpack',
+                data=b'\xc1'):
+            self.assertIsNone(request.get_json(silent=True))
+
+
+# ASGI entry point
+class AsgiTestCase(unittest.TestCase):
+
+    def serve(self, app, messages, path='/', query=b'', headers=(),
+              method='POST'):
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query, 'headers': list(headers),
+                 'http_version': '1.1', 'server': ('testserver', 80)}
+        messages = list(messages)
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(0.05)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(app(scope, receive, send))
+        return sent
+
+    # Requests reach the WSGI app with their body, path, query and headers
+    def test_request(self):
+        def echo(environ, start_response):
+            start_response('201 Created', [('X-Path', environ['PATH_INFO'])])
+            return [environ['wsgi.input'].read(), b'|',
+                    environ['QUERY_STRING'].encode(), b'|',
+                    environ['CONTENT_TYPE'].encode(), b'|',
+                    environ['HTTP_ACCEPT'].encode()]
+
+        sent = self.serve(AsgiApp(echo, 2), [
+            {'type': 'http.request', 'body': b'{"a":', 'more_body': True},
+            {'type': 'http.request', 'body': b'1}'}
+        ], path='/mövies', query=b'limit=5', headers=[
+            (b'content-type', b'application/json'), (b'accept', b'a/b'),
+            (b'accept', b'c/d')])
+        self.assertEqual(sent[0]['status'], 201)
+        self.assertEqual(sent[0]['headers'],
+                         [(b'x-path', '/mövies'.encode())])
+        self.assertEqual(b''.join(message['body'] for message in sent[1:]),
+                         b'{"a":1}|limit=5|application/json|a/b,c/d')
+        self.assertFalse(sent[-1]['more_body'])
+
+    # Streamed bodies are sent chunk by chunk, and stop when the client
+    # goes away
+    def test_streaming(self):
+        closed = []
+
+        def rows():
+            try:
+                for number in range(1000):
+                    time.sleep(0.01)
+                    yield b'%d\n' % number
+            finally:
+                closed.append(True)
+
+        def stream(environ, start_response):
+            start_response('200 OK', [])
+            return rows()
+
+        sent = self.serve(AsgiApp(stream, 2),
+                          [{'type': 'http.request', 'body': b''}])
+        self.assertEqual(closed, [True])
+        self.assertGreater(len(sent), 2)
+        self.assertLess(len(sent), 100)
+        self.assertTrue(all(message['more_body'] for message in sent[1:]))
+
+    # Startup tasks run before requests, failures are reported
+    def test_lifespan(self):
+        started = []
+
+        def fail():
+            raise RuntimeError('no keys')
+
+        for startup, expected in (((lambda: started.append(1),),
+                                   'lifespan.startup.complete'),
+                                  ((fail,), 'lifespan.startup.failed')):
+            messages = [{'type': 'lifespan.startup'},
+                        {'type': 'lifespan.shutdown'}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            asyncio.run(AsgiApp(None, 1, startup)(
+                {'type': 'lifespan'}, receive, send))
+            self.assertEqual(sent[0]['type'], expected)
+        self.assertEqual(started, [1])
+
+    # The app serves its routes through the ASGI entry point
+    def test_create_asgi_app(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_asgi_app({
+                'DATABASE_URL': 'sqlite:///' + os.path.join(
+                    directory, 'cast.db'),
+                'SUGGEST_INDEX': False,
+                'CHANGE_LOG_MAINTENANCE_INTERVAL': 0,
+                'METRICS_DIR': '',
+                'STATS': True
+            })
+            sent = self.serve(app, [{'type': 'http.request', 'body': b''}],
+                              path='/stats', method='GET')
+            self.assertEqual(app.wsgi_app.config['DB_POOL_SIZE'],
+                             ASGI_THREADS)
+            with app.wsgi_app.app_context():
+                db.get_engine(app.wsgi_app).dispose()
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertTrue(json.loads(b''.join(
+            message.get('body', b'') for message in sent[1:]))['success'])
+
+
+# gunicorn.conf.py settings and hooks
+class GunicornConfigTestCase(unittest.TestCase):
+
+    def load(self, **environ):
+        saved = dict(os.environ)
+        os.environ.pop('DB_POOL_SIZE', None)
+        os.environ.update(environ)
+        try:
+            config = runpy.run_path(os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), 'gunicorn.conf.py'))
+            return config, os.environ.get('DB_POOL_SIZE')
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+
+    # Workers stay sync unless threads are asked for, then the pool holds
+    # a connection per thread
+    def test_worker_class(self):
+        config, pool_size = self.load()
+        self.assertNotIn('worker_class', config)
+        self.assertEqual(config['threads'], 1)
+        self.assertIsNone(pool_size)
+        config, pool_size = self.load(WORKER_THREADS='24')
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertEqual(pool_size, '24')
+        self.assertEqual(self.load(WORKER_THREADS='24', DB_POOL_SIZE='8')[1],
+                         '8')
+
+    # Workers fetch the signing keys once they start
+    def test_post_worker_init(self):
+        config, pool_size = self.load()
+        refreshed = []
+        jwks_cache.refresh = lambda: refreshed.append(True)
+        try:
+            config['post_worker_init'](None)
+        finally:
+            del jwks_cache.refresh
+        self.assertEqual(refreshed, [True])
+
+    # The master clears METRICS_DIR at start and retires exited workers
+    def test_metrics_hooks(self):
+        config, pool_size = self.load()
+        calls = []
+        saved = (metrics_module.clear_metrics_dir,
+                 metrics_module.retire_worker)
+        metrics_module.clear_metrics_dir = lambda *args: calls.append(args)
+        metrics_module.retire_worker = lambda *args: calls.append(args)
+        try:
+            config['on_starting'](None)
+            config['child_exit'](type('Server', (), {'pid': 10})(),
+                                 type('Worker', (), {'pid': 11})())
+        finally:
+            metrics_module.clear_metrics_dir, metrics_module.retire_worker = \
+                saved
+        self.assertEqual(calls, [(metrics_module.METRICS_DIR,),
+                                 (metrics_module.METRICS_DIR, 10, 11)])
+
+
+# Response cache backends
+class ResponseCacheTestCase(unittest.TestCase):
+
+    # Least recently used entries are evicted past the memory cap
+    def test_lru_evicts_by_bytes(self):
+        cache = ResponseCache(LRUBackend(max_bytes=100))
+        cache.set('movies1-a', ('movies',), 'application/json', b'x' * 20)
+        cache.set('movies1-b', ('movies',), 'application/json', b'x' * 20)
+        cache.get('movies1-a')
+        cache.set('movies1-c', ('movies',), 'application/json', b'x' * 20)
+        self.assertIsNone(cache.get('movies1-b'))
+        self.assertEqual(cache.get('movies1-a'),
+                         ('application/json', b'x' * 20))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    # Writes drop the local entries of the written table only
+    def test_lru_invalidate_table(self):
+        cache = ResponseCache(LRUBackend())
+        cache.set('movies1-a', ('movies',), 'application/json', b'[]')
+        cache.set('actors1-a', ('actors',), 'application/json', b'[]')
+        cache.invalidate(('movies',))
+        self.assertIsNone(cache.get('movies1-a'))
+        self.assertIsNotNone(cache.get('actors1-a'))
+
+    # Evicted and invalidated keys leave the table index
+    def test_lru_table_index_bounded(self):
+        backend = LRUBackend(max_bytes=100)
+        for number in range(1000):
+            backend.set('cast%d' % number, b'x' * 20, ('movies', 'actors'))
+        self.assertEqual(backend.stats()['entries'], 5)
+        self.assertEqual({table: len(keys) for table, keys in
+                          backend._tables.items()},
+                         {'movies': 5, 'actors': 5})
+        backend.invalidate(('movies',))
+        self.assertEqual(backend._tables, {})
+        self.assertEqual(backend.size, 0)
+
+    # Shared backend entries are visible to every worker
+    def test_shared_backend(self):
+        store = {}
+        ResponseCache(LocalSharedBackend(store)).set(
+            'movies1-a', ('movies',), 'application/json', b'[]')
+        cache = ResponseCache(LocalSharedBackend(store))
+        self.assertEqual(cache.get('movies1-a'), ('application/json', b'[]'))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+# Coalescing of identical concurrent reads
+class SingleFlightTestCase(unittest.TestCase):
+
+    def run_concurrently(self, flight, fn, callers=5):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('movies', fn)))
+            for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    # Concurrent callers share one execution
+    def test_calls_coalesced(self):
+        flight = SingleFlight(timeout=5)
+        calls = []
+
+        def query():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'rows'
+
+        results = self.run_concurrently(flight, query)
+        self.assertEqual(results, [b'rows'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()['coalesced'], 4)
+
+    # Callers stop waiting after the timeout and run their own query
+    def test_wait_timeout(self):
+        flight = SingleFlight(timeout=0.01)
+        results = self.run_concurrently(
+            flight, lambda: time.sleep(0.2) or b'rows', callers=3)
+        self.assertEqual(results, [b'rows'] * 3)
+        self.assertEqual(flight.stats()['timeouts'], 2)
+
+
+# JWKS key store, runs offline against a local JWKS file
+class JWKSCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.write_jwks('key-1')
+        self.cache = JWKSCache(self.jwks_path, ttl=600,
+                               min_refresh_interval=0)
+
+    def tearDown(self):
+        if os.path.exists(self.jwks_path):
+            os.remove(self.jwks_path)
+
+    def write_jwks(self, *kids):
+        with open(self.jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': kid,
+                'use': 'sig',
+                'n': 'AQAB',
+                'e': 'AQAB'
+            } for kid in kids]}, jwks_file)
+
+    # Keys are fetched once and then served from memory
+    def test_jwks_cached(self):
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        stats = self.cache.stats()
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 0)
+
+    # Unknown kid refetches the key set once
+    def test_jwks_unknown_kid_refetch(self):
+        self.cache.get_key('key-1')
+        self.write_jwks('key-1', 'key-2')
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        stats = self.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['refreshes'], 2)
+
+    # Unknown kid refetches are rate limited
+    def test_jwks_refetch_rate_limited(self):
+        self.cache.min_refresh_interval = 60
+        self.cache.get_key('key-1')
+        self.assertIsNone(self.cache.get_key('key-2'))
+        self.assertIsNone(self.cache.get_key('key-3'))
+        self.assertEqual(self.cache.stats()['refreshes'], 1)
+
+    # Failed refresh keeps serving stale keys
+    def test_jwks_stale_on_failure(self):
+        self.cache.get_key('key-1')
+        os.remove(self.jwks_path)
+        self.cache.ttl = 0
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertIsNone(self.cache.get_key('key-2'))
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertGreaterEqual(self.cache.stats()['refresh_failures'], 1)
+
+    # Expired key set is refreshed in the background
+    def test_jwks_background_refresh(self):
+        self.cache.get_key('key-1')
+        self.cache.ttl = 0
+        self.write_jwks('key-2')
+        # keep the background refresh from finishing before the stale read
+        with self.cache._refresh_lock:
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        deadline = time.monotonic() + 5
+        while (self.cache.stats()['refreshes'] < 2 and
+               time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+
+
+# Verified token cache
+class TokenCacheTestCase(unittest.TestCase):
+
+    def payload(self, *permissions, exp=None):
+        return {
+            'exp': exp or time.time() + 3600,
+            'permissions': list(permissions)
+        }
+
+    # Verified payload is returned for the same token
+    def test_token_cached(self):
+        cache = TokenCache(2)
+        self.assertIsNone(cache.get('token-a'))
+        cache.put('token-a', self.payload('get:movies'))
+        entry = cache.get('token-a')
+        self.assertEqual(entry.permissions, frozenset(['get:movies']))
+        self.assertTrue(check_permissions('get:movies', entry.payload,
+                                          entry.permissions))
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    # Least recently used token is evicted past maxsize
+    def test_token_evicted(self):
+        cache = TokenCache(2)
+        cache.put('token-a', self.payload())
+        cache.put('token-b', self.payload())
+        cache.get('token-a')
+        cache.put('token-c', self.payload())
+        self.assertIsNone(cache.get('token-b'))
+        self.assertIsNotNone(cache.get('token-a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    # Entries expire with the token
+    def test_token_expired(self):
+        cache = TokenCache(2)
+        cache.put('token-a', self.payload(exp=time.time() - 1))
+        self.assertIsNone(cache.get('token-a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    # Missing permission still fails with 403
+    def test_token_permission_denied(self):
+        entry = TokenCache(0).put('token-a', self.payload('get:movies'))
+        with self.assertRaises(AuthError) as error:
+            check_permissions('post:movies', entry.payload,
+                              entry.permissions)
+        self.assertEqual(error.exception.status_code, 403)
+
+
 if __name__ == '__main__':
     unittest.main()